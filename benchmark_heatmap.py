@@ -0,0 +1,296 @@
+"""Benchmark the stages of the text reuse heatmap pipeline
+on synthetic passim data.
+
+Steps:
+1. generate_synthetic_folder(): create a folder of passim-style srt files
+(bk1_bk2.csv / bk1_bk2.csv.gz) for a single main text,
+plus a metadata file in the format of the OpenITI metadata file
+2. run_benchmark(): time every stage of the pipeline
+(extract_milestone_data_from_folder, calculate_token_reuse_freq,
+create_plot_lines, filtering date ranges, plot_with_matplotlib,
+plot_with_bokeh) at one or more scales
+3. the results are saved as a json file (with the current git commit),
+which can be compared with the results of another commit
+using compare_results()
+4. optionally (--check), the results of all engines are compared
+with the legacy implementation (see equivalence_heatmap.py)
+
+The generated data is deterministic: the same scale and seed
+always produce the same files.
+
+Usage:
+
+    python benchmark_heatmap.py [scale ...] [--out results.json] [--compare old.json] [--check]
+
+"""
+
+import os
+import sys
+import csv
+import gzip
+import json
+import time
+import shutil
+import platform
+import argparse
+import subprocess
+
+import numpy as np
+import matplotlib
+matplotlib.use("Agg")  # benchmarks should run without a display
+import matplotlib.pyplot as plt
+
+import milestone_text_reuse_heatmap as heatmap
+import equivalence_heatmap
+
+
+# parameters of the synthetic data at each scale:
+SCALES = {
+    "tiny":   dict(n_pairs=10,  n_rows=200,   n_ms=100),
+    "small":  dict(n_pairs=50,  n_rows=1000,  n_ms=500),
+    "medium": dict(n_pairs=200, n_rows=2000,  n_ms=2000),
+    "large":  dict(n_pairs=500, n_rows=5000,  n_ms=10000),
+}
+
+DATE_RANGES = [(0, 500), (500, 1000), (1000, 1501)]
+FILTER_DATE_RANGES = [0]
+
+META_FN = "synthetic_metadata.tsv"
+
+
+def alignment_lengths(rnd, n, dist="lognormal", mean_length=40, max_length=300):
+    """Draw the lengths (in tokens) of `n` alignments.
+
+    Args:
+        rnd (numpy Generator): random number generator
+        n (int): number of lengths
+        dist (str): "lognormal" (many short and few long alignments,
+            as in passim output), "uniform" or "fixed"
+        mean_length (int): (approximate) mean length
+        max_length (int): maximum length
+
+    Returns:
+        numpy array
+    """
+    if dist == "lognormal":
+        lengths = rnd.lognormal(np.log(mean_length) - 0.5, 1.0, n)
+    elif dist == "uniform":
+        lengths = rnd.uniform(1, 2*mean_length, n)
+    elif dist == "fixed":
+        lengths = np.full(n, mean_length)
+    else:
+        raise ValueError("unknown length distribution: {}".format(dist))
+    return np.clip(lengths.astype(np.int64), 1, max_length)
+
+def generate_synthetic_folder(folder, n_pairs=50, n_rows=1000, n_ms=500,
+                              ms_tokens=300, comp_ms=1000, length_dist="lognormal",
+                              mean_length=40, gz="mixed", seed=0):
+    """Create a folder with synthetic passim srt files for a single
+    main text, and a metadata file for the main and compared texts.
+
+    Args:
+        folder (str): path to the output folder (will be overwritten)
+        n_pairs (int): number of srt files (compared texts)
+        n_rows (int): number of alignments in each srt file
+        n_ms (int): number of milestones in the main text
+        ms_tokens (int): number of tokens in each milestone
+        comp_ms (int): number of milestones in each compared text
+        length_dist (str): distribution of the alignment lengths
+            (see alignment_lengths())
+        mean_length (int): mean alignment length
+        gz (bool or str): True (all files gzipped), False (no files gzipped)
+            or "mixed" (every other file gzipped)
+        seed (int): seed of the random number generator
+
+    Returns:
+        str (path to the metadata file)
+    """
+    rnd = np.random.default_rng(seed)
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    os.makedirs(folder)
+    main = "Synth0000001-ara1"
+    meta_rows = [{"id": main.split("-")[0], "status": "pri", "date": 310,
+                  "author_lat": "Synthetic", "book": "MainText"}]
+    fields = ["id1", "id2", "bw1", "ew1", "bw2", "ew2", "s1", "s2"]
+    for p in range(n_pairs):
+        comp_id = "Synth{:07d}".format(p + 2)
+        comp = "{}-ara1".format(comp_id)
+        meta_rows.append({"id": comp_id, "status": "pri" if p % 5 else "sec",
+                          "date": int(rnd.integers(1, 1500)),
+                          "author_lat": "Author{}".format(p),
+                          "book": "Book{}".format(p)})
+        # the main text is bk1 in half of the files:
+        main_first = p % 2 == 0
+        lengths = alignment_lengths(rnd, n_rows, length_dist, mean_length,
+                                    max_length=ms_tokens)
+        main_ms = rnd.integers(1, n_ms + 1, n_rows)
+        main_bw = rnd.integers(0, ms_tokens - lengths + 1)
+        c_ms = rnd.integers(1, comp_ms + 1, n_rows)
+        c_bw = rnd.integers(0, ms_tokens - lengths + 1)
+        rows = []
+        for i in range(n_rows):
+            m = {"id": "{}.ms{}".format(main, main_ms[i]),
+                 "bw": int(main_bw[i]), "ew": int(main_bw[i] + lengths[i]),
+                 "s": "m" * int(lengths[i])}
+            c = {"id": "{}.ms{}".format(comp, c_ms[i]),
+                 "bw": int(c_bw[i]), "ew": int(c_bw[i] + lengths[i]),
+                 "s": "c" * int(lengths[i])}
+            first, second = (m, c) if main_first else (c, m)
+            rows.append([first["id"], second["id"], first["bw"], first["ew"],
+                         second["bw"], second["ew"], first["s"], second["s"]])
+        fn = "{}_{}.csv".format(*((main, comp) if main_first else (comp, main)))
+        fp = os.path.join(folder, fn)
+        if gz is True or (gz == "mixed" and p % 2):
+            file = gzip.open(fp + ".gz", mode="wt", encoding="utf-8", newline="")
+        else:
+            file = open(fp, mode="w", encoding="utf-8", newline="")
+        with file:
+            writer = csv.writer(file, delimiter="\t")
+            writer.writerow(fields)
+            writer.writerows(rows)
+    meta_fp = os.path.join(os.path.dirname(os.path.abspath(folder)), META_FN)
+    with open(meta_fp, mode="w", encoding="utf-8", newline="") as file:
+        writer = csv.DictWriter(file, ["id", "status", "date", "author_lat", "book"],
+                                delimiter="\t")
+        writer.writeheader()
+        writer.writerows(meta_rows)
+    return meta_fp
+
+def timed(func, *args, **kwargs):
+    """Call a function and return (its result, the wall time in seconds)."""
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def run_benchmark(scale, workdir="benchmark_data", seed=0, workers=None,
+                  memory=False, profile=False):
+    """Time every stage of the heatmap pipeline on synthetic data.
+
+    Args:
+        scale (str or dict): name of a scale in SCALES, or parameters
+            for generate_synthetic_folder()
+        workdir (str): folder in which the synthetic data is generated
+        seed (int): seed of the random number generator
+        workers (int): number of workers for calculate_token_reuse_freq()
+        memory (bool): if True, trace the peak memory allocation of each stage
+            (slows down the stages)
+        profile (bool): if True, save a cProfile dump of each stage
+            in the "profile" folder of the synthetic data
+
+    Returns:
+        dict ({"params": ..., "stages": {stage: seconds}, "n_lines": ...,
+            "instrumentation": records of all (nested) stages,
+            see heatmap.instrumentation_report()})
+    """
+    params = dict(SCALES[scale]) if isinstance(scale, str) else dict(scale)
+    name = scale if isinstance(scale, str) else "custom"
+    folder = os.path.join(workdir, name)
+    print("Generating synthetic data for scale", name, params)
+    meta_fp = generate_synthetic_folder(folder, seed=seed, **params)
+    heatmap.meta.clear()
+    heatmap.meta.update(heatmap.load_metadata(meta_fp))
+
+    heatmap.enable_instrumentation(memory=memory,
+                                   profile_folder=os.path.join(folder, "profile") if profile else None)
+    stages = dict()
+    _, stages["extract_milestone_data_from_folder"] = timed(
+        heatmap.extract_milestone_data_from_folder, folder)
+    ms_count_dicts, stages["calculate_token_reuse_freq"] = timed(
+        heatmap.calculate_token_reuse_freq, folder, DATE_RANGES, workers=workers)
+    outfps = [os.path.join(folder, "lines_{}_{}.plotjson".format(*dr))
+              for dr in DATE_RANGES]
+    split_data_lines, stages["create_plot_lines"] = timed(
+        heatmap.create_plot_lines, ms_count_dicts, outfps)
+    n_lines = [len(lines) for lines in split_data_lines]
+    _, stages["filter_date_ranges"] = timed(
+        heatmap.filter_date_range_lines, split_data_lines, FILTER_DATE_RANGES)
+    max_val = max([1] + [v for lines in split_data_lines for x, y, v in lines])
+    last_ms = max([0] + [x[0] for lines in split_data_lines for x, y, v in lines])
+    _, stages["plot_with_matplotlib"] = timed(
+        heatmap.plot_with_matplotlib, DATE_RANGES, split_data_lines, max_val,
+        last_ms, plt.cm.inferno_r, outfp=os.path.join(folder, "heatmap.png"),
+        filter_date_ranges=FILTER_DATE_RANGES, title=name, show_plot=False)
+    _, stages["plot_with_bokeh"] = timed(
+        heatmap.plot_with_bokeh, DATE_RANGES, split_data_lines, max_val,
+        last_ms, heatmap.inferno, outfp=os.path.join(folder, "heatmap.html"),
+        filter_date_ranges=FILTER_DATE_RANGES, title=name, show_plot=False)
+    records = heatmap.disable_instrumentation()
+    for stage, t in stages.items():
+        print("{:40} {:8.3f} s".format(stage, t))
+    return {"params": params, "stages": stages, "n_lines": n_lines,
+            "instrumentation": records}
+
+def git_commit():
+    """Get the hash of the current git commit (or None)."""
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare_results(old_fp, new_results):
+    """Print the speedup of every stage compared to an earlier results file."""
+    with open(old_fp, mode="r", encoding="utf-8") as file:
+        old_results = json.load(file)
+    print("\nComparison with", old_fp, "(commit {})".format(old_results.get("commit")))
+    for scale, result in new_results["scales"].items():
+        if scale not in old_results["scales"]:
+            continue
+        print(scale)
+        old_stages = old_results["scales"][scale]["stages"]
+        for stage, t in result["stages"].items():
+            if stage in old_stages:
+                print("  {:38} {:8.3f} s -> {:8.3f} s  ({:.2f}x)".format(
+                    stage, old_stages[stage], t, old_stages[stage] / max(t, 1e-9)))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("scales", nargs="*", default=["tiny", "small"],
+                        help="scales to be benchmarked: " + ", ".join(SCALES))
+    parser.add_argument("--out", help="path to the results json file "
+                        "(default: benchmarks/<commit>_<time>.json)")
+    parser.add_argument("--compare", help="results json file to compare with")
+    parser.add_argument("--workdir", default="benchmark_data",
+                        help="folder for the synthetic data")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--memory", action="store_true",
+                        help="trace the peak memory allocation of each stage")
+    parser.add_argument("--profile", action="store_true",
+                        help="save a cProfile dump of each stage")
+    parser.add_argument("--check", action="store_true",
+                        help="compare the results of all engines "
+                        "with the legacy implementation")
+    args = parser.parse_args(argv)
+
+    results = {"commit": git_commit(),
+               "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "python": sys.version.split()[0],
+               "platform": platform.platform(),
+               "cpus": os.cpu_count(),
+               "scales": dict()}
+    for scale in args.scales:
+        results["scales"][scale] = run_benchmark(scale, args.workdir, args.seed,
+                                                 args.workers, args.memory,
+                                                 args.profile)
+        if args.check:
+            report = equivalence_heatmap.check_equivalence(
+                os.path.join(args.workdir, scale), DATE_RANGES, FILTER_DATE_RANGES,
+                workers=args.workers)
+            equivalence_heatmap.print_report(report)
+            results["scales"][scale]["equivalence"] = report
+    out_fp = args.out or os.path.join("benchmarks", "{}_{}.json".format(
+        results["commit"] or "nocommit", time.strftime("%Y%m%d-%H%M%S")))
+    if os.path.dirname(out_fp):
+        os.makedirs(os.path.dirname(out_fp), exist_ok=True)
+    with open(out_fp, mode="w", encoding="utf-8") as file:
+        json.dump(results, file, indent=2)
+    print("Saved results to", out_fp)
+    if args.compare:
+        compare_results(args.compare, results)
+
+
+if __name__ == "__main__":
+    main()
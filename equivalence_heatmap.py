@@ -0,0 +1,373 @@
+"""Check that the engines of the text reuse heatmap pipeline
+produce exactly the same results as the legacy pure-Python implementation.
+
+The legacy implementation (calculate_token_reuse_freq, create_plot_lines
+and the date range filter of the first version of
+milestone_text_reuse_heatmap.py) is frozen in this file as the reference.
+Every engine is run on the same folder and compared with it:
+
+1. the count of every token in every milestone of each date range
+2. the lines (segments) of the heatmap of each date range
+3. the lines after filtering out the tokens reused in `filter_date_ranges`
+
+For each engine, the first divergent milestone/token (or line)
+and the speedup compared to the legacy implementation are reported.
+
+Usage:
+
+    python equivalence_heatmap.py folder [--meta metadata.tsv] [--split-dates 300 500 ...]
+    python equivalence_heatmap.py --scale tiny
+
+(see also the --check option of benchmark_heatmap.py)
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+
+import numpy as np
+
+import milestone_text_reuse_heatmap as heatmap
+
+
+##########################################################################
+# Frozen legacy reference: do not modify (except to keep it runnable).  #
+##########################################################################
+
+def legacy_calculate_token_reuse_freq(folder, date_ranges, meta):
+    """Calculate how often an token is reused in milestone json files
+    in `folder` in specific date ranges (legacy implementation)"""
+    ms_count_dicts = [dict() for x in date_ranges]
+
+    for fn in os.listdir(folder):
+        # (only the milestone json files; the legacy version predates
+        # the other json files in the folder, like the pair file manifest)
+        if fn.endswith(".json") and fn.split(".")[0].isdigit():
+            # load json file with data about text reuse in the milestone:
+            # main_ms.json = {comp_id: {comp_ms: {}}}
+            fp = os.path.join(folder, fn)
+            with open(fp, mode="r", encoding="utf-8") as file:
+                data = json.load(file)
+            ms = int(fn.split(".")[0])
+            for comp in data.keys():
+                comp_id = comp.split("-")[0]
+                # select the time range dictionary in which to save the data:
+                ms_count = None
+                for x, r in enumerate(date_ranges):
+                    if r[0] <= int(meta[comp_id]["date"]) < r[1]:
+                        ms_count = ms_count_dicts[x]
+                        break
+                if ms_count == None:
+                    continue  # not in any desired date range!
+                else:
+                    if not ms in ms_count:
+                        ms_count[ms] = [0]*301
+                    for comp_ms in data[comp].keys():
+                        for comp_strt, d in data[comp][comp_ms].items():
+                            for i in range(d["main_bw"], d["main_ew"]):
+                                ms_count[ms][i] += 1
+    return ms_count_dicts
+
+def legacy_create_plot_lines(ms_count_dicts, outfps):
+    """Create list with start and end coordinates + number of reuse cases
+    of each line to be plotted (legacy implementation)"""
+    lines = [[] for i in range(len(ms_count_dicts))]
+
+    for i in range(len(ms_count_dicts)):
+        ms_data = ms_count_dicts[i]
+        json_list = lines[i]
+        outfp = outfps[i]
+        for ms in ms_data:
+            current_line_val = 0
+            current_line_start = 0
+            for i in range(len(ms_data[ms])):
+                v = ms_data[ms][i]
+                if v == current_line_val:
+                    continue
+                else:
+                    if current_line_val:
+                        x = [ms, ms]
+                        y = [current_line_start, i]
+                        json_list.append([x, y, current_line_val])
+                    current_line_val = v
+                    current_line_start = i
+        with open(outfp, mode="w", encoding="utf-8") as file:
+            json.dump(json_list, file, ensure_ascii=False, indent=2)
+    return lines
+
+def legacy_filter_date_ranges(split_data_lines, filter_date_ranges):
+    """Filter out the tokens reused in the date ranges in `filter_date_ranges`
+    from the lines of all later date ranges (legacy implementation)"""
+    for i in filter_date_ranges:
+        # create a dictionary with for every milestone a list of reused token indexes
+        filter_data = dict()
+        for line_data in split_data_lines[i]:
+            ms = line_data[0][0]
+            if not ms in filter_data:
+                filter_data[ms] = []
+            for y in range(line_data[1][0], line_data[1][1]+1):
+                filter_data[ms].append(y)
+        # delete the reused token indexes from all following date ranges:
+        if i < len(split_data_lines):
+            for j in range(i+1, len(split_data_lines)):
+                filtered = []
+                for line_data in split_data_lines[j]:
+                    ms = line_data[0][0]
+                    freq = line_data[2]
+                    if ms not in filter_data:
+                        filtered.append(line_data)
+                    else:
+                        ys = [y for y in range(line_data[1][0], line_data[1][1]+1)]
+                        ys = [y for y in ys if y not in filter_data[ms]]
+                        if ys == []:
+                            continue
+                        else:
+                            start_index = ys[0]
+                            current_index = ys[0]
+                            for y in ys[1:]:
+                                if y == current_index + 1:
+                                    current_index = y
+                                else:
+                                    filtered.append([[ms, ms], [start_index, current_index], freq])
+                                    start_index = y
+                                    current_index = y
+                            filtered.append([[ms, ms], [start_index, current_index], freq])
+                split_data_lines[j] = filtered
+    return split_data_lines
+
+##########################################################################
+
+
+def engines(store_fp=None, workers=None):
+    """Get the engines to be compared with the legacy implementation.
+
+    Each engine is a function (folder, date_ranges) that returns
+    the runs of each date range (see heatmap.calculate_token_reuse_freq()).
+
+    Args:
+        store_fp (str): path to an alignment store of the folder
+            (see heatmap.convert_srt_folder_to_store()); if provided,
+            the store engine is included
+        workers (int): number of workers of the pool engines
+
+    Returns:
+        dict ({engine name: function})
+    """
+    engine_dict = {
+        "serial": lambda folder, drs: heatmap.calculate_token_reuse_freq(
+            folder, drs, workers=1),
+        "process_pool": lambda folder, drs: heatmap.calculate_token_reuse_freq(
+            folder, drs, workers=workers, executor="process", min_pool_files=0),
+        "thread_pool": lambda folder, drs: heatmap.calculate_token_reuse_freq(
+            folder, drs, workers=workers, executor="thread", min_pool_files=0),
+        }
+    if store_fp:
+        engine_dict["store"] = lambda folder, drs: \
+            heatmap.calculate_token_reuse_freq_from_store(store_fp, drs)
+    return engine_dict
+
+def runs_to_counts(ms_runs):
+    """Convert the runs of each milestone ({ms: [[start, end, count], ...]})
+    to a count for every token ({ms: numpy array})."""
+    counts = dict()
+    for ms, runs in ms_runs.items():
+        arr = np.zeros(max([301] + [end for start, end, count in runs]), dtype=np.int64)
+        for start, end, count in runs:
+            arr[start:end] = count
+        counts[int(ms)] = arr
+    return counts
+
+def first_count_divergence(legacy_counts, engine_runs):
+    """Find the first milestone and token for which the counts
+    of an engine differ from the legacy counts.
+
+    Args:
+        legacy_counts (dict): {ms: list of counts for each token}
+        engine_runs (dict): {ms: list of [start, end, count] runs}
+
+    Returns:
+        dict ({"ms": ..., "token": ..., "legacy": ..., "engine": ...})
+        or None if the counts are the same
+    """
+    engine_counts = runs_to_counts(engine_runs)
+    for ms in sorted(set(legacy_counts) | set(engine_counts)):
+        a = np.asarray(legacy_counts.get(ms, []), dtype=np.int64)
+        b = engine_counts.get(ms, np.zeros(0, dtype=np.int64))
+        n = max(len(a), len(b))
+        a = np.pad(a, (0, n - len(a)))
+        b = np.pad(b, (0, n - len(b)))
+        diff = np.flatnonzero(a != b)
+        if len(diff):
+            token = int(diff[0])
+            return {"ms": ms, "token": token,
+                    "legacy": int(a[token]), "engine": int(b[token])}
+    return None
+
+def first_line_divergence(legacy_lines, engine_lines):
+    """Find the first line (in order of milestone and start token)
+    that differs between the legacy lines and the lines of an engine.
+
+    The order of the lines in the lists is not significant
+    (it does not affect the plots).
+
+    Returns:
+        dict ({"index": ..., "legacy": line or None, "engine": line or None})
+        or None if the lines are the same
+    """
+    legacy_lines = sorted(legacy_lines)
+    engine_lines = sorted([list(x), list(y), v] for x, y, v in engine_lines)
+    for i in range(max(len(legacy_lines), len(engine_lines))):
+        a = legacy_lines[i] if i < len(legacy_lines) else None
+        b = engine_lines[i] if i < len(engine_lines) else None
+        if a != b:
+            return {"index": i, "legacy": a, "engine": b}
+    return None
+
+def timed(func, *args, **kwargs):
+    """Call a function and return (its result, the wall time in seconds)."""
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def compare_stage(legacy, engine, first_divergence, date_ranges):
+    """Compare the results of a stage for each date range.
+
+    Returns:
+        dict ({"equal": bool, "first_divergence": None or
+            dict (with the date range added)})
+    """
+    for dr, a, b in zip(date_ranges, legacy, engine):
+        divergence = first_divergence(a, b)
+        if divergence:
+            divergence["date_range"] = list(dr)
+            return {"equal": False, "first_divergence": divergence}
+    return {"equal": True, "first_divergence": None}
+
+def check_equivalence(folder, date_ranges, filter_date_ranges=[],
+                      engine_dict=None, store=True, workers=None):
+    """Run the legacy implementation and every engine on the same folder
+    and compare their results.
+
+    Args:
+        folder (str): path to a folder with milestone json files
+            (see heatmap.extract_milestone_data_from_folder())
+        date_ranges (list): list of tuples (start_date, end_date)
+        filter_date_ranges (list): index numbers of the date ranges
+            to be filtered out from the later date ranges
+        engine_dict (dict): {name: function(folder, date_ranges)};
+            Default: None (see engines())
+        store (bool): if True (and pyarrow is installed), an alignment store
+            of the srt files in the folder is created in a temporary folder
+            (without changing anything in `folder`),
+            and the store engine is compared as well
+        workers (int): number of workers of the pool engines
+
+    Returns:
+        dict ({engine name: {stage: {"equal": ..., "first_divergence": ...,
+            "legacy_s": ..., "engine_s": ..., "speedup": ...}}})
+    """
+    tmp = tempfile.mkdtemp(prefix="heatmap_equivalence_")
+    try:
+        if engine_dict is None:
+            store_fp = None
+            if store and heatmap.pa is not None:
+                store_fp = heatmap.convert_srt_folder_to_store(
+                    folder, store_fp=os.path.join(tmp, "store"),
+                    update_manifest=False)
+            engine_dict = engines(store_fp, workers)
+
+        outfps = [os.path.join(tmp, "lines_{}_{}.plotjson".format(*dr))
+                  for dr in date_ranges]
+        legacy = dict()
+        legacy["counts"], legacy_t = timed(legacy_calculate_token_reuse_freq,
+                                           folder, date_ranges, heatmap.meta)
+        legacy["lines"], t = timed(legacy_create_plot_lines, legacy["counts"],
+                                   outfps)
+        legacy_times = {"counts": legacy_t, "lines": t}
+        legacy["filtered"], legacy_times["filtered"] = timed(
+            legacy_filter_date_ranges, [list(lines) for lines in legacy["lines"]],
+            filter_date_ranges)
+
+        report = dict()
+        for name, engine in engine_dict.items():
+            result = dict()
+            times = dict()
+            result["counts"], times["counts"] = timed(engine, folder, date_ranges)
+            result["lines"], times["lines"] = timed(heatmap.create_plot_lines,
+                                                    result["counts"], outfps)
+            result["filtered"], times["filtered"] = timed(
+                heatmap.filter_date_range_lines,
+                [list(lines) for lines in result["lines"]], filter_date_ranges)
+            report[name] = dict()
+            for stage in ["counts", "lines", "filtered"]:
+                first_divergence = first_count_divergence if stage == "counts" \
+                                   else first_line_divergence
+                r = compare_stage(legacy[stage], result[stage], first_divergence,
+                                  date_ranges)
+                r["legacy_s"] = round(legacy_times[stage], 6)
+                r["engine_s"] = round(times[stage], 6)
+                r["speedup"] = round(legacy_times[stage] / max(times[stage], 1e-9), 2)
+                report[name][stage] = r
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return report
+
+def print_report(report):
+    """Print the result of check_equivalence() and return True
+    if all engines match the legacy implementation."""
+    all_equal = True
+    for name, stages in report.items():
+        print(name)
+        for stage, r in stages.items():
+            print("  {:10} {:9} {:8.3f} s -> {:8.3f} s  ({:.2f}x)".format(
+                stage, "OK" if r["equal"] else "DIVERGES",
+                r["legacy_s"], r["engine_s"], r["speedup"]))
+            if not r["equal"]:
+                all_equal = False
+                print("    first divergence:", json.dumps(r["first_divergence"]))
+    return all_equal
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("folder", nargs="?",
+                        help="folder with srt and milestone json files")
+    parser.add_argument("--meta", help="path to the metadata file")
+    parser.add_argument("--scale", help="check synthetic data of this scale "
+                        "(see benchmark_heatmap.SCALES) instead of a folder")
+    parser.add_argument("--split-dates", type=int, nargs="*", default=[500, 1000])
+    parser.add_argument("--filter", type=int, nargs="*", default=[0],
+                        help="index numbers of the date ranges to be filtered out")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--no-store", action="store_true",
+                        help="do not compare the alignment store engine")
+    parser.add_argument("--out", help="path to a json file for the report")
+    args = parser.parse_args(argv)
+
+    if args.scale:
+        import benchmark_heatmap
+        folder = os.path.join("benchmark_data", args.scale)
+        meta_fp = benchmark_heatmap.generate_synthetic_folder(
+            folder, **benchmark_heatmap.SCALES[args.scale])
+        heatmap.meta.update(heatmap.load_metadata(meta_fp))
+        heatmap.extract_milestone_data_from_folder(folder)
+    elif args.folder:
+        folder = args.folder
+        heatmap.meta.update(heatmap.load_metadata(args.meta) if args.meta
+                            else heatmap.load_metadata())
+    else:
+        parser.error("provide a folder or a --scale")
+    date_ranges = heatmap.split_dates_to_date_ranges(args.split_dates)
+    report = check_equivalence(folder, date_ranges, args.filter,
+                               store=not args.no_store, workers=args.workers)
+    if args.out:
+        with open(args.out, mode="w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+    sys.exit(0 if print_report(report) else 1)
+
+
+if __name__ == "__main__":
+    main()
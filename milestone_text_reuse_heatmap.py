@@ -12,12 +12,44 @@ and put them in a folder with the full URI of the text as folder name
 2. extract_milestone_data_from_file(): extract for each milestone
 the text reuse data from all srt files
 and save that data for each milestone in a separate json file
+(alternatively: convert_srt_folder_to_store(): convert all srt files
+into a parquet alignment store, which is much faster to query
+for specific date ranges; requires pyarrow)
 3. create the heatmap using those json files:
 * ms_data_heatmap(): all text reuse in a single graph
 * ms_data_heatmap_split(): 2 graphs: text reuse in texts
 before and after `split_date`
+* date_slider_heatmap(): a single interactive html graph in which the
+date range can be chosen with a slider
+* serve_heatmap(): serve the heatmap from a local web server,
+which loads only the visible part of the heatmap and shows
+the alignments of a milestone on double click
+* export_tile_pyramid(): export the heatmap as a pyramid of image tiles
+with a static viewer, for the longest texts
+* alignment_dot_plot(): density plot of the milestones of the main text
+against the milestones of the reusing text(s)
+* ms_date_heatmap(): reuse of each milestone against the death year
+of the author of the reusing text, on a continuous date axis
+* diff_heatmap(): difference in reuse between two passim runs
+* top_reused_passages(): the most reused passages of the text
+and the texts that reuse them most (also from the command line:
+`python milestone_text_reuse_heatmap.py top-passages <folder>`)
+4. build_reuse_network(): the number of aligned tokens of every pair
+of texts in the srt files of one or more folders
+(save_reuse_network_csv(), save_reuse_network_graphml(),
+plot_reuse_network())
+5. sharded_heatmap_data(): calculate the heatmap data of many text folders
+(e.g., the whole corpus) in shards, with any number of worker processes
+on one or more machines that share the folders
+(also from the command line, on each machine:
+`python milestone_text_reuse_heatmap.py shard-worker <folder> ... --shards 8`);
+the merged data is then used by the heatmap functions of step 3
 
 
+To measure the time, memory use and throughput of each stage,
+call enable_instrumentation() before running the pipeline
+and instrumentation_report() afterwards.
+
 Useful colormaps (often it is useful not to have colormaps that start with white):
 * Reds
 * autumn_r
@@ -26,30 +58,776 @@ Useful colormaps (often it is useful not to have colormaps that start with white
 """
 
 import os
-
+import sys
 import re
 import csv
 from collections import defaultdict
 import json
+import hashlib
+import zlib
+import socket
 import requests
 import gzip
+import itertools
+import shutil
+import stat
+import tempfile
+import functools
+import argparse
+import traceback
+import cProfile
+import tracemalloc
+import webbrowser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler, SimpleHTTPRequestHandler
+from urllib.parse import unquote
+import xml.etree.ElementTree as ET
+from contextlib import contextmanager, ExitStack
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 
+import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib
 
 import time
 
 from bokeh.plotting import figure, output_file, show, save, ColumnDataSource
-from bokeh.palettes import inferno
-from bokeh.layouts import column, grid
+from bokeh.palettes import inferno, Category10, RdBu
+from bokeh.layouts import column, grid, gridplot
 from bokeh.models import Div, Title, ColorBar, LinearColorMapper, HoverTool, WheelZoomTool
+from bokeh.models import MultiSelect, Button, RangeSlider, CheckboxGroup, RangeTool, Range1d
+from bokeh.models import LogColorMapper, FixedTicker
 from bokeh.embed import file_html
+from bokeh.resources import Resources
+from bokeh.util.paths import bokehjsdir
 from bokeh.events import DoubleTap
 from bokeh.models.callbacks import CustomJS
 
 
 from tqdm import tqdm
 
+# pyarrow is only needed for the columnar alignment store:
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+# zstandard is only needed for the fast-read cache of gzipped srt files:
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+# resource (not available on Windows) is used to measure the memory use
+# of the process (see stage()):
+try:
+    import resource
+except ImportError:
+    resource = None
+# fcntl (not available on Windows) is used to lock shared files
+# (see file_lock()):
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+# orjson (optional) is used to load milestone json files faster:
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# name of the folder (inside a text folder) that contains the alignment store:
+STORE_FOLDER = "alignment_store"
+# name of the file (inside a text folder) that contains information
+# about the srt files from which the milestone json files were extracted:
+MANIFEST_FN = "_pair_files.json"
+# name of the folder (inside a text folder) that contains
+# the recompressed copies of gzipped srt files:
+SRT_CACHE_FOLDER = "_srt_cache"
+# name of the folder (inside a text folder) that contains the partial
+# results of the sharded mode (see shard_worker()):
+SHARD_FOLDER = "_shards"
+# minimum number of milestone files for which calculate_token_reuse_freq()
+# starts a worker pool (for fewer files, starting the workers
+# takes longer than reading the files in the current process):
+MIN_POOL_FILES = 100
+
+# per-stage instrumentation of the pipeline (see stage() and
+# enable_instrumentation()); disabled by default, so that it costs nothing
+# in normal runs:
+INSTRUMENTATION = {"enabled": False, "memory": False, "profile_folder": None,
+                   "records": [], "stack": []}
+
+def enable_instrumentation(memory=False, profile_folder=None):
+    """Start recording the wall time, CPU time, memory use
+    and throughput of every stage of the pipeline (see stage()).
+
+    Args:
+        memory (bool): if True, also trace the peak Python memory allocation
+            of each stage with tracemalloc (this slows down the stages)
+        profile_folder (str): if provided, a cProfile dump
+            (<number>_<stage>.prof) of each stage is saved in this folder;
+            the dump of a stage does not include its nested stages
+            (which have their own dump)
+    """
+    INSTRUMENTATION.update(enabled=True, memory=memory,
+                           profile_folder=profile_folder, records=[], stack=[])
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    if profile_folder:
+        os.makedirs(profile_folder, exist_ok=True)
+
+def disable_instrumentation():
+    """Stop recording the stages of the pipeline
+    and return the records (see instrumentation_report())."""
+    if INSTRUMENTATION["memory"] and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    INSTRUMENTATION["enabled"] = False
+    return INSTRUMENTATION["records"]
+
+def instrumentation_report(fp=None):
+    """Get the records of all stages that ran
+    since enable_instrumentation() was called.
+
+    Args:
+        fp (str): if provided, the records are also saved
+            to this path as a json file
+
+    Returns:
+        list (of dictionaries, one for each stage, in the order
+            in which the stages finished: {"stage": name,
+            "depth": nesting level, "wall_s": wall time,
+            "cpu_s": CPU time (including finished worker processes),
+            "peak_traced_mb": peak Python memory allocation (or None),
+            "max_rss_mb": maximum resident set size of the process so far
+            (or None), "items": {unit: number of items processed},
+            "throughput": {unit: items per second}})
+    """
+    records = INSTRUMENTATION["records"]
+    if fp:
+        with open(fp, mode="w", encoding="utf-8") as file:
+            json.dump(records, file, ensure_ascii=False, indent=2)
+    return records
+
+def cpu_time():
+    """CPU time of the current process and its finished child processes."""
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+def max_rss_mb():
+    """Maximum resident set size of the process (None if unknown)."""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, in kilobytes elsewhere:
+    return round(rss / 1024**2 if sys.platform == "darwin" else rss / 1024, 3)
+
+@contextmanager
+def stage(name):
+    """Record the wall time, CPU time, memory use and throughput
+    of a stage of the pipeline, if instrumentation is enabled
+    (see enable_instrumentation()).
+
+    The context manager yields a dictionary in which the stage
+    can count the items it processed (e.g., `items["rows"] = n`);
+    see also count_items(). Stages can be nested.
+
+    Usage:
+
+        with stage("create_plot_lines") as items:
+            ...
+            items["lines"] = len(lines)
+    """
+    if not INSTRUMENTATION["enabled"]:
+        yield dict()
+        return
+    stack = INSTRUMENTATION["stack"]
+    parent = stack[-1] if stack else None
+    record = {"stage": name, "depth": len(stack), "items": dict(), "_peak": 0}
+    tracing = INSTRUMENTATION["memory"] and tracemalloc.is_tracing()
+    if tracing:
+        # keep the peak of the enclosing stage before resetting it:
+        current, peak = tracemalloc.get_traced_memory()
+        if parent:
+            parent["_peak"] = max(parent["_peak"], peak)
+        if hasattr(tracemalloc, "reset_peak"):  # Python 3.9+
+            tracemalloc.reset_peak()
+        start_mem = current
+    profiler = None
+    if INSTRUMENTATION["profile_folder"]:
+        if parent and parent.get("_profiler"):
+            parent["_profiler"].disable()
+        profiler = record["_profiler"] = cProfile.Profile()
+        profiler.enable()
+    stack.append(record)
+    start_cpu = cpu_time()
+    start = time.perf_counter()
+    try:
+        yield record["items"]
+    finally:
+        wall = time.perf_counter() - start
+        cpu = cpu_time() - start_cpu
+        stack.pop()
+        if profiler:
+            profiler.disable()
+            fn = "{:03d}_{}.prof".format(len(INSTRUMENTATION["records"]), name)
+            profiler.dump_stats(os.path.join(INSTRUMENTATION["profile_folder"], fn))
+            if parent and parent.get("_profiler"):
+                parent["_profiler"].enable()
+        peak = None
+        if tracing:
+            peak = max(record["_peak"], tracemalloc.get_traced_memory()[1])
+            if parent:
+                parent["_peak"] = max(parent["_peak"], peak)
+            peak = round((peak - start_mem) / 1024**2, 3)
+        items = record["items"]
+        INSTRUMENTATION["records"].append({
+            "stage": name, "depth": record["depth"],
+            "wall_s": round(wall, 6), "cpu_s": round(cpu, 6),
+            "peak_traced_mb": peak, "max_rss_mb": max_rss_mb(),
+            "items": items,
+            "throughput": {unit: round(n / wall, 1) if wall else None
+                           for unit, n in items.items()}})
+
+def count_items(**items):
+    """Add to the number of items processed by the current stage
+    (e.g., `count_items(rows=n)`; no-op if instrumentation is disabled)."""
+    if not INSTRUMENTATION["enabled"] or not INSTRUMENTATION["stack"]:
+        return
+    counts = INSTRUMENTATION["stack"][-1]["items"]
+    for unit, n in items.items():
+        counts[unit] = counts.get(unit, 0) + n
+
+def instrumented(name=None):
+    """Decorator that runs a function as a stage of the pipeline
+    (see stage()); the function can count its items with count_items()."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not INSTRUMENTATION["enabled"]:
+                return func(*args, **kwargs)
+            with stage(name or func.__name__):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# files in a text folder may be written by several processes at the same
+# time (e.g., batch workers sharing a folder): every file is written
+# to a temporary file first and then renamed (see atomic_write()),
+# and calculations whose results are saved in the folder hold a lock
+# on the result file (see file_lock()), so that other processes wait
+# and reuse the result instead of calculating it again.
+
+@contextmanager
+def atomic_write(fp, mode="w", encoding="utf-8", newline=None):
+    """Open a temporary file in the folder of `fp` for writing,
+    and rename it to `fp` when the block finishes without errors,
+    so that other processes never read a partially written file.
+
+    The file keeps the permissions of the file it replaces;
+    new files are readable by everyone and writable by the owner (0644).
+
+    Usage:
+
+        with atomic_write(fp) as file:
+            json.dump(data, file)
+    """
+    folder, fn = os.path.split(os.path.abspath(fp))
+    fd, tmp_fp = tempfile.mkstemp(prefix="."+fn+".", suffix=".tmp", dir=folder)
+    try:
+        # (temporary files are created with 0600)
+        try:
+            os.chmod(tmp_fp, stat.S_IMODE(os.stat(fp).st_mode))
+        except FileNotFoundError:
+            os.chmod(tmp_fp, 0o644)
+        if "b" in mode:
+            file = os.fdopen(fd, mode)
+        else:
+            file = os.fdopen(fd, mode, encoding=encoding, newline=newline)
+        with file:
+            yield file
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_fp, fp)
+    except BaseException:
+        if os.path.exists(tmp_fp):
+            os.remove(tmp_fp)
+        raise
+
+def process_is_running(pid):
+    """Check whether a process with this id is running on this machine."""
+    if os.name == "nt":
+        # (os.kill() would terminate the process on Windows)
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(0x1000, False, pid)  # PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            return kernel32.GetLastError() == 5  # access denied: the process exists
+        exit_code = ctypes.c_ulong()
+        kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code))
+        kernel32.CloseHandle(handle)
+        return exit_code.value == 259  # STILL_ACTIVE
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def remove_stale_lock(lock_fp, guard_timeout=60):
+    """Remove a lock file (see file_lock()) that was left behind
+    by a process on this machine that is no longer running.
+
+    Only one process at a time can remove a stale lock (it holds
+    the guard file `<lock_fp>.break` while doing so), and it checks again
+    that the lock file still belongs to the dead process before removing it,
+    so that a new lock created by another process in the meantime
+    is never removed. A guard file older than `guard_timeout` seconds
+    (left behind by a process that died while removing a stale lock)
+    is removed.
+
+    Returns:
+        bool (True if the lock file was removed)
+    """
+    try:
+        with open(lock_fp, mode="r", encoding="utf-8") as file:
+            owner = file.read()
+        pid, host, created = owner.split(" ", 2)
+        pid = int(pid)
+    except (OSError, ValueError):
+        return False  # removed in the meantime, or the owner is still writing it
+    if host != socket.gethostname() or pid == os.getpid() or process_is_running(pid):
+        return False
+    guard_fp = lock_fp + ".break"
+    try:
+        guard = os.open(guard_fp, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        try:
+            if time.time() - os.path.getmtime(guard_fp) > guard_timeout:
+                os.remove(guard_fp)
+        except OSError:
+            pass
+        return False
+    try:
+        with open(lock_fp, mode="r", encoding="utf-8") as file:
+            if file.read() != owner:
+                return False  # a new lock of another process
+        os.remove(lock_fp)
+    except FileNotFoundError:
+        return False
+    finally:
+        os.close(guard)
+        os.remove(guard_fp)
+    print("Removed stale lock {} of process {} (locked at {})".format(
+        lock_fp, pid, created))
+    return True
+
+@contextmanager
+def file_lock(fp, timeout=None, poll_interval=0.2):
+    """Hold an exclusive lock on the lock file `<fp>.lock` (between
+    processes and between threads).
+
+    With fcntl (Linux, macOS), the lock is released by the operating system
+    if the process dies, and the (empty) lock file is left in place;
+    elsewhere, the lock file itself is the lock, and it is removed
+    when the lock is released. It contains the process id, the machine
+    and the time at which it was locked; the lock file of a process
+    that died is removed by the next process on the same machine
+    that tries to lock the file (see remove_stale_lock()).
+    Lock files of processes that died on another machine
+    must be removed by hand.
+
+    Args:
+        fp (str): path of the file (or folder) to be locked
+        timeout (float): maximum number of seconds to wait for the lock
+            (TimeoutError). Default: None (wait as long as necessary)
+        poll_interval (float): number of seconds between attempts
+
+    Yields:
+        bool (True if another process held the lock, so that the caller
+            should check whether that process has already created
+            the locked file)
+    """
+    lock_fp = fp + ".lock"
+    start = time.monotonic()
+    waited = False
+    def wait():
+        if timeout is not None and time.monotonic() - start > timeout:
+            raise TimeoutError("could not lock {}".format(fp))
+        time.sleep(poll_interval)
+    if fcntl is not None:
+        with open(lock_fp, mode="a") as file:
+            while True:
+                try:
+                    fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except OSError:
+                    waited = True
+                    wait()
+            try:
+                yield waited
+            finally:
+                fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+        return
+    while True:
+        try:
+            fd = os.open(lock_fp, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            if remove_stale_lock(lock_fp):
+                continue
+            waited = True
+            wait()
+    try:
+        os.write(fd, "{} {} {}".format(os.getpid(), socket.gethostname(),
+                                       time.strftime("%Y-%m-%d %H:%M:%S")).encode("utf-8"))
+        yield waited
+    finally:
+        os.close(fd)
+        os.remove(lock_fp)
+
+# javascript functions used by the interactive Bokeh plots
+# to recalculate the lines of the heatmap in the browser
+# (see build_group_runs(), plot_with_bokeh() and date_slider_heatmap()):
+RUNS_JS_FUNCTIONS = """
+// sum the runs [ms, start, end, count] of the selected rows
+// with a sweep line; returns the resulting lines as intervals
+// [a, b) of tokens (b = end of the line + 1, as in ms_data_heatmap's filter)
+function sum_runs(d, selected, W) {
+    // pack the key (ms*W + token) and index of each event into one number,
+    // so that the events can be sorted with a fast numeric sort:
+    const SHIFT = 67108864;  // 2**26
+    const packed = new Float64Array(2*d.ms.length);
+    const deltas = new Int32Array(2*d.ms.length);
+    let n = 0;
+    for (let i = 0; i < d.ms.length; i++) {
+        if (!selected(i)) continue;
+        packed[n] = (d.ms[i]*W + d.start[i])*SHIFT + n;
+        deltas[n] = d.count[i];
+        n++;
+        packed[n] = (d.ms[i]*W + d.end[i])*SHIFT + n;
+        deltas[n] = -d.count[i];
+        n++;
+    }
+    const events = packed.subarray(0, n).sort();
+    const out = {ms: [], a: [], b: [], c: []};
+    let count = 0;
+    let prev = 0;
+    let k = 0;
+    while (k < n) {
+        const key = Math.floor(events[k] / SHIFT);
+        let delta = 0;
+        while (k < n && Math.floor(events[k] / SHIFT) === key) {
+            delta += deltas[events[k] % SHIFT];
+            k++;
+        }
+        if (delta === 0) continue;
+        if (count > 0) {
+            const ms = Math.floor(prev / W);
+            out.ms.push(ms);
+            out.a.push(prev - ms*W);
+            out.b.push(key - ms*W + 1);
+            out.c.push(count);
+        }
+        count += delta;
+        prev = key;
+    }
+    return out;
+}
+
+// remove the tokens covered by the intervals in f from the intervals in t
+// (both sorted by milestone and start token, as returned by sum_runs)
+function subtract_intervals(t, f, W) {
+    // merge the overlapping intervals in f:
+    const fs = [];
+    const fe = [];
+    for (let i = 0; i < f.ms.length; i++) {
+        const s = f.ms[i]*W + f.a[i];
+        const e = f.ms[i]*W + f.b[i];
+        if (fs.length && s <= fe[fe.length-1]) {
+            fe[fe.length-1] = Math.max(fe[fe.length-1], e);
+        } else {
+            fs.push(s);
+            fe.push(e);
+        }
+    }
+    const out = {ms: [], a: [], b: [], c: []};
+    for (let i = 0; i < t.ms.length; i++) {
+        const base = t.ms[i]*W;
+        let s = base + t.a[i];
+        const e = base + t.b[i];
+        const push = function (start, end) {
+            out.ms.push(t.ms[i]);
+            out.a.push(start - base);
+            out.b.push(end - base);
+            out.c.push(t.c[i]);
+        };
+        // first filter interval that ends after s:
+        let lo = 0;
+        let hi = fe.length;
+        while (lo < hi) {
+            const mid = (lo + hi) >> 1;
+            if (fe[mid] <= s) lo = mid + 1; else hi = mid;
+        }
+        for (let k = lo; k < fs.length && fs[k] < e; k++) {
+            if (fs[k] > s) push(s, fs[k]);
+            s = Math.max(s, fe[k]);
+        }
+        if (s < e) push(s, e);
+    }
+    return out;
+}
+
+// filter the lines of earlier date ranges out of later date ranges
+// and put the lines in the plot data sources
+function update_sources(lines, sources, filter_ranges, W) {
+    for (const i of filter_ranges) {
+        for (let j = i + 1; j < lines.length; j++) {
+            lines[j] = subtract_intervals(lines[j], lines[i], W);
+        }
+    }
+    for (let r = 0; r < lines.length; r++) {
+        if (sources[r] === null) continue;
+        const l = lines[r];
+        sources[r].data = {x0: l.ms, x1: l.ms, y0: l.a, y1: l.b.map(b => b - 1),
+                           val: l.c};
+    }
+}
+"""
+
+# recalculate the heatmap for the texts selected in a MultiSelect widget:
+TEXT_FILTER_JS = RUNS_JS_FUNCTIONS + """
+const selected_texts = new Set(selector.value.map(Number));
+const lines = runs.map(r => sum_runs(r.data, i => selected_texts.has(r.data.group[i]), W));
+update_sources(lines, sources, filter_ranges, W);
+"""
+
+# load the data of the plot's data sources from binary sidecar files
+# (see save_with_sidecar_data()):
+SIDECAR_LOADER_JS = """
+(function () {
+    const manifest = %s;
+    function load() {
+        if (!window.Bokeh || !Bokeh.documents || !Bokeh.documents.length) {
+            setTimeout(load, 50);
+            return;
+        }
+        const doc = Bokeh.documents[0];
+        for (const name in manifest) {
+            const m = manifest[name];
+            fetch(m.url)
+                .then(response => response.arrayBuffer())
+                .then(buf => {
+                    const data = {};
+                    m.columns.forEach((col, k) => {
+                        data[col] = new Int32Array(buf, k*m.n*4, m.n);
+                    });
+                    for (const col in m.aliases) data[col] = data[m.aliases[col]];
+                    doc.get_model_by_name(name).data = data;
+                });
+        }
+    }
+    load();
+})();
+"""
+
+# number of milestone columns in each tile of the heatmap server
+# (see render_tile()):
+TILE_COLUMNS = 256
+
+# load the tiles of the visible part of each panel from the heatmap server
+# at the level of detail that matches the panel's width in pixels
+# (see serve_heatmap()):
+TILE_LOADER_JS = """
+function heatmap_load_tiles(doc, i) {
+    const plot = doc.get_model_by_name("panel_" + i);
+    const source = doc.get_model_by_name("lines_" + i);
+    const x0 = Math.max(0, plot.x_range.start);
+    const x1 = Math.max(x0 + 1, plot.x_range.end);
+    const px = Math.max(100, plot.inner_width || 800);
+    // level l: every column represents 2**l milestones:
+    const level = Math.max(0, Math.ceil(Math.log2((x1 - x0) / px)));
+    const span = %d * 2**level;
+    const urls = [];
+    for (let t = Math.floor(x0 / span); t*span < x1; t++) {
+        urls.push("/tiles/" + i + "/" + level + "/" + t);
+    }
+    const request = (source._tile_request || 0) + 1;
+    source._tile_request = request;
+    Promise.all(urls.map(url => fetch(url).then(response => response.arrayBuffer())))
+        .then(bufs => {
+            if (source._tile_request !== request) return;  // outdated
+            let n = 0;
+            for (const buf of bufs) n += buf.byteLength / 16;
+            const cols = [0, 1, 2, 3].map(k => new Int32Array(n));
+            let offset = 0;
+            for (const buf of bufs) {
+                const m = buf.byteLength / 16;
+                for (let k = 0; k < 4; k++) {
+                    cols[k].set(new Int32Array(buf, k*m*4, m), offset);
+                }
+                offset += m;
+            }
+            source.data = {x0: cols[0], x1: cols[0], y0: cols[1], y1: cols[2], val: cols[3]};
+        });
+}
+
+function heatmap_show_alignments(div, i, ms) {
+    fetch("/milestone/" + i + "/" + ms)
+        .then(response => response.json())
+        .then(rows => {
+            const esc = s => String(s).replace(/&/g, "&amp;").replace(/</g, "&lt;");
+            let html = "<h3>Milestone " + ms + ": " + rows.length + " alignments</h3>";
+            html += "<table><tr><th>text</th><th>date</th><th>milestone</th>"
+                  + "<th>tokens</th><th>main text</th><th>reusing text</th></tr>";
+            for (const r of rows) {
+                html += "<tr><td>" + esc(r.comp) + "</td><td>" + r.comp_date
+                      + "</td><td>" + r.comp_ms + "</td><td>" + r.main_bw + "-"
+                      + r.main_ew + "</td><td>" + esc(r.main_s || "") + "</td><td>"
+                      + esc(r.comp_s || "") + "</td></tr>";
+            }
+            div.text = html + "</table>";
+        });
+}
+
+(function () {
+    function init() {
+        if (!window.Bokeh || !Bokeh.documents || !Bokeh.documents.length) {
+            setTimeout(init, 50);
+            return;
+        }
+        const doc = Bokeh.documents[0];
+        for (let i = 0; i < %d; i++) heatmap_load_tiles(doc, i);
+    }
+    init();
+})();
+"""
+
+# minimal viewer for a tile pyramid (see export_tile_pyramid()):
+# drag to pan, mouse wheel to zoom (shift+wheel: zoom the tokens axis)
+TILE_VIEWER_HTML = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>%(title)s</title>
+<style>
+body {font-family: sans-serif; margin: 10px;}
+#view {position: relative; overflow: hidden; height: 600px; background: #ddd;
+       cursor: grab; user-select: none;}
+#view img {position: absolute; image-rendering: pixelated; pointer-events: none;}
+</style>
+</head>
+<body>
+<h2>%(title)s</h2>
+<div id="info"></div>
+<div id="view"></div>
+<script>
+const P = %(info)s;
+const view = document.getElementById("view");
+const info = document.getElementById("info");
+let x0 = 0;              // milestone at the left edge of the view
+let ms_per_px = (P.n_ms + 10) / view.clientWidth;
+let y_zoom = 1;          // stretch of the tokens axis
+let y0 = 0;              // token at the bottom edge of the view
+const images = {};
+const tiles = P.tiles.map(names => new Set(names));
+
+function draw() {
+    const W = view.clientWidth;
+    const H = view.clientHeight;
+    const px_per_token = H / P.n_tokens * y_zoom;
+    const level = Math.max(0, Math.min(P.levels - 1, Math.floor(Math.log2(ms_per_px))));
+    const span = P.tile_size * 2**level;  // milestones per tile
+    const tile_w = span / ms_per_px;
+    const tile_h = P.tile_size * px_per_token;
+    const used = new Set();
+    for (let tx = Math.max(0, Math.floor(x0 / span)); tx*span < x0 + W*ms_per_px; tx++) {
+        for (let ty = 0; ty < P.tiles_y; ty++) {
+            const bottom = (ty*P.tile_size - y0) * px_per_token;
+            if (bottom > H || bottom + tile_h < 0) continue;
+            const key = level + "/" + tx + "_" + ty;
+            if (!tiles[level].has(tx + "_" + ty)) continue;  // empty tile
+            let img = images[key];
+            if (!img) {
+                img = document.createElement("img");
+                img.src = key + ".png";
+                images[key] = img;
+                view.appendChild(img);
+            }
+            img.style.left = ((tx*span - x0) / ms_per_px) + "px";
+            img.style.top = (H - bottom - tile_h) + "px";
+            img.style.width = tile_w + "px";
+            img.style.height = tile_h + "px";
+            img.style.display = "block";
+            used.add(key);
+        }
+    }
+    for (const key in images) {
+        if (!used.has(key)) images[key].style.display = "none";
+    }
+    info.textContent = "milestones " + Math.max(0, Math.round(x0)) + "-"
+        + Math.round(x0 + W*ms_per_px) + " (max. value: " + P.max_val
+        + " " + P.value_label + ")";
+}
+
+view.addEventListener("wheel", e => {
+    e.preventDefault();
+    const f = e.deltaY > 0 ? 1.25 : 0.8;
+    const rect = view.getBoundingClientRect();
+    if (e.shiftKey) {
+        const H = view.clientHeight;
+        const t = y0 + (H - (e.clientY - rect.top)) / (H / P.n_tokens * y_zoom);
+        y_zoom = Math.max(1, y_zoom / f);
+        y0 = Math.max(0, t - (H - (e.clientY - rect.top)) / (H / P.n_tokens * y_zoom));
+    } else {
+        const ms = x0 + (e.clientX - rect.left) * ms_per_px;
+        ms_per_px = Math.max(1/16, ms_per_px * f);
+        x0 = ms - (e.clientX - rect.left) * ms_per_px;
+    }
+    draw();
+}, {passive: false});
+let drag = null;
+view.addEventListener("mousedown", e => { drag = [e.clientX, e.clientY, x0, y0]; });
+window.addEventListener("mouseup", () => { drag = null; });
+window.addEventListener("mousemove", e => {
+    if (!drag) return;
+    x0 = drag[2] - (e.clientX - drag[0]) * ms_per_px;
+    const px_per_token = view.clientHeight / P.n_tokens * y_zoom;
+    y0 = Math.max(0, drag[3] + (e.clientY - drag[1]) / px_per_token);
+    draw();
+});
+window.addEventListener("resize", draw);
+draw();
+</script>
+</body>
+</html>
+"""
+
+# recalculate the heatmap for the date bins selected with a RangeSlider:
+DATE_SLIDER_JS = RUNS_JS_FUNCTIONS + """
+const first = Math.round((slider.value[0] - start_date) / bin_size);
+const last = Math.round((slider.value[1] - start_date) / bin_size);
+const d = runs.data;
+const lines = [sum_runs(d, i => d.group[i] >= first && d.group[i] < last, W)];
+if (filter.active.length) {
+    // reuse by authors who died before the selected range:
+    lines.unshift(sum_runs(d, i => d.group[i] < first, W));
+    update_sources(lines, [null, source], [0], W);
+} else {
+    update_sources(lines, [source], [], W);
+}
+let max_val = 1;
+for (const v of source.data.val) if (v > max_val) max_val = v;
+color_mapper.high = max_val + 0.5;
+let text = title_fmt.replace("{}", slider.value[0]).replace("{}", slider.value[1]);
+if (filter.active.length) {
+    text += " (text reuse by authors who died before " + slider.value[0] + " AH filtered out)";
+}
+title.text = text;
+"""
+
 
 def load_metadata(meta_fp="OpenITI_metadata_2021-1-4_merged.txt"):
     with open(meta_fp, mode="r", encoding="utf-8") as file:
@@ -61,43 +839,765 @@ def load_metadata(meta_fp="OpenITI_metadata_2021-1-4_merged.txt"):
     return meta
             
 
-def calculate_token_reuse_freq(folder, date_ranges):
+def coverage_runs(ms, bw, ew, weights=None):
+    """Calculate for each milestone how many alignments cover each token,
+    using a sweep line over the start and end points of the alignments
+    instead of incrementing the count of every covered token.
+
+    The start of each alignment adds 1 to the count, its end subtracts 1;
+    after sorting these events by (milestone, token), the cumulative sum
+    of the events gives the count of the run of tokens between
+    each event and the next one. The cost therefore depends only on the
+    number of alignments, not on their length or on the length
+    of the milestones.
+
+    Args:
+        ms (array): milestone number of each alignment
+        bw (array): start token of each alignment in its milestone
+        ew (array): end token (exclusive) of each alignment
+        weights (array): if provided, each alignment counts for its weight
+            instead of 1 (e.g., to scale up a sample, see preview_heatmap_lines());
+            the weighted counts are rounded to integers
+
+    Returns:
+        dict ({milestone: list of [start, end, count] runs}; each run
+            is a maximal stretch of tokens (end exclusive) covered by
+            the same number of alignments; tokens that are not covered
+            by any alignment are not included)
+    """
+    ms = np.asarray(ms, dtype=np.int64)
+    bw = np.asarray(bw, dtype=np.int64)
+    ew = np.asarray(ew, dtype=np.int64)
+    keep = bw < ew
+    ms, bw, ew = ms[keep], bw[keep], ew[keep]
+    if not len(ms):
+        return dict()
+    # combine milestone and token into a single sortable event key:
+    width = int(ew.max()) + 1
+    keys = np.concatenate([ms*width + bw, ms*width + ew])
+    if weights is None:
+        deltas = np.concatenate([np.ones(len(bw), dtype=np.int64),
+                                 -np.ones(len(ew), dtype=np.int64)])
+    else:
+        weights = np.asarray(weights, dtype=np.float64)[keep]
+        deltas = np.concatenate([weights, -weights])
+    order = np.argsort(keys, kind="stable")
+    keys, deltas = keys[order], deltas[order]
+    keys, first = np.unique(keys, return_index=True)
+    deltas = np.add.reduceat(deltas, first)
+    # events that cancel each other out do not start a new run:
+    keys, deltas = keys[deltas != 0], deltas[deltas != 0]
+    counts = np.cumsum(deltas)[:-1]
+    if weights is not None:
+        # round the weighted counts, and merge neighbouring runs
+        # that get the same count:
+        counts = np.rint(counts).astype(np.int64)
+        change = np.ones(len(counts), dtype=bool)
+        change[1:] = counts[1:] != counts[:-1]
+        keys = np.append(keys[:-1][change], keys[-1])
+        counts = counts[change]
+    # since the count returns to 0 at the end of each milestone,
+    # runs with a positive count never cross a milestone boundary:
+    covered = counts > 0
+    starts = keys[:-1][covered]
+    ends = keys[1:][covered]
+    counts = counts[covered]
+    run_ms = starts // width
+    uniq_ms, first = np.unique(run_ms, return_index=True)
+    runs = np.stack([starts % width, ends - run_ms*width, counts], axis=1).tolist()
+    bounds = list(first) + [len(runs)]
+    return {int(m): runs[bounds[i]:bounds[i+1]] for i, m in enumerate(uniq_ms)}
+
+def union_intervals_per_text(ms, bw, ew, texts):
+    """Merge the overlapping alignments of each text in each milestone,
+    so that every token is covered at most once by each text.
+
+    The coverage of the merged intervals (see coverage_runs())
+    is then the number of distinct texts that reuse each token.
+
+    Args:
+        ms (array): milestone number of each alignment
+        bw (array): start token of each alignment in its milestone
+        ew (array): end token (exclusive) of each alignment
+        texts (array): integer id of the text of each alignment
+
+    Returns:
+        tuple (ms, bw, ew arrays of the merged intervals)
+    """
+    ms = np.asarray(ms, dtype=np.int64)
+    bw = np.asarray(bw, dtype=np.int64)
+    ew = np.asarray(ew, dtype=np.int64)
+    texts = np.asarray(texts, dtype=np.int64)
+    if not len(ms):
+        return ms, bw, ew
+    order = np.lexsort((bw, texts, ms))
+    ms, bw, ew, texts = ms[order], bw[order], ew[order], texts[order]
+    # number the (milestone, text) groups:
+    new_group = np.ones(len(ms), dtype=bool)
+    new_group[1:] = (ms[1:] != ms[:-1]) | (texts[1:] != texts[:-1])
+    group = np.cumsum(new_group) - 1
+    # running maximum of the end tokens within each group
+    # (shifting each group above the previous one avoids a loop):
+    offset = group * (int(ew.max()) + 1)
+    run_max = np.maximum.accumulate(ew + offset) - offset
+    # an alignment starts a new interval if it does not overlap
+    # with the previous alignments of the same text:
+    new_interval = new_group.copy()
+    new_interval[1:] |= bw[1:] > run_max[:-1]
+    idx = np.flatnonzero(new_interval)
+    return ms[idx], bw[idx], np.maximum.reduceat(ew, idx)
+
+SUMMARY_COLUMNS = ["ms", "alignments", "texts", "reused_tokens", "max_value"]
+
+def summarize_milestones(ms, texts, ms_runs):
+    """Summarize the reuse in each milestone: the number of alignments,
+    the number of distinct texts, the number of reused tokens
+    and the highest count of any token.
+
+    Args:
+        ms (array): milestone number of each alignment
+        texts (array): integer id of the text of each alignment
+        ms_runs (dict): runs of reused tokens in each milestone
+            (see coverage_runs())
+
+    Returns:
+        dict (of numpy arrays, see SUMMARY_COLUMNS; only milestones
+            with at least one alignment are included)
+    """
+    ms = np.asarray(ms, dtype=np.int64)
+    texts = np.asarray(texts, dtype=np.int64)
+    n_ms = int(ms.max()) + 1 if len(ms) else 0
+    n_texts = int(texts.max()) + 1 if len(texts) else 1
+    alignments = np.bincount(ms, minlength=n_ms)
+    distinct = np.bincount(np.unique(ms*n_texts + texts) // n_texts, minlength=n_ms)
+    keys = np.repeat(np.array(list(ms_runs.keys()), dtype=np.int64),
+                     [len(r) for r in ms_runs.values()])
+    runs = np.array([run for r in ms_runs.values() for run in r],
+                    dtype=np.int64).reshape(-1, 3)
+    tokens = np.bincount(keys, weights=runs[:, 1] - runs[:, 0], minlength=n_ms)
+    max_value = np.zeros(n_ms, dtype=np.int64)
+    np.maximum.at(max_value, keys, runs[:, 2])
+    used = np.nonzero(alignments)[0]
+    return {"ms": used, "alignments": alignments[used], "texts": distinct[used],
+            "reused_tokens": tokens[used].astype(np.int64),
+            "max_value": max_value[used]}
+
+def merge_summaries(summaries):
+    """Merge the milestone summaries (see summarize_milestones())
+    of different sets of milestones into one, sorted by milestone."""
+    merged = {col: np.concatenate([np.asarray(s[col], dtype=np.int64) for s in summaries])
+              if summaries else np.zeros(0, dtype=np.int64)
+              for col in SUMMARY_COLUMNS}
+    order = np.argsort(merged["ms"], kind="stable")
+    return {col: arr[order] for col, arr in merged.items()}
+
+def save_summary_csv(summary, fp):
+    """Save a milestone summary (see summarize_milestones()) as a csv file."""
+    with atomic_write(fp, newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(SUMMARY_COLUMNS)
+        writer.writerows(np.stack([summary[col] for col in SUMMARY_COLUMNS], axis=1).tolist())
+
+def load_summary_csv(fp):
+    """Load a milestone summary from a csv file (see save_summary_csv())."""
+    with open(fp, mode="r", encoding="utf-8", newline="") as file:
+        rows = list(csv.reader(file))[1:]
+    arr = np.array(rows, dtype=np.int64).reshape(-1, len(SUMMARY_COLUMNS))
+    return {col: arr[:, i] for i, col in enumerate(SUMMARY_COLUMNS)}
+
+def load_ms_json(fp):
+    """Load a milestone json file (with orjson, if it is installed)."""
+    if orjson is not None:
+        with open(fp, mode="rb") as file:
+            return orjson.loads(file.read())
+    with open(fp, mode="r", encoding="utf-8") as file:
+        return json.load(file)
+
+def collect_alignments_from_ms_files(folder, fns, date_ranges, comp_dates,
+                                     min_alignment_length=0, columns=[]):
+    """Collect the main milestone, start and end token and text
+    of all relevant alignments in a number of milestone json files.
+
+    Args:
+        folder (str): path to the folder containing the milestone files
+        fns (list): names of the milestone files to be read
+        date_ranges (list): list of tuples (start_date, end_date)
+        comp_dates (dict): death date of the author of each text
+            that should be included ({text_id: date})
+        min_alignment_length (int): only include alignments that cover
+            at least this number of tokens in the main text.
+        columns (list): names of additional alignment fields to be collected
+            ("comp_ms", "comp_bw", "comp_ew", "comp_date", "main_s", "comp_s")
+
+    Returns:
+        tuple (list of dictionaries of lists (one for each date range):
+                   {"ms": [], "bw": [], "ew": [], "text": [], <column>: []},
+               list of text ids (the "text" lists contain indexes in this list))
+    """
+    alignments = [{key: [] for key in ["ms", "bw", "ew", "text"] + columns}
+                  for x in date_ranges]
+    text_ids = dict()
+    for fn in fns:
+        # load json file with data about text reuse in the milestone:
+        # main_ms.json = {comp_id: {comp_ms: {}}}
+        data = load_ms_json(os.path.join(folder, fn))
+        ms = int(fn.split(".")[0])
+        for comp in data.keys():
+            comp_id = comp.split("-")[0]
+            if comp_id not in comp_dates:
+                continue
+            # select the time range in which to save the data:
+            range_data = None
+            for x, r in enumerate(date_ranges):
+                if r[0] <= comp_dates[comp_id] < r[1]:
+                    range_data = alignments[x]
+                    break
+            if range_data == None:
+                continue  # not in any desired date range!
+            else:
+                text = text_ids.setdefault(comp_id, len(text_ids))
+                for comp_ms in data[comp].keys():
+                    for comp_strt, d in data[comp][comp_ms].items():
+                        if d["main_ew"] - d["main_bw"] < min_alignment_length:
+                            continue
+                        range_data["ms"].append(ms)
+                        range_data["bw"].append(d["main_bw"])
+                        range_data["ew"].append(d["main_ew"])
+                        range_data["text"].append(text)
+                        for col in columns:
+                            if col == "comp_ms":
+                                range_data[col].append(int(comp_ms))
+                            elif col == "comp_date":
+                                range_data[col].append(comp_dates[comp_id])
+                            else:
+                                range_data[col].append(d[col])
+    return alignments, list(text_ids)
+
+def count_token_reuse_in_ms_files(folder, fns, date_ranges, comp_dates,
+                                  min_alignment_length=0, metric="alignments",
+                                  with_summary=False):
+    """Calculate how often each token is reused in a number of
+    milestone json files (one chunk of the work
+    of calculate_token_reuse_freq(), which can be run in a separate process).
+
+    Args:
+        folder (str): path to the folder containing the milestone files
+        fns (list): names of the milestone files to be read
+        date_ranges (list): list of tuples (start_date, end_date)
+        comp_dates (dict): death date of the author of each text
+            that should be included ({text_id: date})
+        min_alignment_length (int): only include alignments that cover
+            at least this number of tokens in the main text.
+        metric (str): "alignments" (count the number of alignments
+            that cover each token) or "texts" (count the number of
+            distinct texts that reuse each token)
+        with_summary (bool): if True, also summarize the reuse
+            in each milestone (see summarize_milestones())
+
+    Returns:
+        list (of dictionaries, one for each date range:
+            {milestone: list of [start, end, count] runs},
+            see coverage_runs()),
+        or, if `with_summary` is True, a tuple (that list,
+            list of milestone summaries for each date range)
+    """
+    alignments, text_ids = collect_alignments_from_ms_files(folder, fns, date_ranges,
+                                                            comp_dates,
+                                                            min_alignment_length)
+    ms_count_dicts = []
+    summaries = []
+    for a in alignments:
+        ms, bw, ew = a["ms"], a["bw"], a["ew"]
+        if metric == "texts":
+            ms, bw, ew = union_intervals_per_text(ms, bw, ew, a["text"])
+        ms_count_dicts.append(coverage_runs(ms, bw, ew))
+        if with_summary:
+            summaries.append(summarize_milestones(a["ms"], a["text"], ms_count_dicts[-1]))
+    if with_summary:
+        return ms_count_dicts, summaries
+    return ms_count_dicts
+
+@instrumented()
+def calculate_token_reuse_freq(folder, date_ranges, status=None,
+                               min_alignment_length=0, workers=None,
+                               executor="process", metric="alignments",
+                               with_summary=False, milestone_range=None,
+                               min_pool_files=MIN_POOL_FILES):
     """Calculate how often an token is reused in milestone json files
-    in `folder` in specific date ranges"""
+    in `folder` in specific date ranges.
+
+    If the folder contains an alignment store
+    (see convert_srt_folder_to_store()), the data is read from the store
+    instead of from the milestone json files.
+
+    Only the milestone files that can contain relevant alignments
+    (according to the pair file manifest, see plan_pair_files())
+    are opened. The milestone files are read in chunks by a pool of
+    worker processes (or threads); since each milestone file
+    is read by only one worker, the partial counts of the workers
+    can simply be merged. The chunks are merged in milestone order,
+    so that the result is the same as that of a single worker.
+
+    Args:
+        folder (str): path to the folder containing the milestone files
+        date_ranges (list): list of tuples (start_date, end_date)
+        status (str or list): only include reuse by texts with this status
+            in the metadata (e.g., "pri"). Default: None (all texts)
+        min_alignment_length (int): only include alignments that cover
+            at least this number of tokens in the main text. Default: 0
+        workers (int): number of workers. Default: None (number of CPUs);
+            use 1 to read all files in the current process.
+        executor (str): "process" or "thread"
+        metric (str): "alignments" (count the number of alignments
+            that cover each token) or "texts" (count the number of
+            distinct texts that reuse each token)
+        with_summary (bool): if True, also summarize the reuse
+            in each milestone (see summarize_milestones())
+        milestone_range (tuple): (first milestone, last milestone (exclusive))
+            of the main text to be included. Default: None (all milestones)
+        min_pool_files (int): read the files in the current process
+            if fewer than this number of milestone files are selected.
+            Default: MIN_POOL_FILES
+
+    Returns:
+        list (of dictionaries, one for each date range:
+            {milestone: list of [start, end, count] runs},
+            see coverage_runs()),
+        or, if `with_summary` is True, a tuple (that list,
+            list of milestone summaries for each date range)
+    """
+    store_fp = os.path.join(folder, STORE_FOLDER)
+    if os.path.exists(store_fp):
+        return calculate_token_reuse_freq_from_store(store_fp, date_ranges,
+                                                     status=status,
+                                                     min_alignment_length=min_alignment_length,
+                                                     metric=metric,
+                                                     with_summary=with_summary,
+                                                     milestone_range=milestone_range)
     print("Calculating reuse frequency of each reused token...")
+    if isinstance(status, str):
+        status = [status]
+    comp_dates = select_comp_dates(status)
+    fns = select_milestone_files(folder, date_ranges, status,
+                                 min_alignment_length, milestone_range)
+    count_items(files=len(fns))
+
     # create dictionaries containing for every token in reused milestones
     # the number of times it figures in an alignment:
-
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(fns) < min_pool_files:
+        return count_token_reuse_in_ms_files(folder, fns, date_ranges,
+                                             comp_dates, min_alignment_length,
+                                             metric, with_summary)
     ms_count_dicts = [dict() for x in date_ranges]
-
-    #for fn in tqdm(os.listdir(folder)):
-    for fn in os.listdir(folder):
-        if fn.endswith(".json"):
-            # load json file with data about text reuse in the milestone:
-            # main_ms.json = {comp_id: {comp_ms: {}}}
-            fp = os.path.join(folder, fn)
-            with open(fp, mode="r", encoding="utf-8") as file:
-                data = json.load(file)
-            ms = int(fn.split(".")[0])
-            for comp in data.keys():
-                comp_id = comp.split("-")[0]
-                # select the time range dictionary in which to save the data:
-                ms_count = None
-                for x, r in enumerate(date_ranges):
-                    if r[0] <= int(meta[comp_id]["date"]) < r[1]:
-                        ms_count = ms_count_dicts[x]
-                        break
-                if ms_count == None:
-                    continue  # not in any desired date range!
-                else:
-                    if not ms in ms_count:
-                        ms_count[ms] = [0]*301
-                    for comp_ms in data[comp].keys():
-                        for comp_strt, d in data[comp][comp_ms].items():
-                            for i in range(d["main_bw"], d["main_ew"]):
-                                ms_count[ms][i] += 1
+    summaries = [[] for x in date_ranges]
+    chunk_size = -(-len(fns) // (workers*4))
+    chunks = [fns[i:i+chunk_size] for i in range(0, len(fns), chunk_size)]
+    pool_class = ProcessPoolExecutor if executor == "process" else ThreadPoolExecutor
+    with pool_class(workers) as pool:
+        n = len(chunks)
+        results = pool.map(count_token_reuse_in_ms_files, [folder]*n, chunks,
+                           [date_ranges]*n, [comp_dates]*n,
+                           [min_alignment_length]*n, [metric]*n, [with_summary]*n)
+        for result in tqdm(results, total=n):
+            if with_summary:
+                result, chunk_summaries = result
+                for x, summary in enumerate(chunk_summaries):
+                    summaries[x].append(summary)
+            for x, ms_count in enumerate(result):
+                ms_count_dicts[x].update(ms_count)
+    if with_summary:
+        return ms_count_dicts, [merge_summaries(s) for s in summaries]
     return ms_count_dicts
 
+def build_contributor_index(ms, bw, ew, texts, text_ids):
+    """Build an inverted index that maps every stretch of tokens
+    in the main text to the texts that reuse it.
+
+    The tokens of each milestone are divided into elementary intervals
+    by the start and end points of all alignments, so that every alignment
+    covers a contiguous series of intervals. The index is stored
+    in compressed sparse row (CSR) form: the texts that reuse the tokens
+    of interval i are texts[indptr[i]:indptr[i+1]], and the number of
+    their alignments that cover the interval is in
+    counts[indptr[i]:indptr[i+1]].
+
+    Args:
+        ms (array): milestone number of each alignment
+        bw (array): start token of each alignment in its milestone
+        ew (array): end token (exclusive) of each alignment
+        texts (array): index (in `text_ids`) of the text of each alignment
+        text_ids (list): ids of the texts
+
+    Returns:
+        dict ({"ms", "start", "end": milestone, start and end token
+                   of each (covered) elementary interval, sorted,
+               "indptr", "texts", "counts": see above,
+               "text_ids": list of text ids})
+    """
+    ms = np.asarray(ms, dtype=np.int64)
+    bw = np.asarray(bw, dtype=np.int64)
+    ew = np.asarray(ew, dtype=np.int64)
+    texts = np.asarray(texts, dtype=np.int64)
+    keep = bw < ew
+    ms, bw, ew, texts = ms[keep], bw[keep], ew[keep], texts[keep]
+    width = int(ew.max()) + 1 if len(ew) else 1
+    start_keys = ms*width + bw
+    end_keys = ms*width + ew
+    bounds = np.unique(np.concatenate([start_keys, end_keys]))
+    # each alignment covers the intervals first ... last-1:
+    first = np.searchsorted(bounds, start_keys)
+    n_intervals = np.searchsorted(bounds, end_keys) - first
+    # expand each alignment into the intervals it covers:
+    offsets = np.arange(n_intervals.sum()) - np.repeat(np.cumsum(n_intervals) - n_intervals,
+                                                       n_intervals)
+    interval = np.repeat(first, n_intervals) + offsets
+    n_texts = max(len(text_ids), 1)
+    pairs, counts = np.unique(interval*n_texts + np.repeat(texts, n_intervals),
+                              return_counts=True)
+    interval = pairs // n_texts
+    covered, n_entries = np.unique(interval, return_counts=True)
+    interval_start = bounds[covered]
+    interval_ms = interval_start // width
+    return {"ms": interval_ms,
+            "start": interval_start - interval_ms*width,
+            "end": bounds[covered+1] - interval_ms*width,
+            "indptr": np.concatenate([[0], np.cumsum(n_entries)]),
+            "texts": pairs % n_texts,
+            "counts": counts,
+            "text_ids": list(text_ids)}
+
+@instrumented()
+def build_contributor_indexes(folder, date_ranges, status=None,
+                              min_alignment_length=0, milestone_range=None):
+    """Build a contributor index (see build_contributor_index())
+    for each date range, reading the alignments only once.
+
+    Returns:
+        list (of contributor indexes, one for each date range)
+    """
+    print("Building index of the texts that reuse each token...")
+    alignments, text_ids = load_alignments(folder, date_ranges, status=status,
+                                           min_alignment_length=min_alignment_length,
+                                           milestone_range=milestone_range)
+    return [build_contributor_index(a["ms"], a["bw"], a["ew"], a["text"], text_ids)
+            for a in alignments]
+
+def save_contributor_index(index, fp):
+    """Save a contributor index to a (compressed) .npz file."""
+    arrays = {key: val for key, val in index.items() if key != "text_ids"}
+    with atomic_write(fp, mode="wb") as file:
+        np.savez_compressed(file, text_ids=np.array(index["text_ids"], dtype=str), **arrays)
+
+def load_contributor_index(fp):
+    """Load a contributor index from an .npz file."""
+    with np.load(fp) as data:
+        index = {key: data[key] for key in data.files}
+    index["text_ids"] = index["text_ids"].tolist()
+    return index
+
+def describe_text(text_id):
+    """Create a short description of a text from the metadata
+    ("author (death date): book")."""
+    if text_id not in meta:
+        return text_id
+    return "{} ({}): {}".format(meta[text_id]["author"], meta[text_id]["date"],
+                                meta[text_id]["book"])
+
+def top_contributors(index, ms_start, ms_end=None, token_start=0,
+                     token_end=None, n=10):
+    """Find the texts that reuse most tokens in a passage of the main text.
+
+    Args:
+        index (dict): contributor index (see build_contributor_index())
+        ms_start (int): first milestone of the passage
+        ms_end (int): last milestone of the passage (inclusive).
+            Default: None (same as ms_start)
+        token_start (int): first token of the passage in ms_start
+        token_end (int): end token (exclusive) of the passage in ms_end.
+            Default: None (end of the milestone)
+        n (int): number of texts to be returned
+
+    Returns:
+        list (of dictionaries {"text": text id, "tokens": number of tokens
+            of the passage covered by alignments with the text
+            (summed over all alignments), "description": see describe_text()},
+            sorted by number of tokens)
+    """
+    if ms_end is None:
+        ms_end = ms_start
+    lo = np.searchsorted(index["ms"], ms_start, side="left")
+    hi = np.searchsorted(index["ms"], ms_end, side="right")
+    starts = index["start"][lo:hi].copy()
+    ends = index["end"][lo:hi].copy()
+    # clip the intervals in the first and last milestone to the passage:
+    first_ms = index["ms"][lo:hi] == ms_start
+    starts[first_ms] = np.maximum(starts[first_ms], token_start)
+    if token_end is not None:
+        last_ms = index["ms"][lo:hi] == ms_end
+        ends[last_ms] = np.minimum(ends[last_ms], token_end)
+    lengths = np.maximum(ends - starts, 0)
+    indptr = index["indptr"]
+    a, b = indptr[lo], indptr[hi]
+    weights = np.repeat(lengths, np.diff(indptr[lo:hi+1])) * index["counts"][a:b]
+    tokens = np.bincount(index["texts"][a:b], weights=weights,
+                         minlength=len(index["text_ids"]))
+    top = np.argsort(-tokens, kind="stable")[:n]
+    return [{"text": index["text_ids"][t], "tokens": int(tokens[t]),
+             "description": describe_text(index["text_ids"][t])}
+            for t in top if tokens[t] > 0]
+
+def reuse_passages(ms_runs, min_count=1):
+    """Find the maximal passages of the main text in which every token
+    is reused at least `min_count` times.
+
+    Args:
+        ms_runs (dict): {milestone: list of [start, end, count] runs}
+            (see coverage_runs())
+        min_count (int): minimum count of every token of a passage
+
+    Returns:
+        dict of numpy arrays ({"ms", "start", "end", "peak", "total"}:
+            milestone, start and end token (exclusive), highest count
+            and sum of the counts of all tokens of each passage)
+    """
+    runs = [(m, s, e, c) for m in sorted(ms_runs) for s, e, c in ms_runs[m] if c >= min_count]
+    arr = np.array(runs, dtype=np.int64).reshape(-1, 4)
+    ms, start, end, count = arr.T
+    if not len(ms):
+        return {key: np.zeros(0, dtype=np.int64)
+                for key in ["ms", "start", "end", "peak", "total"]}
+    # a run starts a new passage unless it continues the previous run:
+    new = np.ones(len(ms), dtype=bool)
+    new[1:] = (ms[1:] != ms[:-1]) | (start[1:] != end[:-1])
+    first = np.flatnonzero(new)
+    last = np.append(first[1:], len(ms)) - 1
+    return {"ms": ms[first], "start": start[first], "end": end[last],
+            "peak": np.maximum.reduceat(count, first),
+            "total": np.add.reduceat(count * (end - start), first)}
+
+def count_percentile(ms_runs, q):
+    """Get the q-th percentile of the counts of all reused tokens
+    (each run weighted by its length)."""
+    runs = np.array([r for m in ms_runs for r in ms_runs[m]], dtype=np.int64).reshape(-1, 3)
+    if not len(runs):
+        return 1
+    order = np.argsort(runs[:, 2], kind="stable")
+    lengths = np.cumsum((runs[:, 1] - runs[:, 0])[order])
+    i = np.searchsorted(lengths, q / 100 * lengths[-1])
+    return int(runs[order[min(i, len(order)-1)], 2])
+
+def top_k(score, k, ms, start):
+    """Get the index numbers of the k highest scores, sorted by score
+    (highest first) and, for equal scores, by milestone and start token.
+
+    Only the scores that can be among the top k are sorted
+    (a partial sort with numpy.argpartition); all scores equal
+    to the k-th highest score are included in that sort, so that ties
+    are broken in the same way as with a full sort.
+
+    Returns:
+        numpy array (at most k index numbers)
+    """
+    k = min(k, len(score))
+    if not k:
+        return np.zeros(0, dtype=np.int64)
+    kth = -np.partition(-score, k - 1)[k - 1]
+    top = np.flatnonzero(score >= kth)
+    return top[np.lexsort((start[top], ms[top], -score[top]))][:k]
+
+@instrumented()
+def top_reused_passages(folder, k=50, date_range=(0, 1501), status=None,
+                        min_alignment_length=0, metric="alignments",
+                        min_count=None, rank_by="peak", top_n=3,
+                        milestone_range=None):
+    """Find the k most reused passages of the main text, and the texts
+    that reuse them most.
+
+    A passage is a maximal stretch of tokens within a milestone
+    in which every token is reused at least `min_count` times.
+    The passages are ranked with a partial sort (see top_k()),
+    so that only the top k are sorted; passages with the same score
+    are ranked by milestone and start token.
+
+    Args:
+        folder (str): path to the folder containing the milestone files
+            (or alignment store)
+        k (int): number of passages
+        date_range (tuple): (start_date, end_date) of the reusing texts
+        status (str or list): only include reuse by texts with this status
+            in the metadata (e.g., "pri"). Default: None (all texts)
+        min_alignment_length (int): only include alignments that cover
+            at least this number of tokens in the main text. Default: 0
+        metric (str): "alignments" or "texts" (see ms_data_heatmap())
+        min_count (int): minimum count of every token of a passage.
+            Default: None (the 90th percentile of the counts
+            of all reused tokens)
+        rank_by (str): "peak" (highest count in the passage),
+            "mean" (mean count) or "total" (sum of the counts of all tokens)
+        top_n (int): number of contributing texts for each passage
+        milestone_range (tuple): (first milestone, last milestone (exclusive))
+            of the main text to be included. Default: None (all milestones)
+
+    Returns:
+        list (of dictionaries {"rank", "ms", "start", "end" (exclusive),
+            "length", "peak", "mean", "total",
+            "contributors": see top_contributors()}, one for each passage)
+    """
+    alignments, text_ids = load_alignments(folder, [date_range], status=status,
+                                           min_alignment_length=min_alignment_length,
+                                           milestone_range=milestone_range)
+    a = alignments[0]
+    ms, bw, ew = a["ms"], a["bw"], a["ew"]
+    if metric == "texts":
+        ms, bw, ew = union_intervals_per_text(ms, bw, ew, a["text"])
+    ms_runs = coverage_runs(ms, bw, ew)
+    if min_count is None:
+        min_count = count_percentile(ms_runs, 90)
+    passages = reuse_passages(ms_runs, min_count)
+    length = passages["end"] - passages["start"]
+    mean = passages["total"] / np.maximum(length, 1)
+    score = {"peak": passages["peak"] + mean / (mean.max() + 1) if len(mean) else mean,
+             "mean": mean, "total": passages["total"]}[rank_by]
+    count_items(passages=len(score))
+
+    top = top_k(score, k, passages["ms"], passages["start"])
+
+    index = build_contributor_index(a["ms"], a["bw"], a["ew"], a["text"], text_ids)
+    results = []
+    for rank, i in enumerate(top, 1):
+        m, start, end = int(passages["ms"][i]), int(passages["start"][i]), int(passages["end"][i])
+        results.append({"rank": rank, "ms": m, "start": start, "end": end,
+                        "length": end - start, "peak": int(passages["peak"][i]),
+                        "mean": round(float(mean[i]), 2), "total": int(passages["total"][i]),
+                        "contributors": top_contributors(index, m, m, start, end, n=top_n)})
+    return results
+
+def top_reused_passages_cli(argv=None):
+    """Command line interface for top_reused_passages():
+
+        python milestone_text_reuse_heatmap.py top-passages folder [-k 50] ...
+    """
+    parser = argparse.ArgumentParser(prog="milestone_text_reuse_heatmap.py top-passages",
+                                     description="List the most reused passages of a text.")
+    parser.add_argument("folder", help="folder with the milestone files (or alignment store)")
+    parser.add_argument("-k", type=int, default=50, help="number of passages")
+    parser.add_argument("--date-range", type=int, nargs=2, default=[0, 1501],
+                        metavar=("START", "END"))
+    parser.add_argument("--status", nargs="*", help="e.g., pri")
+    parser.add_argument("--min-alignment-length", type=int, default=0)
+    parser.add_argument("--metric", choices=["alignments", "texts"], default="alignments")
+    parser.add_argument("--min-count", type=int, default=None)
+    parser.add_argument("--rank-by", choices=["peak", "mean", "total"], default="peak")
+    parser.add_argument("--top-n", type=int, default=3,
+                        help="number of contributing texts for each passage")
+    parser.add_argument("--milestone-range", type=int, nargs=2, default=None,
+                        metavar=("FIRST", "END"))
+    parser.add_argument("--meta", help="path to the metadata file")
+    parser.add_argument("--json", action="store_true", help="print the result as json")
+    args = parser.parse_args(argv)
+
+    meta.update(load_metadata(args.meta) if args.meta else load_metadata())
+    passages = top_reused_passages(args.folder, k=args.k, date_range=tuple(args.date_range),
+                                   status=args.status,
+                                   min_alignment_length=args.min_alignment_length,
+                                   metric=args.metric, min_count=args.min_count,
+                                   rank_by=args.rank_by, top_n=args.top_n,
+                                   milestone_range=args.milestone_range)
+    if args.json:
+        print(json.dumps(passages, ensure_ascii=False, indent=2))
+        return
+    print("{:>4} {:>6} {:>11} {:>5} {:>6} {:>8}  most reused by".format(
+        "rank", "ms", "tokens", "peak", "mean", "total"))
+    for p in passages:
+        print("{:>4} {:>6} {:>5}-{:<5} {:>5} {:>6.1f} {:>8}  {}".format(
+            p["rank"], p["ms"], p["start"], p["end"], p["peak"], p["mean"], p["total"],
+            "; ".join("{} ({})".format(c["description"], c["tokens"])
+                      for c in p["contributors"])))
+
+def contributor_labels(index, lines, n=3):
+    """Create for each line in a plot a label listing the texts
+    that reuse its tokens most often (see plot_with_bokeh()).
+
+    Args:
+        index (dict): contributor index (see build_contributor_index())
+        lines (list): list of lines [[ms, ms], [start, end], count]
+        n (int): maximum number of texts in each label
+
+    Returns:
+        list (of strings, one for each line)
+    """
+    if not lines:
+        return []
+    width = int(max(index["end"].max() if len(index["end"]) else 0,
+                    max(line[1][1] for line in lines))) + 1
+    start_keys = index["ms"]*width + index["start"]
+    end_keys = index["ms"]*width + index["end"]
+    line_ms = np.array([line[0][0] for line in lines], dtype=np.int64)
+    line_start = np.array([line[1][0] for line in lines], dtype=np.int64)
+    line_end = np.array([line[1][1] for line in lines], dtype=np.int64)
+    # the intervals that overlap with each line:
+    lo = np.searchsorted(end_keys, line_ms*width + line_start, side="right")
+    hi = np.searchsorted(start_keys, line_ms*width + line_end, side="left")
+    indptr = index["indptr"]
+    labels = []
+    cache = dict()
+    for i in range(len(lines)):
+        key = (lo[i], hi[i])
+        if key not in cache:
+            totals = defaultdict(int)
+            a, b = indptr[lo[i]], indptr[max(lo[i], hi[i])]
+            for t, c in zip(index["texts"][a:b], index["counts"][a:b]):
+                totals[t] += c
+            top = sorted(totals, key=lambda t: totals[t], reverse=True)[:n]
+            cache[key] = "; ".join([describe_text(index["text_ids"][t]) for t in top])
+        labels.append(cache[key])
+    return labels
+
+def build_group_runs(ms, bw, ew, groups, texts=None, metric="alignments"):
+    """Build a reverse index from groups of alignments (e.g., the alignments
+    with each text, or with all texts in a date bin) to the runs of tokens
+    in the main text they reuse (see coverage_runs()), so that the heatmap
+    for any selection of groups can be calculated by summing their runs.
+
+    Args:
+        ms (array): milestone number of each alignment
+        bw (array): start token of each alignment in its milestone
+        ew (array): end token (exclusive) of each alignment
+        groups (array): integer id of the group of each alignment
+        texts (array): integer id of the text of each alignment
+            (only needed for metric "texts"; each text must belong
+            to a single group)
+        metric (str): "alignments" (runs count the number of alignments
+            in the group) or "texts" (runs count the number of distinct
+            texts in the group, so that the sum over a selection of groups
+            is the number of distinct texts)
+
+    Returns:
+        dict (of int32 arrays "group", "ms", "start", "end", "count",
+            sorted by group, milestone and start token)
+    """
+    ms = np.asarray(ms, dtype=np.int64)
+    bw = np.asarray(bw, dtype=np.int64)
+    ew = np.asarray(ew, dtype=np.int64)
+    groups = np.asarray(groups, dtype=np.int64)
+    # treat each milestone of each group as a separate "milestone":
+    n_ms = int(ms.max()) + 1 if len(ms) else 1
+    group_ms = groups*n_ms + ms
+    if metric == "texts":
+        group_ms, bw, ew = union_intervals_per_text(group_ms, bw, ew, texts)
+    runs = coverage_runs(group_ms, bw, ew)
+    keys = np.repeat(np.array(list(runs.keys()), dtype=np.int64),
+                     [len(r) for r in runs.values()])
+    runs = np.array([run for r in runs.values() for run in r],
+                    dtype=np.int64).reshape(-1, 3)
+    return {"group": (keys // n_ms).astype(np.int32),
+            "ms": (keys % n_ms).astype(np.int32),
+            "start": runs[:, 0].astype(np.int32),
+            "end": runs[:, 1].astype(np.int32),
+            "count": runs[:, 2].astype(np.int32)}
+
+@instrumented()
 def create_plot_lines(ms_count_dicts, outfps):
     """Create list with start and end coordinates + number of reuse cases
     of each line to be plotted.
@@ -105,61 +1605,75 @@ def create_plot_lines(ms_count_dicts, outfps):
     Args:
         ms_count_dicts (list): list of dictionaries
             (one for each relevant data range)
-            containing for every milestone a list of 300 integers
-            (one for each token in the milestone)
-            that represents the number of times the token was
-            repeated within the relevant date range
+            containing for every milestone a list of runs
+            [start, end, count] (see coverage_runs()):
+            maximal stretches of tokens (end exclusive) that were
+            reused the same number of times within the relevant date range
         outfps (list): list of file paths to which each list of lines
             should be saved
             (same number of paths as dictionaries in ms_count_dicts)
 
     Returns:
-        list (list of dictionaries {"xs": [<x value tuples (start = end) for each line>],
-                                    "ys": [<y value tuples (start, end) for each line>],
-                                    "vals": [<number of times the tokens covered by this line are reused>]}
+        list (list of lists [[ms, ms], [start, end], count] for each line)
     """
     print("Calculating location and color for each line in heatmap...")
 
-    #lines = [{"xs": [], "ys":[], "vals":[]} for i in range(len(ms_count_dicts))]
     lines = [[] for i in range(len(ms_count_dicts))]
 
     for i in range(len(ms_count_dicts)):
         ms_data = ms_count_dicts[i]
-        #json_d = lines[i]
         json_list = lines[i]
         outfp = outfps[i]
         for ms in ms_data:
-            current_line_val = 0
-            current_line_start = 0
-            for i in range(len(ms_data[ms])):
-                v = ms_data[ms][i]
-                #print(v)
-                if v == current_line_val:
-                    continue
-                else:
-                    if current_line_val:
-                        x = [ms, ms]
-                        y = [current_line_start, i]
-                        #print(current_line_val/max_val)
-##                        ax.plot(x, y, c=cmap(current_line_val/max_val),
-##                                linewidth=1)
-                        #json_list.append([x, y, current_line_val/max_val])
-##                        json_d["xs"].append(x)
-##                        json_d["ys"].append(y)
-##                        json_d["vals"].append(current_line_val)
-                        json_list.append([x, y, current_line_val])
-                    current_line_val = v
-                    current_line_start = i
-        with open(outfp, mode="w", encoding="utf-8") as file:
-            #json.dump(json_d, file, ensure_ascii=False, indent=2)
+            # each run of tokens with the same count is one line:
+            for start, end, count in ms_data[ms]:
+                json_list.append([[ms, ms], [start, end], count])
+        with atomic_write(outfp) as file:
             json.dump(json_list, file, ensure_ascii=False, indent=2)
+        count_items(lines=len(json_list))
     return lines
 
 
+@instrumented()
 def plot_with_bokeh(date_ranges, split_data_lines, max_val, last_ms,
-                    cmap, outfp=None, filter_date_ranges=[], mode="inline"):
-    print("filter_date_ranges:", filter_date_ranges)
-    print("date_ranges:", date_ranges)
+                    cmap, outfp=None, filter_date_ranges=[], mode="inline",
+                    value_label="reuse cases", contributor_indexes=None,
+                    top_n=3, text_runs=None, text_ids=None, summaries=None,
+                    milestone_range=None, title=None, show_plot=True):
+    """Use Bokeh to create an interactive html version of the heatmap.
+
+    If `text_runs` (a list with the runs of each text
+    for every date range, see build_group_runs()) is provided,
+    the runs are embedded in the html file, and a selection widget
+    allows to recalculate the heatmap in the browser
+    for any selection of the texts in `text_ids`.
+
+    If `mode` is "sidecar", the plot data is not embedded in the html file
+    but written to binary files next to it, and BokehJS is loaded
+    from a local static folder (see save_with_sidecar_data()).
+    The contributors (`contributor_indexes`) cannot be shown in this mode,
+    nor together with the text selection widget.
+
+    If `summaries` (the summary of the reuse in each milestone
+    of the whole text for every date range, see summarize_milestones())
+    are provided, an overview of the whole text is displayed above
+    the heatmap, with a range tool that selects the milestones shown
+    in the heatmap.
+
+    If `milestone_range` (first milestone, last milestone (exclusive))
+    is provided, the x axis of the heatmap (and the initial selection
+    of the range tool) is limited to that range.
+
+    `title` (e.g., the name of the text) is displayed above the plot;
+    if `show_plot` is False, the plot is only saved, not opened.
+
+    Returns:
+        Bokeh layout
+    """
+    if contributor_indexes and (text_runs or mode == "sidecar"):
+        raise ValueError("contributors cannot be shown with the text filter or in sidecar mode")
+    sidecar = dict() if mode == "sidecar" else None
+    count_items(lines=sum(len(lines) for lines in split_data_lines))
     # create subplots:
     tools = "pan,wheel_zoom,box_zoom,reset,tap"
     title_fmt = "Reuse of texts by authors who died between {} and {} AH"
@@ -168,36 +1682,60 @@ def plot_with_bokeh(date_ranges, split_data_lines, max_val, last_ms,
         ax = figure(plot_width=250, plot_height=250, tools=tools)
         ax.background_fill_color="grey"
         ax.background_fill_alpha=0.3
-        title=title_fmt.format(*dr)
+        ax_title = title_fmt.format(*dr)
         filtered = [date_ranges[j] for j in filter_date_ranges if i > j]
-        print("FILTERED:", filtered)
         if filtered:
             filtered = ", ".join(["{}-{} AH".format(*dr) for dr in filtered])
-            title += " (text reuse from previous date range(s) filtered out: {})".format(filtered)
-        ax.add_layout(Title(text=title, text_font_size="12pt"), "above")
+            ax_title += " (text reuse from previous date range(s) filtered out: {})".format(filtered)
+        ax.add_layout(Title(text=ax_title, text_font_size="12pt"), "above")
         axes.append(ax)
 
     cmap = list(cmap(max_val)) # number of values in the color palette
     cmap.reverse()
+    color_mapper = LinearColorMapper(palette=cmap, low=0.5, high=max_val+0.5)
 
     # plot lines:
+    segment_sources = []
     for i in range(len(date_ranges)):
         line_data = split_data_lines[i]
+        if text_runs or sidecar is not None:
+            # put all lines in a single data source,
+            # which can be updated by the text selection widget:
+            data = {"x0": [x[0] for x, y, v in line_data],
+                    "x1": [x[1] for x, y, v in line_data],
+                    "y0": [y[0] for x, y, v in line_data],
+                    "y1": [y[1] for x, y, v in line_data],
+                    "val": [v for x, y, v in line_data]}
+            if sidecar is not None:
+                name = "lines_{}".format(i)
+                sidecar[name] = data
+                source = ColumnDataSource(data={k: [] for k in data}, name=name)
+            else:
+                source = ColumnDataSource(data=data)
+            axes[i].segment("x0", "y0", "x1", "y1", source=source,
+                            color={"field": "val", "transform": color_mapper},
+                            nonselection_line_width=1,
+                            selection_line_width=3)
+            segment_sources.append(source)
+            continue
         ax = axes[i]
         vals = dict()
-        #print("plotting values in subplot ", i+1)
-        print("plotting values in subplot {}".format(i+1))
-        for x, y, v in line_data:
+        # add the texts that reuse each line most to the hover info:
+        if contributor_indexes:
+            labels = contributor_labels(contributor_indexes[i], line_data, top_n)
+        for j, (x, y, v) in enumerate(line_data):
             #ax.plot(x, y, c=cmap(v/max_val), linewidth=1) # this is too slow
             # group lines by reuse count, which speeds up plotting:
             if not v in vals:
-                vals[v] = {"xs": [], "ys": [], "val": []}
+                vals[v] = {"xs": [], "ys": [], "val": [], "top": []}
             vals[v]["xs"].append(x)
             vals[v]["ys"].append(y)
             vals[v]["val"].append(v)
+            if contributor_indexes:
+                vals[v]["top"].append(labels[j])
         for val in sorted(vals.keys()):
-            #print(val)
-            print("val", val, "color:", cmap[val-1])
+            if not contributor_indexes:
+                del vals[val]["top"]
             source = ColumnDataSource(data=vals[val])
             ml = ax.multi_line("xs", "ys", source=source,
                                color=cmap[val-1],
@@ -206,26 +1744,43 @@ def plot_with_bokeh(date_ranges, split_data_lines, max_val, last_ms,
                                selection_line_width=3)
 
     # add color bar:
-    color_mapper = LinearColorMapper(palette=cmap, low=0.5, high=max_val+0.5)
     color_bar = ColorBar(color_mapper=color_mapper, label_standoff=12)
     for ax in axes:
         ax.add_layout(color_bar, 'right')
 
-    # set x range of all axes to last_ms:
+    # set x range of all axes to last_ms
+    # (and y range to the length of the longest milestone):
+    max_token = max([300] + [y[1] for lst in split_data_lines for x, y, v in lst])
+    x_start, x_end = milestone_range or (0, last_ms + 10)
     for ax in axes:
-        ax.x_range.end = last_ms + 10
-        ax.x_range.start = 0
+        ax.x_range.end = x_end
+        ax.x_range.start = x_start
         ax.y_range.start = 0
-        ax.y_range.end = 300
+        ax.y_range.end = max_token
         ax.sizing_mode = "stretch_width"
+    if summaries:
+        # the overview always shows the whole text:
+        overview_end = max([last_ms] + [int(s["ms"].max()) for s in summaries
+                                        if len(s["ms"])]) + 10
+        overview = milestone_overview(date_ranges, summaries, (0, overview_end),
+                                      value_label)
+        # link the x ranges of the heatmap panels to the range tool:
+        x_range = Range1d(x_start, x_end)
+        for ax in axes:
+            ax.x_range = x_range
+        range_tool = RangeTool(x_range=x_range)
+        overview.add_tools(range_tool)
+        overview.toolbar.active_multi = range_tool
 
     # add title:        
     #title = "<h1>{}</h1>".format(os.path.split(folder)[-1])
-    title = os.path.split(folder)[-1]
-    axes[0].add_layout(Title(text=title, text_font_size="16pt"), "above")
+    if title:
+        axes[0].add_layout(Title(text=title, text_font_size="16pt"), "above")
 
     # add tooltips and double-click callback:        
-    TOOLTIPS = [("reuse cases", "@val")]
+    TOOLTIPS = [(value_label, "@val")]
+    if contributor_indexes:
+        TOOLTIPS.append(("most reused by", "@top"))
     for ax in axes:
         ax.add_tools(HoverTool(tooltips=TOOLTIPS, line_policy="interp"))
         #ax.add_tools(WheelZoomTool())
@@ -251,36 +1806,233 @@ def plot_with_bokeh(date_ranges, split_data_lines, max_val, last_ms,
     # save and show image:
     #c = column(*axes, sizing_mode="stretch_width")
     columns = [[ax] for ax in axes]
+    if summaries:
+        columns = [[overview]] + columns
 ##    columns = [[div]] + columns
+    if text_runs:
+        columns = [text_selection_widgets(text_runs, text_ids, segment_sources,
+                                          filter_date_ranges, sidecar)] + columns
     c = grid(columns)
+    if sidecar is not None:
+        save_with_sidecar_data(c, outfp, sidecar, show_plot=show_plot)
+        return c
     if outfp:
         output_file(outfp, mode=mode)
         save(c)
         #save(c, outfp)
     #show(column(Div(text=title), *axes, sizing_mode="stretch_both"))
-    show(c)
-    
+    if show_plot:
+        show(c)
+    return c
 
-    
 
+def milestone_overview(date_ranges, summaries, ms_range, value_label="reuse cases"):
+    """Create a small overview plot of the reuse in every milestone
+    of the whole text (number of reused tokens per milestone,
+    with a line for each date range).
+
+    Args:
+        date_ranges (list): list of tuples (start_date, end_date)
+        summaries (list): milestone summary of each date range
+            (see summarize_milestones())
+        ms_range (tuple): first and last milestone (exclusive) of the overview
+        value_label (str): name of the values in the heatmap
+
+    Returns:
+        Bokeh figure
+    """
+    overview = figure(plot_height=130, plot_width=250, tools="xpan",
+                      toolbar_location=None, x_range=ms_range,
+                      sizing_mode="stretch_width")
+    overview.yaxis.axis_label = "reused tokens"
+    colors = Category10[10]
+    for i, (dr, summary) in enumerate(zip(date_ranges, summaries)):
+        # include the milestones without reuse:
+        data = {col: np.zeros(ms_range[1] - ms_range[0], dtype=np.int64)
+                for col in SUMMARY_COLUMNS}
+        data["ms"] = np.arange(*ms_range)
+        keep = (summary["ms"] >= ms_range[0]) & (summary["ms"] < ms_range[1])
+        for col in SUMMARY_COLUMNS[1:]:
+            data[col][summary["ms"][keep] - ms_range[0]] = summary[col][keep]
+        source = ColumnDataSource(data=data)
+        overview.line("ms", "reused_tokens", source=source, color=colors[i % 10],
+                      legend_label="{}-{} AH".format(*dr))
+    overview.add_tools(HoverTool(tooltips=[("milestone", "@ms"),
+                                           ("reused tokens", "@reused_tokens"),
+                                           ("max. " + value_label, "@max_value"),
+                                           ("alignments", "@alignments"),
+                                           ("texts", "@texts")],
+                                 mode="vline"))
+    overview.legend.location = "top_left"
+    overview.legend.label_text_font_size = "8pt"
+    overview.legend.click_policy = "hide"
+    overview.ygrid.grid_line_color = None
+    return overview
+
+def text_selection_widgets(text_runs, text_ids, sources, filter_date_ranges=[],
+                           sidecar=None):
+    """Create a widget for selecting the texts whose reuse is displayed
+    in the heatmap, with buttons to select all or no texts.
+
+    The runs of each text are embedded (as binary arrays) in the html file,
+    and the lines of the heatmap are recalculated in the browser
+    every time the selection changes (see TEXT_FILTER_JS).
+
+    Args:
+        text_runs (list): runs of each text (see build_group_runs())
+            for each date range
+        text_ids (list): ids of the texts
+        sources (list): data source of the lines in each subplot
+        filter_date_ranges (list): see ms_data_heatmap()
+        sidecar (dict): if provided, the runs are not embedded in the
+            html file but added to this dictionary, to be written
+            to sidecar files (see save_with_sidecar_data())
+
+    Returns:
+        list (of Bokeh widgets)
+    """
+    # list the texts in chronological order:
+    used = sorted(set(t for runs in text_runs for t in np.unique(runs["group"]).tolist()))
+    used.sort(key=lambda t: (meta.get(text_ids[t], {}).get("date", 0), text_ids[t]))
+    options = [(str(t), describe_text(text_ids[t])) for t in used]
+    selector = MultiSelect(title="Texts (ctrl+click to deselect):",
+                           value=[str(t) for t in used], options=options,
+                           size=8, sizing_mode="stretch_width")
+    if sidecar is not None:
+        run_sources = []
+        for i, runs in enumerate(text_runs):
+            name = "text_runs_{}".format(i)
+            sidecar[name] = runs
+            run_sources.append(ColumnDataSource(data={k: [] for k in runs}, name=name))
+    else:
+        run_sources = [ColumnDataSource(data=runs) for runs in text_runs]
+    W = max([300] + [int(runs["end"].max()) for runs in text_runs if len(runs["end"])]) + 2
+    callback = CustomJS(args=dict(selector=selector, runs=run_sources, sources=sources,
+                                  filter_ranges=list(filter_date_ranges), W=W),
+                        code=TEXT_FILTER_JS)
+    selector.js_on_change("value", callback)
+    select_all = Button(label="Select all texts", width=150)
+    select_all.js_on_click(CustomJS(args=dict(selector=selector), code="""
+selector.value = selector.options.map(o => o[0]);
+"""))
+    select_none = Button(label="Select no texts", width=150)
+    select_none.js_on_click(CustomJS(args=dict(selector=selector), code="""
+selector.value = [];
+"""))
+    return [selector, column(select_all, select_none)]
+
+def copy_bokeh_static(folder):
+    """Copy the minified BokehJS files into a static folder inside `folder`
+    (if they are not there yet), so that all html files in that folder
+    can share them and do not depend on a CDN.
+
+    Returns:
+        Bokeh Resources object that loads BokehJS from that folder
+    """
+    src = os.path.join(bokehjsdir(), "js")
+    dest = os.path.join(folder, "static", "js")
+    os.makedirs(dest, exist_ok=True)
+    for fn in os.listdir(src):
+        if re.match(r"bokeh(-\w+)?\.min\.js$", fn) \
+                and not os.path.exists(os.path.join(dest, fn)):
+            shutil.copy2(os.path.join(src, fn), dest)
+    # BokehJS urls will be relative to the html file: static/js/...
+    return Resources(mode="server", root_url="")
+
+def save_with_sidecar_data(layout, outfp, sidecar, show_plot=False, port=0):
+    """Save a Bokeh layout as an html file that does not contain the
+    data of its data sources; these are written as raw binary (int32)
+    arrays to a folder next to the html file, and are loaded by the
+    browser when the page has been opened (see SIDECAR_LOADER_JS),
+    so that the html file stays small regardless of the number of lines.
+
+    NB: browsers do not allow loading the data files from a page
+    opened with file://; serve the folder with a web server instead
+    (e.g., `python -m http.server`, or use `show_plot`).
+
+    Args:
+        layout (Bokeh layout): the layout to be saved
+        outfp (str): path to the html file
+        sidecar (dict): data of each data source (key: name of the data
+            source; value: dict of equal-length columns of integers)
+        show_plot (bool): if True, serve the folder of the html file
+            on localhost and open the page in the web browser;
+            the server runs until it is interrupted (ctrl+C)
+        port (int): port of that server. Default: 0 (any free port)
+    """
+    if not outfp:
+        raise ValueError("sidecar mode requires an output file path")
+    outfolder, html_fn = os.path.split(os.path.abspath(outfp))
+    data_folder = os.path.splitext(html_fn)[0] + "_data"
+    os.makedirs(os.path.join(outfolder, data_folder), exist_ok=True)
+    manifest = dict()
+    for name, data in sidecar.items():
+        columns = []
+        aliases = dict()
+        arrays = []
+        for col, arr in data.items():
+            arr = np.asarray(arr, dtype="<i4")
+            # store identical columns (e.g., x0 and x1) only once:
+            for prev, prev_arr in zip(columns, arrays):
+                if np.array_equal(arr, prev_arr):
+                    aliases[col] = prev
+                    break
+            else:
+                columns.append(col)
+                arrays.append(arr)
+        fn = "{}.bin".format(name)
+        with atomic_write(os.path.join(outfolder, data_folder, fn), mode="wb") as file:
+            for arr in arrays:
+                file.write(arr.tobytes())
+        manifest[name] = {"url": "{}/{}".format(data_folder, fn), "columns": columns,
+                          "aliases": aliases, "n": len(arrays[0]) if arrays else 0}
+    html = file_html(layout, copy_bokeh_static(outfolder),
+                     title=os.path.splitext(html_fn)[0])
+    script = "<script type=\"text/javascript\">{}</script>\n".format(
+        SIDECAR_LOADER_JS % json.dumps(manifest))
+    html = html.replace("</body>", script + "</body>")
+    with atomic_write(outfp) as file:
+        file.write(html)
+    print("Saved {} (data in {}); open it through a web server".format(outfp, data_folder))
+    if not show_plot:
+        return
+    class SidecarRequestHandler(SimpleHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+    handler = functools.partial(SidecarRequestHandler, directory=outfolder)
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    url = "http://127.0.0.1:{}/{}".format(server.server_address[1], html_fn)
+    print("Serving", url, "(press ctrl+C to stop)")
+    webbrowser.open(url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+@instrumented()
 def plot_with_matplotlib(date_ranges, split_data_lines, max_val, last_ms,
-                         cmap, outfp=None, filter_date_ranges=[]):
-    """Use matplotlib to create the """
+                         cmap, outfp=None, filter_date_ranges=[],
+                         value_label="reuse cases", milestone_range=None,
+                         title=None, show_plot=True):
+    """Use matplotlib to create the heatmap.
+
+    Returns:
+        matplotlib figure
+    """
     # create the different subplots (axes);
     fig, axes = plt.subplots(len(date_ranges), 1)
     if len(date_ranges) == 1:
         axes = [axes, ]
 
     # plot the lines:
-    start = time.time()
-    #for i in range(len(date_ranges)):
-    pbar = tqdm(range(len(date_ranges)))
-    for i in pbar:
+    count_items(lines=sum(len(lines) for lines in split_data_lines))
+    for i in range(len(date_ranges)):
         line_data = split_data_lines[i]
         ax = axes[i]
         vals = dict()
-        #print("plotting values in subplot ", i+1)
-        pbar.write("plotting values in subplot {}".format(i+1))
         for x, y, v in line_data:
             #ax.plot(x, y, c=cmap(v/max_val), linewidth=1) # this is too slow
             # group lines by reuse count, which speeds up plotting:
@@ -288,17 +2040,17 @@ def plot_with_matplotlib(date_ranges, split_data_lines, max_val, last_ms,
                 vals[v] = []
             vals[v]+=[x, y]
         for val in sorted(vals.keys()):
-            #print(val)
-            pbar.write(str(val))
             ax.plot(*vals[val], c=cmap(val/max_val), linewidth=1)
-    print("plotting took", time.time()-start)
-    # set all X axes to the last reused milestone:
+    # set all X axes to the last reused milestone
+    # (and Y axes to the length of the longest milestone):
+    max_token = max([300] + [y[1] for lst in split_data_lines for x, y, v in lst])
     for ax in axes:
-        ax.set_xlim([0, last_ms+10])
-        ax.set_ylim([0, 300])
+        ax.set_xlim(milestone_range or [0, last_ms+10])
+        ax.set_ylim([0, max_token])
 
     # add titles:
-    fig.suptitle(os.path.split(folder)[-1])
+    if title:
+        fig.suptitle(title)
     for i, dr in enumerate(date_ranges):
         ax = axes[i]
         title = "Reuse of texts by authors who died between {} and {} AH"
@@ -310,76 +2062,65 @@ def plot_with_matplotlib(date_ranges, split_data_lines, max_val, last_ms,
     norm = matplotlib.colors.Normalize(vmin=0, vmax=max_val)
     sm = matplotlib.cm.ScalarMappable(norm=norm, cmap=cmap)
     cbar = fig.colorbar(sm, ax=list(axes))
-    cbar.ax.set_title("reuse cases")
+    cbar.ax.set_title(value_label)
 
     # display plot:
     #plt.tight_layout() # does not work with cbar!
-    plt.get_current_fig_manager().window.state('zoomed') # fullscreen!
+    if show_plot:
+        plt.get_current_fig_manager().window.state('zoomed') # fullscreen!
     if outfp:
         plt.savefig(outfp)
-    plt.show()
+    if show_plot:
+        plt.show()
+    else:
+        plt.close(fig)
+    return fig
 
-def ms_data_heatmap(folder, date_ranges=[(0, 1501),], filter_date_ranges=[],
-                    cmap=plt.cm.autumn_r, plot_func=plot_with_matplotlib,
-                    outfp=None):
-    """Visualize the frequency of reuse of each token in a text
-    by a heat map. 
+def cache_file_suffix(status=None, min_alignment_length=0, metric="alignments",
+                      milestone_range=None):
+    """Create the suffix of the names of the files in which the calculated
+    data for a specific selection of alignments is cached
+    (e.g., "_texts_pri_min10_ms4000-4500")."""
+    suffix = ""
+    if metric == "texts":
+        suffix += "_texts"
+    if status:
+        suffix += "_" + ("-".join(status) if not isinstance(status, str) else status)
+    if min_alignment_length:
+        suffix += "_min{}".format(min_alignment_length)
+    if milestone_range:
+        suffix += "_ms{}-{}".format(*milestone_range)
+    return suffix
 
-    Args:
-        folder (str): path to folder containing the milestone files.
-            Ideally, the folder has the URI of the text as name.
-        date_ranges (list): list of tuples (start_date (int), end_date (int))
-            for each date range for which the reuse data should be
-            visualized in a separate graph.
-            NB: start date is inclusive, end date exclusive:
-            with [(0, 300), (300, 1501)] 300 will be included in the second graph.
-        filter_date_ranges (list): list of index numbers of the date_ranges list
-            for which the reuse data should be
-            filtered out from the later graphs (mostly used for displaying
-            only text reuse that the text itself did not reuse from other sources)
-        cmap (Matplotlib color map): Matplot lib color map to be used
-            for the heatmap: see
-            https://matplotlib.org/stable/tutorials/colors/colormaps.html
-        plot_func (function): function to be used to plot the data.
-        outfp (str): graph will be saved to file if a path is provided.
-            Default: None.
+def heatmap_cache_fps(folder, date_ranges, suffix=""):
+    """Get the paths to the files in which the lines (plotjson)
+    and the milestone summary (csv) of each date range are cached
+    (see cache_file_suffix()).
+
+    Returns:
+        tuple (list of paths to the lines files,
+               list of paths to the summary files)
     """
-    # check if data has already been calculated:
-    split_data_lines = []
-    split_fps = []
-    for i, dr in enumerate(date_ranges):
-        fp = os.path.join(folder, "lines_{}_{}.plotjson".format(*dr))
-        split_fps.append(fp)
-        if os.path.exists(fp):
-            print("loading data for range", dr)
-            with open(fp, mode="r", encoding="utf-8") as file:
-                split_data_lines.append(json.load(file))
-        else:
-            print("Data for range", dr, "not yet calculated")
-            split_data_lines.append([])
+    return ([os.path.join(folder, "lines_{}_{}{}.plotjson".format(*dr, suffix))
+             for dr in date_ranges],
+            [os.path.join(folder, "summary_{}_{}{}.csv".format(*dr, suffix))
+             for dr in date_ranges])
 
-    # calculate missing date range data:
-    no_data = [i for i in range(len(split_data_lines)) if split_data_lines[i] == []]
-    if no_data:
-        #filtered_ms_data = filter_srt_files(folder, [date_ranges[e] for e in no_data])
-        ms_count_dicts = calculate_token_reuse_freq(folder, [date_ranges[e] for e in no_data])
-        missing_lines = create_plot_lines(ms_count_dicts, [split_fps[e] for e in no_data])
-        for i, e in enumerate(no_data):
-            split_data_lines[e] = missing_lines[i]
+@instrumented()
+def filter_date_range_lines(split_data_lines, filter_date_ranges):
+    """Remove the tokens reused in the date ranges in `filter_date_ranges`
+    from the lines of all later date ranges.
 
-    # calculate the maximum value and last milestone:
-    max_val = 0
-    last_ms = 0
-    for lst in split_data_lines:
-        for tup in lst:
-            if tup[2] > max_val:
-                max_val = tup[2]
-            if tup[0][0] > last_ms:
-                last_ms = tup[0][0]
-    print("max_val:", max_val)
-    print("last milestone:", last_ms)
+    Args:
+        split_data_lines (list): list of lists of lines for each date range
+            (see create_plot_lines()); the lists are replaced in place
+        filter_date_ranges (list): index numbers of the date ranges
+            to be filtered out from the later date ranges
 
-    # filter out lines from selected date ranges in other date ranges:
+    Returns:
+        list (split_data_lines)
+    """
+    count_items(lines=sum(len(lines) for lines in split_data_lines))
     for i in filter_date_ranges:
         # create a dictionary with for every milestone a list of reused token indexes
         filter_data = dict()
@@ -415,8 +2156,1722 @@ def ms_data_heatmap(folder, date_ranges=[(0, 1501),], filter_date_ranges=[],
                                     current_index = y
                             filtered.append([[ms, ms], [start_index, current_index], freq])
                 split_data_lines[j] = filtered
-    plot_func(date_ranges, split_data_lines, max_val, last_ms, cmap, outfp,
-              filter_date_ranges=filter_date_ranges)
+
+    return split_data_lines
+
+@instrumented()
+def load_heatmap_lines(folder, date_ranges, filter_date_ranges=[], status=None,
+                       min_alignment_length=0, metric="alignments",
+                       with_summary=False, milestone_range=None):
+    """Load the lines of the heatmap for each date range
+    (from the plotjson files in the folder, or calculate them
+    if they have not been calculated yet), and filter out the tokens
+    reused in the date ranges in `filter_date_ranges`
+    from the later date ranges.
+
+    If `with_summary` is True, the summary of the reuse in each milestone
+    (see summarize_milestones()) of each date range is loaded as well
+    (from the summary csv files in the folder, or calculated
+    together with the lines).
+
+    See ms_data_heatmap() for the other arguments.
+
+    Returns:
+        tuple (list of lists of lines for each date range
+            (see create_plot_lines()), max_val (int), last_ms (int)
+            [, list of milestone summaries of each date range])
+    """
+    # check if data has already been calculated:
+    suffix = cache_file_suffix(status, min_alignment_length, metric, milestone_range)
+    split_fps, summary_fps = heatmap_cache_fps(folder, date_ranges, suffix)
+    split_data_lines = [[] for dr in date_ranges]
+    summaries = [None for dr in date_ranges]
+    def load_cached(i):
+        """Load the saved data of date range i (False if it is missing)."""
+        if with_summary:
+            if not os.path.exists(summary_fps[i]):
+                return False
+            summaries[i] = load_summary_csv(summary_fps[i])
+        if not os.path.exists(split_fps[i]):
+            return False
+        print("loading data for range", date_ranges[i])
+        with open(split_fps[i], mode="r", encoding="utf-8") as file:
+            split_data_lines[i] = json.load(file)
+        return split_data_lines[i] != []
+    for i, dr in enumerate(date_ranges):
+        if not load_cached(i):
+            print("Data for range", dr, "not yet calculated")
+
+    # calculate missing date range data:
+    no_data = [i for i in range(len(split_data_lines)) if split_data_lines[i] == []]
+    if no_data:
+        # lock the missing files (in a fixed order, to avoid deadlocks),
+        # so that other processes wait for this one instead of calculating
+        # the same data:
+        with ExitStack() as stack:
+            waited = [stack.enter_context(file_lock(split_fps[e]))
+                      for e in sorted(no_data, key=lambda e: split_fps[e])]
+            if any(waited):
+                # another process may have calculated the data in the meantime:
+                no_data = [e for e in no_data if not load_cached(e)]
+            if no_data:
+                #filtered_ms_data = filter_srt_files(folder, [date_ranges[e] for e in no_data])
+                ms_count_dicts = calculate_token_reuse_freq(folder, [date_ranges[e] for e in no_data],
+                                                            status=status,
+                                                            min_alignment_length=min_alignment_length,
+                                                            metric=metric,
+                                                            with_summary=with_summary,
+                                                            milestone_range=milestone_range)
+                if with_summary:
+                    ms_count_dicts, missing_summaries = ms_count_dicts
+                    for i, e in enumerate(no_data):
+                        summaries[e] = missing_summaries[i]
+                        save_summary_csv(summaries[e], summary_fps[e])
+                missing_lines = create_plot_lines(ms_count_dicts, [split_fps[e] for e in no_data])
+                for i, e in enumerate(no_data):
+                    split_data_lines[e] = missing_lines[i]
+
+    # calculate the maximum value and last milestone:
+    max_val = 0
+    last_ms = 0
+    for lst in split_data_lines:
+        for tup in lst:
+            if tup[2] > max_val:
+                max_val = tup[2]
+            if tup[0][0] > last_ms:
+                last_ms = tup[0][0]
+    print("max_val:", max_val)
+    print("last milestone:", last_ms)
+
+    # filter out lines from selected date ranges in other date ranges:
+    filter_date_range_lines(split_data_lines, filter_date_ranges)
+
+    if with_summary:
+        return split_data_lines, max_val, last_ms, summaries
+    return split_data_lines, max_val, last_ms
+
+def load_milestone_summaries(folder, date_ranges, status=None,
+                             min_alignment_length=0, metric="alignments"):
+    """Load the summary of the reuse in each milestone of the whole text
+    (see summarize_milestones()) for each date range from the summary
+    csv files in the folder, without loading the lines of the heatmap.
+
+    If a summary has not been saved yet, the data of the whole text
+    is calculated (and saved) by load_heatmap_lines().
+
+    See ms_data_heatmap() for the arguments.
+
+    Returns:
+        list (milestone summary of each date range)
+    """
+    suffix = cache_file_suffix(status, min_alignment_length, metric)
+    summary_fps = heatmap_cache_fps(folder, date_ranges, suffix)[1]
+    if all(os.path.exists(fp) for fp in summary_fps):
+        return [load_summary_csv(fp) for fp in summary_fps]
+    return load_heatmap_lines(folder, date_ranges, status=status,
+                              min_alignment_length=min_alignment_length,
+                              metric=metric, with_summary=True)[3]
+
+def sample_lines(lines, fraction, rnd):
+    """Yield each line of an iterable of lines with probability `fraction`
+    (a Bernoulli sample); the lines between two sampled lines
+    are skipped without being looked at.
+
+    Args:
+        lines (iterator): lines (e.g., of an open file)
+        fraction (float): probability that a line is yielded
+        rnd (numpy Generator): random number generator
+    """
+    while True:
+        # the number of lines up to and including the next sampled line:
+        skip = int(rnd.geometric(fraction)) - 1
+        line = next(itertools.islice(lines, skip, None), None)
+        if line is None:
+            return
+        yield line
+
+def read_pair_file_alignments(fp, main_col, comp_col, fraction=1.0, rnd=None,
+                              srt_cache=False):
+    """Read the main milestone, start and end token of the alignments
+    in an srt file (like in the milestone json files, only the last
+    alignment with the same main milestone, comp milestone and comp_bw
+    is kept).
+
+    If `fraction` is smaller than 1, the lines of the file are sampled
+    before they are parsed (see sample_lines()), so that only
+    the sampled rows are parsed. The duplicate alignments are removed
+    after sampling: each sampled row represents 1/fraction rows
+    of the file, not 1/fraction distinct alignments.
+
+    Args:
+        fp (str): path to the srt file
+        main_col (str): is the main book bk1 or bk2 in the srt file? "1" or "2".
+        comp_col (str): is the compared book bk1 or bk2 in the srt file? "1" or "2".
+        fraction (float): if smaller than 1, each row is only read
+            with this probability
+        rnd (numpy Generator): random number generator for the row sample
+        srt_cache (bool): see open_pair_file()
+
+    Returns:
+        tuple (ms, bw, ew numpy arrays)
+    """
+    rows = dict()
+    with open_pair_file(fp, srt_cache=srt_cache) as file:
+        lines = iter(file)
+        header = next(csv.reader([next(lines, "")], delimiter="\t"), [])
+        if fraction < 1:
+            lines = sample_lines(lines, fraction, rnd)
+        for row in csv.DictReader(lines, fieldnames=header, delimiter="\t"):
+            main_ms = int(re.findall(r"\d+$", row["id"+main_col])[0])
+            comp_ms = int(re.findall(r"\d+$", row["id"+comp_col])[0])
+            rows[(main_ms, comp_ms, int(row["bw"+comp_col]))] = (
+                main_ms, int(row["bw"+main_col]), int(row["ew"+main_col]))
+    arr = np.array(list(rows.values()), dtype=np.int64).reshape(-1, 3)
+    return arr[:, 0], arr[:, 1], arr[:, 2]
+
+def stratified_total(totals, n_population):
+    """Estimate the total of a stratum from a simple random sample
+    (without replacement) of its units, and the standard error
+    of the estimate.
+
+    Args:
+        totals (list): value of each sampled unit (e.g., srt file)
+        n_population (int): number of units in the stratum
+
+    Returns:
+        tuple (estimated total, variance of the estimate)
+    """
+    n = len(totals)
+    if not n:
+        return 0.0, 0.0
+    y = np.asarray(totals, dtype=np.float64)
+    estimate = n_population * y.mean()
+    if n < 2 or n >= n_population:
+        return estimate, 0.0
+    variance = n_population**2 * (1 - n/n_population) * y.var(ddof=1) / n
+    return estimate, variance
+
+@instrumented()
+def preview_heatmap_lines(folder, date_ranges, filter_date_ranges=[],
+                          fraction=0.1, sample="files", status=None,
+                          min_alignment_length=0, metric="alignments",
+                          milestone_range=None, stratum_size=100, seed=0,
+                          srt_cache=False):
+    """Calculate a draft of the lines of the heatmap from a sample
+    of the srt files in the folder, without extracting the milestone
+    json files and without saving any data in the folder.
+
+    With `sample="files"`, the srt files of each date range are divided
+    into strata of `stratum_size` years (based on the death date of the author
+    of the compared text), and `fraction` of the files of each stratum
+    (at least 2, so that the error can be estimated) are read;
+    each alignment counts for (number of files in its stratum)
+    / (number of sampled files in the stratum).
+    With `sample="rows"`, all srt files are opened, but only `fraction`
+    of their rows are parsed (see read_pair_file_alignments()),
+    and each sampled row counts for 1/fraction
+    (not possible with the "texts" metric).
+
+    The scaled counts are rounded to integers. For each date range,
+    the total number of alignments and of reused tokens
+    (the sum of the counts of all tokens) is estimated,
+    with its standard error.
+
+    See ms_data_heatmap() for the other arguments.
+
+    Returns:
+        tuple (list of lists of lines for each date range
+            (see create_plot_lines()), max_val (int), last_ms (int),
+            list of error estimates for each date range:
+            {"date_range": ..., "sample": ..., "sampled": number of
+             sampled files (or rows), "total": number of srt files,
+             "alignments": ..., "alignments_se": ..., "reused_tokens": ...,
+             "reused_tokens_se": ..., "relative_error": standard error
+             of the reused tokens / reused tokens})
+    """
+    if sample not in ("files", "rows"):
+        raise ValueError("unknown sample type: {}".format(sample))
+    if sample == "rows" and metric == "texts":
+        raise ValueError("the texts metric cannot be estimated from a sample of rows")
+    rnd = np.random.default_rng(seed)
+    fns = [fn for fn in plan_pair_files(folder, date_ranges, status, min_alignment_length)
+           if os.path.exists(os.path.join(folder, fn))]
+    if not fns:
+        raise FileNotFoundError("no srt files for the preview in {}".format(folder))
+    main = find_main_text(folder)
+
+    # divide the srt files into strata by date range and date of the comp:
+    strata = defaultdict(list)
+    for fn in fns:
+        comp = get_pair_file_roles(fn, main)[0]
+        date = int(meta[comp.split("-")[0]]["date"])
+        x = [r[0] <= date < r[1] for r in date_ranges].index(True)
+        strata[(x, date // stratum_size)].append(fn)
+
+    # read the sampled files (or rows):
+    n_dr = len(date_ranges)
+    text_ids = dict()
+    alignments = [{"ms": [], "bw": [], "ew": [], "weight": []} for x in date_ranges]
+    estimates = [{"date_range": list(dr), "sample": sample, "sampled": 0, "total": 0,
+                  "alignments": 0.0, "alignments_se": 0.0,
+                  "reused_tokens": 0.0, "reused_tokens_se": 0.0} for dr in date_ranges]
+    variances = [[0.0, 0.0] for x in date_ranges]
+    row_fraction = fraction if sample == "rows" else 1.0
+    for (x, date_bin), stratum_fns in sorted(strata.items()):
+        n_total = len(stratum_fns)
+        if sample == "files":
+            n = min(n_total, max(2, int(np.ceil(fraction * n_total))))
+            stratum_fns = [stratum_fns[i]
+                           for i in sorted(rnd.choice(n_total, n, replace=False))]
+        weight = n_total / len(stratum_fns) / row_fraction
+        stratum = {"ms": [], "bw": [], "ew": [], "text": []}
+        file_totals = []
+        for fn in stratum_fns:
+            comp, main_col, comp_col = get_pair_file_roles(fn, main)
+            ms, bw, ew = read_pair_file_alignments(os.path.join(folder, fn),
+                                                   main_col, comp_col,
+                                                   row_fraction, rnd, srt_cache)
+            keep = ew - bw >= min_alignment_length
+            if milestone_range:
+                keep &= (milestone_range[0] <= ms) & (ms < milestone_range[1])
+            ms, bw, ew = ms[keep], bw[keep], ew[keep]
+            text = np.full(len(ms), text_ids.setdefault(comp.split("-")[0], len(text_ids)))
+            for key, arr in zip(["ms", "bw", "ew", "text"], [ms, bw, ew, text]):
+                stratum[key].append(arr)
+            if sample == "files":
+                if metric == "texts":
+                    u_ms, u_bw, u_ew = union_intervals_per_text(ms, bw, ew, text)
+                    file_totals.append((len(ms), int((u_ew - u_bw).sum())))
+                else:
+                    file_totals.append((len(ms), int((ew - bw).sum())))
+            else:
+                # Horvitz-Thompson variance of a Bernoulli sample of rows:
+                c = (1 - row_fraction) / row_fraction**2
+                variances[x][0] += c * len(ms)
+                variances[x][1] += c * float(((ew - bw)**2).sum())
+                estimates[x]["total"] += 1
+        ms, bw, ew, text = [np.concatenate(stratum[key]) for key in ["ms", "bw", "ew", "text"]]
+        if metric == "texts":
+            ms, bw, ew = union_intervals_per_text(ms, bw, ew, text)
+        a = alignments[x]
+        for key, arr in zip(["ms", "bw", "ew", "weight"],
+                            [ms, bw, ew, np.full(len(ms), weight)]):
+            a[key].append(arr)
+        if sample == "files":
+            estimates[x]["sampled"] += len(stratum_fns)
+            estimates[x]["total"] += n_total
+            for i in range(2):
+                total, var = stratified_total([t[i] for t in file_totals], n_total)
+                estimates[x][["alignments", "reused_tokens"][i]] += total
+                variances[x][i] += var
+        else:
+            estimates[x]["sampled"] += len(ms)
+            estimates[x]["alignments"] += len(ms) * weight
+            estimates[x]["reused_tokens"] += float((ew - bw).sum()) * weight
+    for x in range(n_dr):
+        est = estimates[x]
+        est["alignments_se"] = float(np.sqrt(variances[x][0]))
+        est["reused_tokens_se"] = float(np.sqrt(variances[x][1]))
+        est["relative_error"] = est["reused_tokens_se"] / est["reused_tokens"] \
+                                if est["reused_tokens"] else None
+    count_items(files=sum(e["sampled"] for e in estimates) if sample == "files"
+                else len(fns))
+
+    # calculate the scaled lines of each date range:
+    split_data_lines = []
+    for a in alignments:
+        if a["ms"]:
+            a = {key: np.concatenate(arrs) for key, arrs in a.items()}
+            ms_runs = coverage_runs(a["ms"], a["bw"], a["ew"], weights=a["weight"])
+        else:
+            ms_runs = dict()
+        split_data_lines.append([[[ms, ms], [start, end], count]
+                                 for ms in sorted(ms_runs)
+                                 for start, end, count in ms_runs[ms]])
+    max_val = max([1] + [v for lines in split_data_lines for x, y, v in lines])
+    last_ms = max([0] + [x[0] for lines in split_data_lines for x, y, v in lines])
+    filter_date_range_lines(split_data_lines, filter_date_ranges)
+    return split_data_lines, max_val, last_ms, estimates
+
+def preview_title(folder, fraction, sample, estimates):
+    """Create the title of a preview heatmap, with the estimated
+    relative error of the reuse in each date range."""
+    errors = ["{}-{} AH: {}".format(*e["date_range"],
+                                    "±{:.0%}".format(e["relative_error"])
+                                    if e["relative_error"] is not None else "no data")
+              for e in estimates]
+    return "{} - PREVIEW ({:.0%} of the srt {} sampled; counts scaled up). " \
+           "Estimated error: {}".format(os.path.split(folder)[-1], fraction,
+                                        "files" if sample == "files" else "rows",
+                                        ", ".join(errors))
+
+@instrumented()
+def ms_data_heatmap(folder, date_ranges=[(0, 1501),], filter_date_ranges=[],
+                    cmap=plt.cm.autumn_r, plot_func=plot_with_matplotlib,
+                    outfp=None, status=None, min_alignment_length=0,
+                    metric="alignments", contributors=0, text_filter=False,
+                    mode=None, overview=False, milestone_range=None,
+                    show_plot=True, preview=None, preview_sample="files"):
+    """Visualize the frequency of reuse of each token in a text
+    by a heat map. 
+
+    Args:
+        folder (str): path to folder containing the milestone files.
+            Ideally, the folder has the URI of the text as name.
+        date_ranges (list): list of tuples (start_date (int), end_date (int))
+            for each date range for which the reuse data should be
+            visualized in a separate graph.
+            NB: start date is inclusive, end date exclusive:
+            with [(0, 300), (300, 1501)] 300 will be included in the second graph.
+        filter_date_ranges (list): list of index numbers of the date_ranges list
+            for which the reuse data should be
+            filtered out from the later graphs (mostly used for displaying
+            only text reuse that the text itself did not reuse from other sources)
+        cmap (Matplotlib color map): Matplot lib color map to be used
+            for the heatmap: see
+            https://matplotlib.org/stable/tutorials/colors/colormaps.html
+        plot_func (function): function to be used to plot the data.
+        outfp (str): graph will be saved to file if a path is provided.
+            Default: None.
+        status (str or list): only include reuse by texts with this status
+            in the metadata (e.g., "pri"). Default: None (all texts)
+        min_alignment_length (int): only include alignments that cover
+            at least this number of tokens in the main text. Default: 0
+        metric (str): value to be plotted for each token:
+            "alignments" (the number of alignments that cover the token;
+            default) or "texts" (the number of distinct texts
+            that reuse the token)
+        contributors (int): if larger than 0, the hover tooltip of each line
+            shows this number of texts that reuse it most
+            (only for plot_with_bokeh, and not together with `text_filter`
+            or sidecar mode; the contributor index for each
+            date range is saved in the folder). Default: 0
+        text_filter (bool): if True, add a widget for selecting
+            the reusing texts to be displayed; the heatmap is recalculated
+            in the browser when the selection changes
+            (only for plot_with_bokeh). Default: False
+        mode (str): Bokeh resources mode for the html file
+            (only for plot_with_bokeh): e.g., "inline", "cdn", or "sidecar"
+            (the plot data is written to binary files next to the html file
+            instead of being embedded in it, see save_with_sidecar_data();
+            the contributors cannot be shown in this mode). Default: None
+            (the default of the plot function)
+        overview (bool): if True, display an overview of the reuse
+            in every milestone above the heatmap, with a range tool to select
+            the milestones shown in the heatmap (only for plot_with_bokeh;
+            the summary of each date range is saved in the folder
+            as a csv file). With a `milestone_range`, the overview
+            still shows the whole text (see load_milestone_summaries()),
+            and the range tool selects the window. Default: False
+        milestone_range (tuple): (first milestone, last milestone (exclusive)):
+            only calculate and display the heatmap for these milestones
+            (only the data of these milestones is read). Default: None
+            (the whole text)
+        show_plot (bool): if False, the graph is only saved to `outfp`,
+            not displayed (e.g., for batch or benchmark runs);
+            in sidecar mode, the graph is displayed through a local
+            web server. Default: True
+        preview (float): if provided, draw a quick draft of the heatmap
+            from this fraction of the srt files (or rows) in the folder,
+            with the counts scaled up and the estimated error of each
+            date range in the title (see preview_heatmap_lines());
+            nothing is saved in the folder, and the contributors,
+            text filter and overview are not shown. Default: None
+        preview_sample (str): "files" (sample srt files, stratified
+            by the date of the compared text) or "rows" (sample rows
+            of all srt files). Default: "files"
+
+    Returns:
+        the plot created by `plot_func` (a Bokeh layout for plot_with_bokeh,
+            a matplotlib figure for plot_with_matplotlib)
+    """
+    if plot_func is not plot_with_bokeh:
+        bokeh_options = [name for name, value in [("contributors", contributors),
+                                                  ("text_filter", text_filter),
+                                                  ("mode", mode),
+                                                  ("overview", overview)]
+                         if value]
+        if bokeh_options:
+            raise ValueError("{} can only be used with plot_with_bokeh".format(
+                ", ".join(bokeh_options)))
+    if contributors and (text_filter or mode == "sidecar") and not preview:
+        raise ValueError("contributors cannot be shown with the text filter or in sidecar mode")
+    plot_kwargs = dict()
+    title = os.path.split(folder)[-1]
+    if preview:
+        split_data_lines, max_val, last_ms, estimates = preview_heatmap_lines(
+            folder, date_ranges, filter_date_ranges, fraction=preview,
+            sample=preview_sample, status=status,
+            min_alignment_length=min_alignment_length, metric=metric,
+            milestone_range=milestone_range)
+        for e in estimates:
+            print("{}-{}: {:.0f} ± {:.0f} reused tokens, {:.0f} ± {:.0f} alignments".format(
+                *e["date_range"], e["reused_tokens"], e["reused_tokens_se"],
+                e["alignments"], e["alignments_se"]))
+        title = preview_title(folder, preview, preview_sample, estimates)
+        contributors, text_filter, overview = 0, False, False
+    else:
+        result = load_heatmap_lines(folder, date_ranges, filter_date_ranges, status=status,
+                                    min_alignment_length=min_alignment_length,
+                                    metric=metric,
+                                    with_summary=overview and not milestone_range,
+                                    milestone_range=milestone_range)
+        split_data_lines, max_val, last_ms = result[:3]
+    if overview and milestone_range:
+        plot_kwargs["summaries"] = load_milestone_summaries(
+            folder, date_ranges, status=status,
+            min_alignment_length=min_alignment_length, metric=metric)
+    elif overview:
+        plot_kwargs["summaries"] = result[3]
+    if milestone_range:
+        plot_kwargs["milestone_range"] = milestone_range
+    index_suffix = cache_file_suffix(status, min_alignment_length,
+                                     milestone_range=milestone_range)
+
+    if contributors:
+        # load or build the index of the texts that reuse each token:
+        index_fps = [os.path.join(folder, "contributors_{}_{}{}.npz".format(*dr, index_suffix))
+                     for dr in date_ranges]
+        missing = [i for i, fp in enumerate(index_fps) if not os.path.exists(fp)]
+        with ExitStack() as stack:
+            for i in sorted(missing, key=lambda i: index_fps[i]):
+                stack.enter_context(file_lock(index_fps[i]))
+            # another process may have built the indexes in the meantime:
+            missing = [i for i in missing if not os.path.exists(index_fps[i])]
+            if missing:
+                indexes = build_contributor_indexes(folder, [date_ranges[i] for i in missing],
+                                                    status=status,
+                                                    min_alignment_length=min_alignment_length,
+                                                    milestone_range=milestone_range)
+                for i, index in zip(missing, indexes):
+                    save_contributor_index(index, index_fps[i])
+        plot_kwargs["contributor_indexes"] = [load_contributor_index(fp) for fp in index_fps]
+        plot_kwargs["top_n"] = contributors
+    if text_filter:
+        print("Building index of the tokens reused by each text...")
+        alignments, text_ids = load_alignments(folder, date_ranges, status=status,
+                                               min_alignment_length=min_alignment_length,
+                                               milestone_range=milestone_range)
+        with stage("build_group_runs") as items:
+            plot_kwargs["text_runs"] = [build_group_runs(a["ms"], a["bw"], a["ew"], a["text"],
+                                                         texts=a["text"], metric=metric)
+                                        for a in alignments]
+            items["alignments"] = sum(len(a["ms"]) for a in alignments)
+        plot_kwargs["text_ids"] = text_ids
+    if mode:
+        plot_kwargs["mode"] = mode
+
+    value_label = "reusing texts" if metric == "texts" else "reuse cases"
+    return plot_func(date_ranges, split_data_lines, max_val, last_ms, cmap, outfp,
+                     filter_date_ranges=filter_date_ranges, value_label=value_label,
+                     title=title, show_plot=show_plot,
+                     **plot_kwargs)
+
+def date_slider_heatmap(folder, bin_size=25, start_date=0, end_date=1501,
+                        cmap=inferno, outfp=None, status=None,
+                        min_alignment_length=0, metric="alignments",
+                        mode="inline", show_plot=True):
+    """Create a single interactive Bokeh heatmap in which the date range
+    of the reusing texts can be chosen with a slider,
+    instead of a separate graph (and html file) for each date range.
+
+    The runs of reused tokens of the texts in each date bin
+    (see build_group_runs()) are embedded in the html file as binary arrays;
+    when the slider is moved, the runs of the selected bins are summed
+    in the browser and the heatmap is redrawn. A checkbox allows
+    filtering out the tokens reused by texts from before the selected range
+    (as filter_date_ranges does in ms_data_heatmap()).
+
+    Args:
+        folder (str): path to the folder containing the milestone files
+            (or alignment store)
+        bin_size (int): number of years in each date bin
+            (the step size of the slider)
+        start_date (int): earliest date to be included
+        end_date (int): latest date to be included (exclusive)
+        cmap (function): Bokeh palette function (e.g., inferno)
+        outfp (str): path to the html file. Default: None (not saved)
+        status (str or list): only include reuse by texts with this status
+            in the metadata (e.g., "pri"). Default: None (all texts)
+        min_alignment_length (int): only include alignments that cover
+            at least this number of tokens in the main text. Default: 0
+        metric (str): "alignments" or "texts" (see ms_data_heatmap())
+        mode (str): Bokeh resources mode for the html file
+            (or "sidecar": see save_with_sidecar_data())
+        show_plot (bool): if False, the plot is only saved, not opened
+            (in sidecar mode, it is opened through a local web server)
+
+    Returns:
+        Bokeh layout
+    """
+    alignments, text_ids = load_alignments(folder, [(start_date, end_date)],
+                                           status=status,
+                                           min_alignment_length=min_alignment_length,
+                                           columns=["comp_date"])
+    a = alignments[0]
+    bins = (np.asarray(a["comp_date"], dtype=np.int64) - start_date) // bin_size
+    print("Calculating reused tokens for each date bin...")
+    runs = build_group_runs(a["ms"], a["bw"], a["ew"], bins, texts=a["text"],
+                            metric=metric)
+
+    # start with the heatmap for the whole date range:
+    ms, bw, ew = a["ms"], a["bw"], a["ew"]
+    if metric == "texts":
+        ms, bw, ew = union_intervals_per_text(ms, bw, ew, a["text"])
+    ms_runs = coverage_runs(ms, bw, ew)
+    line_data = [[ms, start, end, count] for ms in ms_runs
+                 for start, end, count in ms_runs[ms]]
+    data = {"x0": [l[0] for l in line_data], "x1": [l[0] for l in line_data],
+            "y0": [l[1] for l in line_data], "y1": [l[2] for l in line_data],
+            "val": [l[3] for l in line_data]}
+    if mode == "sidecar":
+        sidecar = {"lines": data, "runs": runs}
+        source = ColumnDataSource(data={k: [] for k in data}, name="lines")
+        run_source = ColumnDataSource(data={k: [] for k in runs}, name="runs")
+    else:
+        source = ColumnDataSource(data=data)
+        run_source = ColumnDataSource(data=runs)
+    max_val = max([1] + [l[3] for l in line_data])
+    last_ms = max([0] + [l[0] for l in line_data])
+    max_token = max([300] + [l[2] for l in line_data])
+
+    palette = list(cmap(max_val))
+    palette.reverse()
+    color_mapper = LinearColorMapper(palette=palette, low=0.5, high=max_val+0.5)
+    ax = figure(plot_width=250, plot_height=400,
+                tools="pan,wheel_zoom,box_zoom,reset,tap")
+    ax.background_fill_color = "grey"
+    ax.background_fill_alpha = 0.3
+    ax.segment("x0", "y0", "x1", "y1", source=source,
+               color={"field": "val", "transform": color_mapper},
+               nonselection_line_width=1, selection_line_width=3)
+    ax.add_layout(ColorBar(color_mapper=color_mapper, label_standoff=12), "right")
+    title_fmt = "Reuse of texts by authors who died between {} and {} AH"
+    n_bins = -(-(end_date - start_date) // bin_size)
+    title = Title(text=title_fmt.format(start_date, start_date + n_bins*bin_size),
+                  text_font_size="12pt")
+    ax.add_layout(title, "above")
+    ax.add_layout(Title(text=os.path.split(folder)[-1], text_font_size="16pt"), "above")
+    value_label = "reusing texts" if metric == "texts" else "reuse cases"
+    ax.add_tools(HoverTool(tooltips=[(value_label, "@val")]))
+    ax.toolbar.active_scroll = ax.select_one(WheelZoomTool)
+    ax.x_range.start = 0
+    ax.x_range.end = last_ms + 10
+    ax.y_range.start = 0
+    ax.y_range.end = max_token
+    ax.sizing_mode = "stretch_width"
+
+    # add the slider and filter checkbox:
+    slider = RangeSlider(start=start_date, end=start_date + n_bins*bin_size,
+                         step=bin_size, value=(start_date, start_date + n_bins*bin_size),
+                         title="Death date of the reusing authors (AH)",
+                         sizing_mode="stretch_width")
+    checkbox = CheckboxGroup(labels=["Filter out reuse by authors who died before the selected range"],
+                             active=[])
+    W = max(max_token, int(runs["end"].max()) if len(runs["end"]) else 0) + 2
+    callback = CustomJS(args=dict(slider=slider, filter=checkbox,
+                                  runs=run_source, source=source,
+                                  color_mapper=color_mapper, title=title,
+                                  title_fmt=title_fmt, start_date=start_date,
+                                  bin_size=bin_size, W=W),
+                        code=DATE_SLIDER_JS)
+    slider.js_on_change("value_throttled", callback)
+    checkbox.js_on_change("active", callback)
+
+    c = column(slider, checkbox, ax, sizing_mode="stretch_width")
+    if mode == "sidecar":
+        save_with_sidecar_data(c, outfp, sidecar, show_plot=show_plot)
+        return c
+    if outfp:
+        output_file(outfp, mode=mode)
+        save(c)
+    if show_plot:
+        show(c)
+    return c
+
+def lines_to_arrays(line_data):
+    """Convert a list of heatmap lines (see create_plot_lines())
+    into a dictionary of int32 arrays "x", "y0", "y1", "val",
+    sorted by milestone and start token."""
+    arr = np.array([[x[0], y[0], y[1], v] for x, y, v in line_data],
+                   dtype=np.int32).reshape(-1, 4)
+    arr = arr[np.lexsort((arr[:, 1], arr[:, 0]))]
+    return {"x": arr[:, 0], "y0": arr[:, 1], "y1": arr[:, 2], "val": arr[:, 3]}
+
+def max_grid(lines, ms_start, step, n_columns, token_bin=1, n_bins=None):
+    """Downsample heatmap lines into a grid of (groups of) milestones
+    by (groups of) tokens, keeping the highest value in each cell
+    (so that hotspots of reuse remain visible when zoomed out).
+
+    Args:
+        lines (dict): lines of the heatmap (see lines_to_arrays())
+        ms_start (int): first milestone of the grid
+        step (int): number of milestones in each column of the grid
+        n_columns (int): number of columns of the grid
+        token_bin (int): number of tokens in each row of the grid
+        n_bins (int): number of rows of the grid
+            (default: enough for the highest token in the lines)
+
+    Returns:
+        2D int32 array (n_columns x n_bins)
+    """
+    lo, hi = np.searchsorted(lines["x"], [ms_start, ms_start + step*n_columns])
+    x = lines["x"][lo:hi].astype(np.int64)
+    # rows y0 to y1 (exclusive) of the grid, like the tokens of the lines:
+    y0 = lines["y0"][lo:hi].astype(np.int64) // token_bin
+    y1 = -(-lines["y1"][lo:hi].astype(np.int64) // token_bin)
+    if n_bins is None:
+        n_bins = int(y1.max()) if len(y1) else 1
+    y1 = np.minimum(y1, n_bins)
+    keep = y0 < y1
+    x, y0, y1, val = x[keep], y0[keep], y1[keep], lines["val"][lo:hi][keep]
+    # expand every line into the cells it covers:
+    n_cells = y1 - y0
+    first = np.repeat(np.cumsum(n_cells) - n_cells, n_cells)
+    rows = np.repeat(y0, n_cells) + (np.arange(n_cells.sum()) - first)
+    cols = np.repeat((x - ms_start) // step, n_cells)
+    grid = np.zeros(n_columns * n_bins, dtype=np.int32)
+    np.maximum.at(grid, cols*n_bins + rows, np.repeat(val, n_cells))
+    return grid.reshape(n_columns, n_bins)
+
+def render_tile(lines, level, tile, tile_columns=TILE_COLUMNS):
+    """Create the lines of a tile of the heatmap at a level of detail.
+
+    At level 0, the tile contains the exact lines of `tile_columns`
+    milestones; at higher levels, each column of the tile
+    represents 2**level milestones, and contains the highest value
+    of these milestones for each token (see max_grid()).
+    At every level, y1 is the end token of each line (exclusive).
+
+    Args:
+        lines (dict): lines of the heatmap (see lines_to_arrays())
+        level (int): level of detail
+        tile (int): index of the tile at that level
+        tile_columns (int): number of columns in each tile
+
+    Returns:
+        bytes (int32 arrays x, y0, y1, val, one after the other)
+    """
+    step = 2**level
+    ms_start = tile * tile_columns * step
+    if level == 0:
+        lo, hi = np.searchsorted(lines["x"], [ms_start, ms_start + tile_columns])
+        cols = [lines[k][lo:hi] for k in ["x", "y0", "y1", "val"]]
+    else:
+        grid = max_grid(lines, ms_start, step, tile_columns)
+        # merge consecutive tokens with the same value into a single line:
+        prev = np.zeros_like(grid)
+        prev[:, 1:] = grid[:, :-1]
+        nxt = np.zeros_like(grid)
+        nxt[:, :-1] = grid[:, 1:]
+        c, y0 = np.nonzero((grid > 0) & (grid != prev))
+        _, y1 = np.nonzero((grid > 0) & (grid != nxt))
+        cols = [ms_start + c*step + step//2, y0, y1 + 1, grid[c, y0]]
+    return b"".join(np.asarray(col, dtype="<i4").tobytes() for col in cols)
+
+def serve_heatmap(folder, date_ranges=[(0, 1501),], filter_date_ranges=[],
+                  cmap=inferno, status=None, min_alignment_length=0,
+                  metric="alignments", port=8765, cache_size=1024,
+                  open_browser=True):
+    """Serve an interactive heatmap from a local web server.
+
+    Instead of embedding all lines in the html file, the page requests
+    tiles of the visible part of the heatmap at a level of detail
+    that matches the zoom level (see render_tile()); rendered tiles
+    are kept in an LRU cache. Double-clicking on a milestone shows
+    the alignments in that milestone (see milestone_alignments()).
+
+    The server runs until it is interrupted (ctrl+C).
+
+    Args:
+        folder (str): path to the folder containing the milestone files
+            (or alignment store)
+        date_ranges, filter_date_ranges, status, min_alignment_length,
+            metric: see ms_data_heatmap()
+        cmap (function): Bokeh palette function (e.g., inferno)
+        port (int): port of the server (on localhost)
+        cache_size (int): number of tiles kept in the cache
+        open_browser (bool): if True, open the page in the web browser
+    """
+    split_data_lines, max_val, last_ms = load_heatmap_lines(
+        folder, date_ranges, filter_date_ranges, status=status,
+        min_alignment_length=min_alignment_length, metric=metric)
+    split_lines = [lines_to_arrays(line_data) for line_data in split_data_lines]
+    max_token = max([300] + [int(lines["y1"].max()) for lines in split_lines
+                             if len(lines["y1"])])
+
+    @functools.lru_cache(maxsize=cache_size)
+    def get_tile(i, level, tile):
+        return render_tile(split_lines[i], level, tile)
+
+    # create the page:
+    palette = list(cmap(max(max_val, 1)))
+    palette.reverse()
+    color_mapper = LinearColorMapper(palette=palette, low=0.5, high=max_val+0.5)
+    value_label = "reusing texts" if metric == "texts" else "reuse cases"
+    title_fmt = "Reuse of texts by authors who died between {} and {} AH"
+    details = Div(text="Double-click on a milestone to list its alignments",
+                  sizing_mode="stretch_width")
+    axes = []
+    for i, dr in enumerate(date_ranges):
+        ax = figure(plot_width=250, plot_height=250, name="panel_{}".format(i),
+                    tools="pan,wheel_zoom,box_zoom,reset")
+        ax.background_fill_color = "grey"
+        ax.background_fill_alpha = 0.3
+        title = title_fmt.format(*dr)
+        filtered = [date_ranges[j] for j in filter_date_ranges if i > j]
+        if filtered:
+            filtered = ", ".join(["{}-{} AH".format(*dr) for dr in filtered])
+            title += " (text reuse from previous date range(s) filtered out: {})".format(filtered)
+        ax.add_layout(Title(text=title, text_font_size="12pt"), "above")
+        source = ColumnDataSource(data={k: [] for k in ["x0", "x1", "y0", "y1", "val"]},
+                                  name="lines_{}".format(i))
+        ax.segment("x0", "y0", "x1", "y1", source=source,
+                   color={"field": "val", "transform": color_mapper})
+        ax.add_layout(ColorBar(color_mapper=color_mapper, label_standoff=12), "right")
+        ax.add_tools(HoverTool(tooltips=[(value_label, "@val")], line_policy="interp"))
+        ax.toolbar.active_scroll = ax.select_one(WheelZoomTool)
+        ax.x_range.start = 0
+        ax.x_range.end = last_ms + 10
+        ax.y_range.start = 0
+        ax.y_range.end = max_token
+        ax.sizing_mode = "stretch_width"
+        ax.x_range.js_on_change("end", CustomJS(args=dict(i=i), code="""
+clearTimeout(window["heatmap_timer_" + i]);
+window["heatmap_timer_" + i] = setTimeout(() => heatmap_load_tiles(Bokeh.documents[0], i), 200);
+"""))
+        ax.js_on_event(DoubleTap, CustomJS(args=dict(div=details, i=i), code="""
+heatmap_show_alignments(div, i, Math.round(cb_obj.x));
+"""))
+        axes.append(ax)
+    axes[0].add_layout(Title(text=os.path.split(folder)[-1], text_font_size="16pt"), "above")
+    html = file_html(grid([[ax] for ax in axes] + [[details]]),
+                     Resources(mode="server", root_url="/"),
+                     title=os.path.split(folder)[-1])
+    script = "<script type=\"text/javascript\">{}</script>\n".format(
+        TILE_LOADER_JS % (TILE_COLUMNS, len(date_ranges)))
+    page = html.replace("</body>", script + "</body>").encode("utf-8")
+    static_folder = os.path.abspath(bokehjsdir())
+
+    class HeatmapRequestHandler(BaseHTTPRequestHandler):
+        def send(self, body, content_type):
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            path = unquote(self.path.split("?")[0])
+            parts = path.strip("/").split("/")
+            try:
+                if path == "/":
+                    self.send(page, "text/html; charset=utf-8")
+                elif parts[0] == "tiles" and len(parts) == 4:
+                    i, level, tile = [int(p) for p in parts[1:]]
+                    self.send(get_tile(i, level, tile), "application/octet-stream")
+                elif parts[0] == "milestone" and len(parts) == 3:
+                    i, ms = int(parts[1]), int(parts[2])
+                    rows = milestone_alignments(folder, ms, [date_ranges[i]], status=status,
+                                                min_alignment_length=min_alignment_length)
+                    self.send(json.dumps(rows, ensure_ascii=False).encode("utf-8"),
+                              "application/json")
+                elif parts[0] == "static":
+                    fp = os.path.abspath(os.path.join(static_folder, *parts[1:]))
+                    if not fp.startswith(static_folder + os.sep) or not os.path.isfile(fp):
+                        raise FileNotFoundError(path)
+                    with open(fp, mode="rb") as file:
+                        self.send(file.read(), "text/javascript")
+                else:
+                    raise FileNotFoundError(path)
+            except (ValueError, IndexError, FileNotFoundError):
+                self.send_error(404)
+            except Exception:
+                traceback.print_exc()
+                self.send_error(500)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), HeatmapRequestHandler)
+    url = "http://127.0.0.1:{}/".format(port)
+    print("Serving the heatmap at", url, "(press ctrl+C to stop)")
+    if open_browser:
+        webbrowser.open(url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def reduce_grid(grid):
+    """Halve the number of columns of a heatmap grid (see max_grid())
+    by taking the maximum of every two consecutive columns."""
+    if len(grid) % 2:
+        grid = np.concatenate([grid, np.zeros((1, grid.shape[1]), dtype=grid.dtype)])
+    return np.maximum(grid[0::2], grid[1::2])
+
+def save_tile_images(grid, level, first_tile, outfolder, cmap, max_val,
+                     tile_size=256):
+    """Save a heatmap grid (milestone columns x token rows) as PNG tiles
+    of tile_size x tile_size pixels; empty tiles are not saved.
+
+    Args:
+        grid (2D array): values of the grid (see max_grid()); the number
+            of columns must be a multiple of tile_size
+        level (int): level of the grid in the tile pyramid
+        first_tile (int): horizontal index of the first tile in the grid
+        outfolder (str): path to the folder of the tile pyramid
+        cmap (Matplotlib color map): color map of the heatmap
+        max_val (int): value that gets the last color of the color map
+        tile_size (int): width and height of the tiles in pixels
+
+    Returns:
+        list (names of the saved tiles, e.g. "3_0")
+    """
+    level_folder = os.path.join(outfolder, str(level))
+    os.makedirs(level_folder, exist_ok=True)
+    n_rows = -(-grid.shape[1] // tile_size) * tile_size
+    if n_rows > grid.shape[1]:
+        grid = np.pad(grid, ((0, 0), (0, n_rows - grid.shape[1])))
+    saved = []
+    for i in range(len(grid) // tile_size):
+        for ty in range(n_rows // tile_size):
+            block = grid[i*tile_size:(i+1)*tile_size, ty*tile_size:(ty+1)*tile_size]
+            if not block.any():
+                continue
+            # rows of the image are tokens, with the first token at the bottom:
+            rgba = cmap(block.T / max_val)
+            rgba[..., 3] = block.T > 0
+            name = "{}_{}".format(first_tile + i, ty)
+            plt.imsave(os.path.join(level_folder, name + ".png"), rgba, origin="lower")
+            saved.append(name)
+    return saved
+
+def render_pyramid_chunk(lines, first_tile, chunk_level, n_tokens, outfolder,
+                         cmap, max_val, tile_size=256):
+    """Render the tiles of the levels 0 to `chunk_level` of a tile pyramid
+    for a chunk of tile_size * 2**chunk_level milestones
+    (the unit of work of the worker processes in export_tile_pyramid()).
+
+    Args:
+        lines (dict): lines of the heatmap (see lines_to_arrays())
+        first_tile (int): index of the first level 0 tile of the chunk
+        chunk_level (int): highest level to be rendered
+        n_tokens (int): number of token rows of the grid
+        outfolder, cmap, max_val, tile_size: see save_tile_images()
+
+    Returns:
+        tuple (grid of the chunk at chunk_level,
+               dict of the names of the saved tiles at each level)
+    """
+    n_columns = tile_size * 2**chunk_level
+    grid = max_grid(lines, first_tile * tile_size, 1, n_columns, n_bins=n_tokens)
+    saved = dict()
+    for level in range(chunk_level + 1):
+        if level:
+            grid = reduce_grid(grid)
+        saved[level] = save_tile_images(grid, level, first_tile >> level, outfolder,
+                                        cmap, max_val, tile_size)
+    return grid, saved
+
+def export_tile_pyramid(folder, outfolder=None, date_ranges=[(0, 1501),],
+                        filter_date_ranges=[], cmap=plt.cm.inferno_r,
+                        status=None, min_alignment_length=0,
+                        metric="alignments", tile_size=256, workers=None,
+                        executor="process"):
+    """Export the heatmap of each date range as a pyramid of PNG tiles,
+    with a static viewer page, so that even the heatmaps of very long texts
+    can be explored at full resolution in the browser.
+
+    At level 0, every pixel column of the tiles represents a milestone
+    and every pixel row a token; at every higher level, the number of
+    milestones per pixel column is doubled, keeping the highest value
+    (the number of tokens per pixel row stays the same; the viewer
+    stretches the token axis to the height of the view).
+
+    The tiles of the lower levels are rendered in chunks of milestones
+    in parallel worker processes; the highest levels are created
+    from the chunks' lowest-resolution grids.
+
+    Args:
+        folder (str): path to the folder containing the milestone files
+            (or alignment store)
+        outfolder (str): path to the output folder (default: a "tiles"
+            folder inside `folder`); the pyramid of every date range is
+            saved in a subfolder (e.g., "0_300"), with an index.html viewer
+        date_ranges, filter_date_ranges, status, min_alignment_length,
+            metric: see ms_data_heatmap()
+        cmap (Matplotlib color map): color map of the heatmap
+        tile_size (int): width and height of the tiles in pixels
+        workers (int): number of worker processes (default: number of CPUs)
+        executor (str): "process" or "thread"
+    """
+    if outfolder is None:
+        outfolder = os.path.join(folder, "tiles")
+    split_data_lines, max_val, last_ms = load_heatmap_lines(
+        folder, date_ranges, filter_date_ranges, status=status,
+        min_alignment_length=min_alignment_length, metric=metric)
+    split_lines = [lines_to_arrays(line_data) for line_data in split_data_lines]
+    n_tokens = max([300] + [int(lines["y1"].max()) + 1 for lines in split_lines
+                            if len(lines["y1"])])
+    n_tiles = -(-(last_ms + 1) // tile_size)
+    levels = max(1, int(np.ceil(np.log2(n_tiles))) + 1)
+    workers = workers or os.cpu_count() or 1
+    # make chunks large enough that the workers get about 4 chunks each:
+    chunk_level = max(0, min(levels - 1, int(np.log2(max(1, n_tiles / (4*workers))))))
+    chunk_tiles = 2**chunk_level
+    value_label = "reusing texts" if metric == "texts" else "reuse cases"
+
+    pool_class = ProcessPoolExecutor if executor == "process" else ThreadPoolExecutor
+    for dr, lines in zip(date_ranges, split_lines):
+        range_folder = os.path.join(outfolder, "{}_{}".format(*dr))
+        print("Rendering tile pyramid for date range", dr)
+        chunks = []
+        for first_tile in range(0, n_tiles, chunk_tiles):
+            lo, hi = np.searchsorted(lines["x"], [first_tile * tile_size,
+                                                  (first_tile + chunk_tiles) * tile_size])
+            chunks.append(({k: v[lo:hi] for k, v in lines.items()}, first_tile,
+                           chunk_level, n_tokens, range_folder, cmap, max_val, tile_size))
+        if workers == 1:
+            results = [render_pyramid_chunk(*args) for args in tqdm(chunks)]
+        else:
+            with pool_class(max_workers=workers) as pool:
+                futures = [pool.submit(render_pyramid_chunk, *args) for args in chunks]
+                for future in tqdm(as_completed(futures), total=len(futures)):
+                    pass
+                results = [future.result() for future in futures]
+        tiles = [[] for level in range(levels)]
+        for grid, saved in results:
+            for level, names in saved.items():
+                tiles[level] += names
+        # create the higher levels from the chunks' grids:
+        grid = np.concatenate([grid for grid, saved in results])
+        for level in range(chunk_level + 1, levels):
+            grid = reduce_grid(grid)
+            if len(grid) % tile_size:
+                grid = np.pad(grid, ((0, tile_size - len(grid) % tile_size), (0, 0)))
+            tiles[level] = save_tile_images(grid, level, 0, range_folder,
+                                            cmap, max_val, tile_size)
+        # save the viewer:
+        title = "{}: reuse of texts by authors who died between {} and {} AH".format(
+            os.path.split(folder)[-1], *dr)
+        info = {"levels": levels, "tile_size": tile_size, "n_ms": last_ms + 1,
+                "n_tokens": n_tokens, "tiles_y": -(-n_tokens // tile_size),
+                "max_val": max_val, "value_label": value_label, "tiles": tiles}
+        with open(os.path.join(range_folder, "index.html"), mode="w", encoding="utf-8") as file:
+            file.write(TILE_VIEWER_HTML % {"title": title, "info": json.dumps(info)})
+        print("Saved", sum(len(t) for t in tiles), "tiles in", range_folder)
+
+def alignment_dot_plot(folder, comp=None, date_range=(0, 1501), status=None,
+                       min_alignment_length=0, bins=(1000, 1000), cmap=inferno,
+                       outfp=None, mode="inline", milestone_range=None,
+                       show_plot=True):
+    """Plot the milestones of the main text against the milestones
+    of the texts that reuse it, as a density image: the alignments are
+    counted in a fixed grid of bins (numpy.histogram2d), so that the cost
+    of drawing does not depend on the number of alignments.
+
+    Args:
+        folder (str): path to the folder containing the milestone files
+            (or alignment store)
+        comp (str): id of the reusing text to be plotted (e.g.,
+            "Shamela0009788"); if None, all texts in the date range
+            are stacked on the y axis, in chronological order
+        date_range (tuple): (start_date, end_date) of the reusing texts
+        status (str or list): only include reuse by texts with this status
+            in the metadata (e.g., "pri"). Default: None (all texts)
+        min_alignment_length (int): only include alignments that cover
+            at least this number of tokens in the main text. Default: 0
+        bins (tuple): maximum number of bins along the x and y axis
+        cmap (function): Bokeh palette function (e.g., inferno)
+        outfp (str): path to the html file. Default: None (not saved)
+        mode (str): Bokeh resources mode for the html file
+        milestone_range (tuple): (first milestone, last milestone (exclusive))
+            of the main text to be included. Default: None (all milestones)
+        show_plot (bool): if False, the plot is only saved, not opened
+
+    Returns:
+        Bokeh figure
+    """
+    alignments, text_ids = load_alignments(folder, [date_range], status=status,
+                                           min_alignment_length=min_alignment_length,
+                                           columns=["comp_ms"],
+                                           milestone_range=milestone_range)
+    a = alignments[0]
+    x = np.asarray(a["ms"], dtype=np.int64)
+    comp_ms = np.asarray(a["comp_ms"], dtype=np.int64)
+    texts = np.asarray(a["text"], dtype=np.int64)
+    if comp:
+        comp = comp.split("-")[0]
+        keep = texts == (text_ids.index(comp) if comp in text_ids else -1)
+        x, y = x[keep], comp_ms[keep]
+        order = [text_ids.index(comp)] if keep.any() else []
+        offsets = np.zeros(len(text_ids), dtype=np.int64)
+    else:
+        # stack the milestones of all texts, in chronological order:
+        order = sorted(set(texts.tolist()),
+                       key=lambda t: (int(meta.get(text_ids[t], {}).get("date", 0)), text_ids[t]))
+        n_ms = np.zeros(len(text_ids), dtype=np.int64)
+        np.maximum.at(n_ms, texts, comp_ms + 1)
+        offsets = np.zeros(len(text_ids), dtype=np.int64)
+        offsets[order] = np.cumsum(n_ms[order]) - n_ms[order]
+        y = offsets[texts] + comp_ms
+    x_start, x_end = milestone_range or (0, int(x.max()) + 1 if len(x) else 1)
+    y_end = int(y.max()) + 1 if len(y) else 1
+    nx = max(1, min(bins[0], x_end - x_start))
+    ny = max(1, min(bins[1], y_end))
+    counts, x_edges, y_edges = np.histogram2d(x, y, bins=(nx, ny),
+                                              range=[[x_start, x_end], [0, y_end]])
+    image = counts.T
+    image[image == 0] = np.nan
+    max_count = int(np.nanmax(image)) if len(x) else 1
+    print("Plotted", len(x), "alignments in a", nx, "x", ny, "grid")
+
+    palette = list(cmap(256))
+    palette.reverse()
+    color_mapper = LogColorMapper(palette=palette, low=1, high=max(max_count, 2),
+                                  nan_color="rgba(0, 0, 0, 0)")
+    ax = figure(plot_width=800, plot_height=600, x_range=(x_start, x_end),
+                y_range=(0, y_end), tools="pan,wheel_zoom,box_zoom,reset",
+                sizing_mode="stretch_width")
+    ax.background_fill_color = "grey"
+    ax.background_fill_alpha = 0.1
+    ax.image(image=[image], x=x_start, y=0, dw=x_end - x_start, dh=y_end,
+             color_mapper=color_mapper)
+    ax.add_layout(ColorBar(color_mapper=color_mapper, label_standoff=12), "right")
+    ax.xaxis.axis_label = "milestone in {}".format(os.path.split(folder)[-1])
+    if comp:
+        ax.yaxis.axis_label = "milestone in {}".format(describe_text(comp))
+    else:
+        ax.yaxis.axis_label = "milestones of the reusing texts (chronological)"
+        # mark the start of every text on the y axis:
+        ax.yaxis.ticker = FixedTicker(ticks=offsets[order].tolist())
+        ax.yaxis.major_label_overrides = {int(offsets[t]): text_ids[t] for t in order}
+        ax.yaxis.major_label_text_font_size = "7pt"
+        ax.ygrid.ticker = ax.yaxis.ticker
+    ax.add_tools(HoverTool(tooltips=[("milestone", "$x{0}"), ("comp. milestone", "$y{0}"),
+                                     ("alignments", "@image")]))
+    ax.toolbar.active_scroll = ax.select_one(WheelZoomTool)
+    title = "Alignments with texts by authors who died between {} and {} AH".format(*date_range)
+    ax.add_layout(Title(text=title, text_font_size="12pt"), "above")
+    ax.add_layout(Title(text=os.path.split(folder)[-1], text_font_size="16pt"), "above")
+    if outfp:
+        output_file(outfp, mode=mode)
+        save(ax)
+    if show_plot:
+        show(ax)
+    return ax
+
+def binned_counts(keys, n_bins, weights=None, texts=None):
+    """Count (or sum the weights of) the alignments in each bin,
+    or, if `texts` is provided, count the distinct texts in each bin.
+
+    Args:
+        keys (array): bin number of each alignment (0 <= key < n_bins)
+        n_bins (int): number of bins
+        weights (array): weight of each alignment (e.g., its length)
+        texts (array): integer id of the text of each alignment
+
+    Returns:
+        numpy array (one value for each bin)
+    """
+    keys = np.asarray(keys, dtype=np.int64)
+    if texts is not None:
+        # keep only one alignment of each text in each bin:
+        pairs = np.unique(keys * (int(np.max(texts, initial=0)) + 1) + texts)
+        keys = pairs // (int(np.max(texts, initial=0)) + 1)
+        weights = None
+    return np.bincount(keys, weights=weights, minlength=n_bins).astype(np.float64)
+
+def ms_date_matrix(ms, bw, ew, dates, texts, ms_range, ms_bin=1,
+                   date_range=(0, 1501), year_bin=10, metric="alignments"):
+    """Aggregate the alignments into a matrix of milestone bins
+    by bins of the death year of the author of the reusing text,
+    in one vectorized pass, with the marginal totals along each axis.
+
+    Args:
+        ms, bw, ew (arrays): main milestone, start and end token
+            of each alignment
+        dates (array): death date of the author of the reusing text
+            of each alignment
+        texts (array): integer id of the reusing text of each alignment
+        ms_range (tuple): (first milestone, last milestone (exclusive))
+        ms_bin (int): number of milestones in each column
+        date_range (tuple): (start_date, end_date (exclusive))
+        year_bin (int): number of years in each row
+        metric (str): value of each cell: "alignments" (number of alignments),
+            "tokens" (number of reused tokens of the main text)
+            or "texts" (number of distinct reusing texts)
+
+    Returns:
+        tuple (matrix (numpy array of shape (n_year_bins, n_ms_bins)),
+               marginal of each milestone bin, marginal of each year bin)
+    """
+    ms = np.asarray(ms, dtype=np.int64)
+    dates = np.asarray(dates, dtype=np.int64)
+    keep = (ms_range[0] <= ms) & (ms < ms_range[1]) \
+           & (date_range[0] <= dates) & (dates < date_range[1])
+    nx = -(-(ms_range[1] - ms_range[0]) // ms_bin)
+    ny = -(-(date_range[1] - date_range[0]) // year_bin)
+    ix = (ms[keep] - ms_range[0]) // ms_bin
+    iy = (dates[keep] - date_range[0]) // year_bin
+    weights = None
+    if metric == "tokens":
+        weights = (np.asarray(ew, dtype=np.int64) - np.asarray(bw, dtype=np.int64))[keep]
+    texts = np.asarray(texts, dtype=np.int64)[keep] if metric == "texts" else None
+    matrix = binned_counts(iy*nx + ix, nx*ny, weights, texts).reshape(ny, nx)
+    # the marginals of distinct texts are not the sums of the matrix:
+    if metric == "texts":
+        return matrix, binned_counts(ix, nx, texts=texts), binned_counts(iy, ny, texts=texts)
+    return matrix, matrix.sum(axis=0), matrix.sum(axis=1)
+
+def ms_date_heatmap(folder, date_range=(0, 1501), year_bin=10, ms_bin=None,
+                    metric="alignments", status=None, min_alignment_length=0,
+                    cmap=inferno, outfp=None, mode="inline", milestone_range=None,
+                    max_columns=2000, show_plot=True):
+    """Show the reuse of each milestone of the main text against
+    the death year of the author of the reusing text (in bins of `year_bin`
+    years), as a single image, with the total reuse of each milestone
+    above it and the total reuse of each year bin to the right of it.
+
+    Unlike ms_data_heatmap(), the date axis is continuous,
+    so that the temporal spread of the reuse of the whole text
+    is visible at once.
+
+    Args:
+        folder (str): path to the folder containing the milestone files
+            (or alignment store)
+        date_range (tuple): (start_date, end_date) of the reusing texts
+        year_bin (int): number of years in each row of the image
+        ms_bin (int): number of milestones in each column of the image.
+            Default: None (as small as possible
+            with at most `max_columns` columns)
+        metric (str): "alignments", "tokens" or "texts"
+            (see ms_date_matrix())
+        status (str or list): only include reuse by texts with this status
+            in the metadata (e.g., "pri"). Default: None (all texts)
+        min_alignment_length (int): only include alignments that cover
+            at least this number of tokens in the main text. Default: 0
+        cmap (function): Bokeh palette function (e.g., inferno)
+        outfp (str): path to the html file. Default: None (not saved)
+        mode (str): Bokeh resources mode for the html file
+        milestone_range (tuple): (first milestone, last milestone (exclusive))
+            of the main text to be included. Default: None (all milestones)
+        max_columns (int): maximum number of columns if `ms_bin` is None
+        show_plot (bool): if False, the plot is only saved, not opened
+
+    Returns:
+        Bokeh layout
+    """
+    alignments, text_ids = load_alignments(folder, [date_range], status=status,
+                                           min_alignment_length=min_alignment_length,
+                                           columns=["comp_date"],
+                                           milestone_range=milestone_range)
+    a = alignments[0]
+    ms_range = milestone_range or (0, int(np.max(a["ms"], initial=0)) + 1)
+    if not ms_bin:
+        ms_bin = max(1, -(-(ms_range[1] - ms_range[0]) // max_columns))
+    with stage("ms_date_matrix") as items:
+        matrix, ms_totals, year_totals = ms_date_matrix(
+            a["ms"], a["bw"], a["ew"], a["comp_date"], a["text"], ms_range, ms_bin,
+            date_range, year_bin, metric)
+        items["alignments"] = len(a["ms"])
+
+    value_label = {"alignments": "alignments", "tokens": "reused tokens",
+                   "texts": "reusing texts"}[metric]
+    x_start = ms_range[0]
+    x_end = x_start + matrix.shape[1] * ms_bin
+    y_end = date_range[0] + matrix.shape[0] * year_bin
+    image = matrix.copy()
+    image[image == 0] = np.nan
+    palette = list(cmap(256))
+    palette.reverse()
+    max_value = np.nanmax(image) if np.any(matrix) else 1
+    color_mapper = LogColorMapper(palette=palette, low=1, high=max(max_value, 2),
+                                  nan_color="rgba(0, 0, 0, 0)")
+    tools = "pan,wheel_zoom,box_zoom,reset"
+    ax = figure(plot_width=800, plot_height=500, x_range=(x_start, x_end),
+                y_range=(date_range[0], y_end), tools=tools)
+    ax.background_fill_color = "grey"
+    ax.background_fill_alpha = 0.1
+    ax.image(image=[image], x=x_start, y=date_range[0], dw=x_end - x_start,
+             dh=y_end - date_range[0], color_mapper=color_mapper)
+    ax.add_layout(ColorBar(color_mapper=color_mapper, label_standoff=12), "right")
+    ax.add_tools(HoverTool(tooltips=[("milestone", "$x{0}"), ("death year", "$y{0}"),
+                                     (value_label, "@image")]))
+    ax.xaxis.axis_label = "milestone in {}".format(os.path.split(folder)[-1])
+    ax.yaxis.axis_label = "death year of the author of the reusing text (AH)"
+
+    # marginal histograms, linked to the axes of the image:
+    top = figure(plot_width=800, plot_height=150, x_range=ax.x_range, tools=tools)
+    top.vbar(x=x_start + (np.arange(len(ms_totals)) + 0.5) * ms_bin, width=ms_bin,
+             top=ms_totals, color="grey")
+    top.yaxis.axis_label = value_label
+    top.xaxis.visible = False
+    right = figure(plot_width=200, plot_height=500, y_range=ax.y_range, tools=tools)
+    right.hbar(y=date_range[0] + (np.arange(len(year_totals)) + 0.5) * year_bin,
+               height=year_bin, right=year_totals, color="grey")
+    right.xaxis.axis_label = value_label
+    right.yaxis.visible = False
+    for fig in [ax, top, right]:
+        fig.toolbar.active_scroll = fig.select_one(WheelZoomTool)
+    title = "Reuse by texts by authors who died between {} and {} AH " \
+            "({} years x {} milestones per cell)".format(*date_range, year_bin, ms_bin)
+    top.add_layout(Title(text=title, text_font_size="12pt"), "above")
+    top.add_layout(Title(text=os.path.split(folder)[-1], text_font_size="16pt"), "above")
+
+    layout = gridplot([[top, None], [ax, right]], toolbar_location="right")
+    if outfp:
+        output_file(outfp, mode=mode)
+        save(layout)
+    if show_plot:
+        show(layout)
+    return layout
+
+def dense_coverage(ms, bw, ew, n_ms, n_tokens, first_ms=0):
+    """Count for every token of every milestone how many alignments
+    cover it, as a dense matrix (milestones x tokens).
+
+    Args:
+        ms, bw, ew (arrays): main milestone, start and end token
+            (exclusive) of each alignment
+        n_ms (int): number of rows (milestones first_ms to first_ms + n_ms - 1)
+        n_tokens (int): number of columns (larger than the largest end token)
+        first_ms (int): milestone of the first row
+
+    Returns:
+        numpy array of shape (n_ms, n_tokens)
+    """
+    rows = np.asarray(ms, dtype=np.int64) - first_ms
+    events = np.zeros((n_ms, n_tokens + 1), dtype=np.int32)
+    np.add.at(events, (rows, np.asarray(bw, dtype=np.int64)), 1)
+    np.add.at(events, (rows, np.asarray(ew, dtype=np.int64)), -1)
+    return np.cumsum(events, axis=1)[:, :n_tokens]
+
+def matrix_to_lines(matrix, first_ms=0):
+    """Convert a (milestones x tokens) matrix, whose first row is
+    milestone `first_ms`, into lines
+    [[ms, ms], [start, end (exclusive)], value] for each maximal stretch
+    of tokens with the same non-zero value (see create_plot_lines())."""
+    n_ms, n_tokens = matrix.shape
+    # pad each row with a zero on both sides, so that runs
+    # never continue from one row to the next:
+    width = n_tokens + 2
+    padded = np.zeros((n_ms, width), dtype=matrix.dtype)
+    padded[:, 1:-1] = matrix
+    flat = padded.ravel()
+    bounds = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    starts, ends = bounds[:-1], bounds[1:]
+    vals = flat[starts]
+    keep = vals != 0
+    starts, ends, vals = starts[keep], ends[keep], vals[keep]
+    rows = starts // width
+    return [[[m, m], [s, e], v] for m, s, e, v in
+            zip((rows + first_ms).tolist(), (starts % width - 1).tolist(),
+                (ends - rows*width - 1).tolist(), vals.tolist())]
+
+def load_run_alignments(path, date_ranges, status=None, min_alignment_length=0,
+                        milestone_range=None):
+    """Load the alignments of a passim run from an alignment store
+    or from a text folder (see load_alignments()).
+
+    Returns:
+        tuple (alignments of each date range, text ids,
+               main text (None if unknown))
+    """
+    if os.path.exists(os.path.join(path, "_store_info.json")):
+        alignments, text_ids = load_alignments_from_store(
+            path, date_ranges, status=status,
+            min_alignment_length=min_alignment_length,
+            milestone_range=milestone_range)
+        return alignments, text_ids, load_store_info(path)["main"]
+    alignments, text_ids = load_alignments(path, date_ranges, status=status,
+                                           min_alignment_length=min_alignment_length,
+                                           milestone_range=milestone_range)
+    manifest = load_pair_file_manifest(path) or dict()
+    return alignments, text_ids, manifest.get("main")
+
+def diff_heatmap(old, new, date_ranges=[(0, 1501),], status=None,
+                 min_alignment_length=0, metric="alignments", outfp=None,
+                 mode="inline", milestone_range=None, show_plot=True):
+    """Show which passages of the main text gained or lost reuse
+    between two passim runs, as a heatmap of the signed difference
+    (new - old) of the count of every token, for each date range.
+
+    Both runs are loaded as arrays (preferably from an alignment store,
+    see convert_srt_folder_to_store()), their coverage is counted
+    in a dense (milestone x token) matrix, and the matrices are subtracted;
+    the milestone json files and plotjson files are not used.
+
+    Args:
+        old (str): path to the alignment store (or text folder)
+            of the older passim run
+        new (str): path to the alignment store (or text folder)
+            of the newer passim run (of the same main text)
+        date_ranges (list): list of tuples (start_date, end_date)
+        status (str or list): only include reuse by texts with this status
+            in the metadata (e.g., "pri"). Default: None (all texts)
+        min_alignment_length (int): only include alignments that cover
+            at least this number of tokens in the main text. Default: 0
+        metric (str): "alignments" or "texts" (see ms_data_heatmap())
+        outfp (str): path to the html file. Default: None (not saved)
+        mode (str): Bokeh resources mode for the html file
+        milestone_range (tuple): (first milestone, last milestone (exclusive))
+            of the main text to be included. Default: None (all milestones)
+        show_plot (bool): if False, the plot is only saved, not opened
+
+    Returns:
+        tuple (list of lists of difference lines for each date range
+               (see create_plot_lines()),
+               list of dictionaries {"date_range": ..., "gained": number
+               of token counts gained, "lost": number lost, "net": ...})
+    """
+    runs = []
+    for path in [old, new]:
+        alignments, text_ids, main = load_run_alignments(
+            path, date_ranges, status=status,
+            min_alignment_length=min_alignment_length,
+            milestone_range=milestone_range)
+        if metric == "texts":
+            for i, a in enumerate(alignments):
+                ms, bw, ew = union_intervals_per_text(a["ms"], a["bw"], a["ew"], a["text"])
+                alignments[i] = {"ms": ms, "bw": bw, "ew": ew}
+        runs.append((alignments, main))
+    if runs[0][1] and runs[1][1] and runs[0][1] != runs[1][1]:
+        raise ValueError("the runs are not of the same main text: {} and {}".format(
+            runs[0][1], runs[1][1]))
+
+    with stage("diff") as items:
+        all_alignments = [a for alignments, main in runs for a in alignments]
+        # only the rows of the milestones in the milestone range are allocated:
+        first_ms = milestone_range[0] if milestone_range else 0
+        n_ms = max([first_ms] + [int(a["ms"].max()) for a in all_alignments
+                                 if len(a["ms"])]) + 1 - first_ms
+        n_tokens = max([300] + [int(a["ew"].max()) for a in all_alignments if len(a["ms"])]) + 1
+        split_diff_lines = []
+        totals = []
+        for x, dr in enumerate(date_ranges):
+            old_a, new_a = runs[0][0][x], runs[1][0][x]
+            diff = dense_coverage(new_a["ms"], new_a["bw"], new_a["ew"], n_ms, n_tokens,
+                                  first_ms) \
+                   - dense_coverage(old_a["ms"], old_a["bw"], old_a["ew"], n_ms, n_tokens,
+                                    first_ms)
+            split_diff_lines.append(matrix_to_lines(diff, first_ms))
+            gained = int(diff[diff > 0].sum())
+            lost = int(-diff[diff < 0].sum())
+            totals.append({"date_range": list(dr), "gained": gained, "lost": lost,
+                           "net": gained - lost})
+            items["alignments"] = items.get("alignments", 0) + len(old_a["ms"]) + len(new_a["ms"])
+    for t in totals:
+        print("{}-{} AH: +{} / -{} (net {:+d})".format(*t["date_range"], t["gained"],
+                                                       t["lost"], t["net"]))
+
+    # plot the differences with a diverging color map
+    # (lost reuse in red, gained reuse in blue):
+    max_abs = max([1] + [abs(v) for lines in split_diff_lines for x, y, v in lines])
+    color_mapper = LinearColorMapper(palette=list(reversed(RdBu[11])),
+                                     low=-max_abs, high=max_abs)
+    value_label = "difference in reusing texts" if metric == "texts" \
+                  else "difference in reuse cases"
+    x_start, x_end = milestone_range or (0, n_ms + 10)
+    axes = []
+    tools = "pan,wheel_zoom,box_zoom,reset"
+    for i, dr in enumerate(date_ranges):
+        ax = figure(plot_width=250, plot_height=250, tools=tools,
+                    x_range=axes[0].x_range if axes else Range1d(x_start, x_end),
+                    y_range=axes[0].y_range if axes else Range1d(0, n_tokens - 1))
+        ax.background_fill_color = "grey"
+        ax.background_fill_alpha = 0.3
+        line_data = split_diff_lines[i]
+        source = ColumnDataSource(data={"x": [x[0] for x, y, v in line_data],
+                                        "y0": [y[0] for x, y, v in line_data],
+                                        "y1": [y[1] for x, y, v in line_data],
+                                        "val": [v for x, y, v in line_data]})
+        ax.segment("x", "y0", "x", "y1", source=source,
+                   color={"field": "val", "transform": color_mapper})
+        ax.add_tools(HoverTool(tooltips=[(value_label, "@val")], line_policy="interp"))
+        ax.add_layout(ColorBar(color_mapper=color_mapper, label_standoff=12), "right")
+        ax.toolbar.active_scroll = ax.select_one(WheelZoomTool)
+        t = totals[i]
+        title = "Texts by authors who died between {} and {} AH: " \
+                "+{} / -{} (net {:+d})".format(*dr, t["gained"], t["lost"], t["net"])
+        ax.add_layout(Title(text=title, text_font_size="12pt"), "above")
+        ax.sizing_mode = "stretch_width"
+        axes.append(ax)
+    title = "Difference in reuse: {} -> {}".format(old, new)
+    axes[0].add_layout(Title(text=title, text_font_size="16pt"), "above")
+    c = grid([[ax] for ax in axes])
+    if outfp:
+        output_file(outfp, mode=mode)
+        save(c)
+    if show_plot:
+        show(c)
+    return split_diff_lines, totals
+
+def pair_file_totals(fp, min_alignment_length=0, srt_cache=False):
+    """Count the alignments in an srt file and the number of tokens
+    of each book covered by them (without keeping the alignments).
+
+    Args:
+        fp (str): path to the srt file
+        min_alignment_length (int): only include alignments that cover
+            at least this number of tokens in both books
+        srt_cache (bool): see open_pair_file()
+
+    Returns:
+        tuple (number of alignments, tokens of bk1, tokens of bk2)
+    """
+    n = tokens1 = tokens2 = 0
+    with open_pair_file(fp, srt_cache=srt_cache) as file:
+        for row in csv.DictReader(file, delimiter="\t"):
+            len1 = int(row["ew1"]) - int(row["bw1"])
+            len2 = int(row["ew2"]) - int(row["bw2"])
+            if len1 < min_alignment_length or len2 < min_alignment_length:
+                continue
+            n += 1
+            tokens1 += len1
+            tokens2 += len2
+    return n, tokens1, tokens2
+
+def text_date(text_id):
+    """Get the death date of the author of a text from the metadata
+    (None if the text is not in the metadata)."""
+    try:
+        return int(meta[text_id]["date"])
+    except (KeyError, ValueError):
+        return None
+
+@instrumented()
+def build_reuse_network(folders, status=None, min_alignment_length=0,
+                        workers=None, srt_cache=False):
+    """Aggregate the number of alignments and aligned tokens
+    of every pair of texts in the srt files of one or more folders
+    into a sparse matrix, in a single streaming pass over the srt files
+    (no milestone json files are created).
+
+    An srt file that is found in more than one folder (e.g., A_B.csv
+    in the folder of text A and B_A.csv in the folder of text B)
+    is only read once. Versions of the same text are counted
+    as the same text; alignments between versions of the same text
+    are left out.
+
+    Args:
+        folders (str or list): path(s) to the folder(s) containing srt files
+        status (str or list): only include texts with this status
+            in the metadata (e.g., "pri"). Default: None (all texts)
+        min_alignment_length (int): only include alignments that cover
+            at least this number of tokens in both texts. Default: 0
+        workers (int): number of worker processes. Default: None
+            (number of CPUs); use 1 to read all files in the current process.
+        srt_cache (bool): see open_pair_file()
+
+    Returns:
+        dict ({"texts": list of text ids, ordered by the death date
+                   of their author (texts without date at the end),
+               "dates": list of the death dates (or None),
+               "row", "col": numpy arrays with the index numbers (in "texts")
+                   of the two texts of each pair (row < col),
+               "alignments": numpy array with the number of alignments
+                   of each pair,
+               "row_tokens", "col_tokens": numpy arrays with the number
+                   of tokens of the row/col text covered by the alignments})
+    """
+    if isinstance(folders, str):
+        folders = [folders]
+    if isinstance(status, str):
+        status = [status]
+    # list the srt files, and keep only one copy of each pair of books:
+    files = dict()
+    for folder in folders:
+        for fn in sorted(os.listdir(folder)):
+            if not is_pair_file(fn):
+                continue
+            bk1, bk2 = split_pair_file_name(fn)
+            id1, id2 = bk1.split("-")[0], bk2.split("-")[0]
+            if id1 == id2 or frozenset([bk1, bk2]) in files:
+                continue
+            if status and any(meta.get(t, {}).get("status") not in status
+                              for t in (id1, id2)):
+                continue
+            files[frozenset([bk1, bk2])] = (os.path.join(folder, fn), id1, id2)
+    print("Building reuse network from", len(files), "srt files...")
+
+    # aggregate the totals of each pair of texts:
+    pairs = defaultdict(lambda: [0, 0, 0])
+    def add(totals, id1, id2):
+        n, tokens1, tokens2 = totals
+        count_items(files=1, alignments=n)
+        if not n:
+            return
+        if id1 > id2:
+            id1, id2, tokens1, tokens2 = id2, id1, tokens2, tokens1
+        pair = pairs[(id1, id2)]
+        pair[0] += n
+        pair[1] += tokens1
+        pair[2] += tokens2
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(files) < 100:
+        for fp, id1, id2 in tqdm(files.values()):
+            add(pair_file_totals(fp, min_alignment_length, srt_cache), id1, id2)
+    else:
+        with ProcessPoolExecutor(workers) as pool:
+            futures = {pool.submit(pair_file_totals, fp, min_alignment_length,
+                                   srt_cache): (id1, id2)
+                       for fp, id1, id2 in files.values()}
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                add(future.result(), *futures[future])
+
+    # order the texts by date and build the sparse matrix:
+    text_ids = set(t for pair in pairs for t in pair)
+    texts = sorted(text_ids, key=lambda t: (text_date(t) is None, text_date(t) or 0, t))
+    index = {t: i for i, t in enumerate(texts)}
+    network = {"texts": texts, "dates": [text_date(t) for t in texts]}
+    cols = {key: [] for key in ["row", "col", "alignments", "row_tokens", "col_tokens"]}
+    for (id1, id2), (n, tokens1, tokens2) in pairs.items():
+        if index[id1] > index[id2]:
+            id1, id2, tokens1, tokens2 = id2, id1, tokens2, tokens1
+        for key, val in zip(cols, [index[id1], index[id2], n, tokens1, tokens2]):
+            cols[key].append(val)
+    order = np.lexsort((cols["col"], cols["row"]))
+    for key, lst in cols.items():
+        network[key] = np.asarray(lst, dtype=np.int64)[order]
+    return network
+
+def save_reuse_network_csv(network, fp):
+    """Save the pairs of a reuse network (see build_reuse_network())
+    as a tab-separated edge list, ordered by the dates of the texts."""
+    texts, dates = network["texts"], network["dates"]
+    with open(fp, mode="w", encoding="utf-8", newline="") as file:
+        writer = csv.writer(file, delimiter="\t")
+        writer.writerow(["text1", "date1", "text2", "date2", "alignments",
+                         "tokens1", "tokens2"])
+        for i, j, n, tokens1, tokens2 in zip(network["row"], network["col"],
+                                             network["alignments"],
+                                             network["row_tokens"],
+                                             network["col_tokens"]):
+            writer.writerow([texts[i], dates[i], texts[j], dates[j],
+                             n, tokens1, tokens2])
+
+def save_reuse_network_graphml(network, fp):
+    """Save a reuse network (see build_reuse_network()) as a GraphML file
+    (e.g., for Gephi or networkx): one node for each text (in date order,
+    with the metadata of the text) and one undirected edge for each pair."""
+    node_keys = [("date", "int"), ("author", "string"), ("book", "string"),
+                 ("status", "string")]
+    edge_keys = [("alignments", "int"), ("tokens1", "int"), ("tokens2", "int")]
+    root = ET.Element("graphml", xmlns="http://graphml.graphdrawing.org/xmlns")
+    for key, typ in node_keys:
+        ET.SubElement(root, "key", {"id": key, "for": "node", "attr.name": key,
+                                    "attr.type": typ})
+    for key, typ in edge_keys:
+        ET.SubElement(root, "key", {"id": key, "for": "edge", "attr.name": key,
+                                    "attr.type": typ})
+    graph = ET.SubElement(root, "graph", id="reuse", edgedefault="undirected")
+    for text_id, date in zip(network["texts"], network["dates"]):
+        node = ET.SubElement(graph, "node", id=text_id)
+        d = meta.get(text_id, {})
+        for key, val in [("date", date), ("author", d.get("author")),
+                         ("book", d.get("book")), ("status", d.get("status"))]:
+            if val is not None:
+                ET.SubElement(node, "data", key=key).text = str(val)
+    texts = network["texts"]
+    for i, j, n, tokens1, tokens2 in zip(network["row"], network["col"],
+                                         network["alignments"],
+                                         network["row_tokens"],
+                                         network["col_tokens"]):
+        edge = ET.SubElement(graph, "edge", source=texts[i], target=texts[j])
+        for key, val in zip(["alignments", "tokens1", "tokens2"], [n, tokens1, tokens2]):
+            ET.SubElement(edge, "data", key=key).text = str(val)
+    ET.ElementTree(root).write(fp, encoding="utf-8", xml_declaration=True)
+
+def plot_reuse_network(network, outfp=None, cmap=inferno, max_pairs=5000,
+                       mode="inline", show_plot=True):
+    """Visualize a reuse network (see build_reuse_network()) with Bokeh:
+    a matrix of the texts (in date order) in which the color of each cell
+    is the number of tokens of the row text aligned with the column text,
+    and a graph with the texts in date order on a circle.
+
+    Args:
+        network (dict): see build_reuse_network()
+        outfp (str): path to the html file. Default: None (not saved)
+        cmap (function): Bokeh palette function (e.g., inferno)
+        max_pairs (int): only the pairs with the most aligned tokens
+            are drawn
+        mode (str): Bokeh resources mode for the html file
+        show_plot (bool): if False, the plot is only saved, not opened
+
+    Returns:
+        Bokeh layout
+    """
+    texts, dates = network["texts"], network["dates"]
+    total = network["row_tokens"] + network["col_tokens"]
+    top = np.argsort(-total, kind="stable")[:max_pairs]
+    row, col = network["row"][top], network["col"][top]
+    labels = ["{} ({})".format(t, d) for t, d in zip(texts, dates)]
+
+    # matrix: the upper triangle shows the tokens of the row text,
+    # the lower triangle the tokens of the column text:
+    data = {"x": np.concatenate([col, row]), "y": np.concatenate([row, col]),
+            "tokens": np.concatenate([network["row_tokens"][top],
+                                      network["col_tokens"][top]]),
+            "alignments": np.concatenate([network["alignments"][top]]*2)}
+    data["text1"] = [labels[i] for i in data["y"]]
+    data["text2"] = [labels[i] for i in data["x"]]
+    palette = list(cmap(256))
+    palette.reverse()
+    max_tokens = int(data["tokens"].max()) if len(top) else 1
+    color_mapper = LogColorMapper(palette=palette, low=1, high=max(max_tokens, 2))
+    n = max(len(texts), 1)
+    matrix = figure(plot_width=600, plot_height=600, x_range=(-0.5, n-0.5),
+                    y_range=(n-0.5, -0.5), tools="pan,wheel_zoom,box_zoom,reset,tap",
+                    title="Aligned tokens of each pair of texts (texts in date order)")
+    matrix.rect("x", "y", width=1, height=1, source=ColumnDataSource(data=data),
+                fill_color={"field": "tokens", "transform": color_mapper},
+                line_color=None)
+    matrix.add_layout(ColorBar(color_mapper=color_mapper, label_standoff=12), "right")
+    matrix.add_tools(HoverTool(tooltips=[("text", "@text1"), ("aligned with", "@text2"),
+                                         ("tokens of text", "@tokens"),
+                                         ("alignments", "@alignments")]))
+    matrix.xaxis.axis_label = matrix.yaxis.axis_label = "texts (by death date of the author)"
+
+    # graph: the texts in date order on a circle, edges between the pairs:
+    angle = np.pi/2 - 2*np.pi*np.arange(n)/n
+    node_x, node_y = np.cos(angle), np.sin(angle)
+    edge_tokens = total[top]
+    edges = {"xs": [[node_x[i], node_x[j]] for i, j in zip(row, col)],
+             "ys": [[node_y[i], node_y[j]] for i, j in zip(row, col)],
+             "width": (0.5 + 4 * np.log1p(edge_tokens) / np.log1p(max(edge_tokens.max(), 1))
+                       if len(top) else []),
+             "tokens": edge_tokens, "alignments": network["alignments"][top],
+             "text1": [labels[i] for i in row], "text2": [labels[j] for j in col]}
+    graph = figure(plot_width=600, plot_height=600, x_range=(-1.2, 1.2),
+                   y_range=(-1.2, 1.2), tools="pan,wheel_zoom,box_zoom,reset",
+                   title="Reuse network (texts in date order, clockwise)")
+    edge_renderer = graph.multi_line("xs", "ys", source=ColumnDataSource(data=edges),
+                                     line_width="width", line_alpha=0.3,
+                                     color={"field": "tokens", "transform": color_mapper})
+    node_renderer = graph.circle("x", "y", size=6, color="black",
+                                 source=ColumnDataSource(data={"x": node_x, "y": node_y,
+                                                               "text": labels}))
+    graph.add_tools(HoverTool(renderers=[edge_renderer], line_policy="interp",
+                              tooltips=[("texts", "@text1 - @text2"),
+                                        ("aligned tokens", "@tokens"),
+                                        ("alignments", "@alignments")]))
+    graph.add_tools(HoverTool(renderers=[node_renderer], tooltips=[("text", "@text")]))
+    for ax in [matrix, graph]:
+        ax.toolbar.active_scroll = ax.select_one(WheelZoomTool)
+    graph.axis.visible = False
+    graph.grid.visible = False
+
+    layout = grid([[matrix, graph]])
+    if outfp:
+        output_file(outfp, mode=mode)
+        save(layout)
+    if show_plot:
+        show(layout)
+    return layout
 
 def split_dates_to_date_ranges(split_dates, start_date=0, end_date=1501):
     """Given a list of dates, create date ranges
@@ -459,7 +3914,16 @@ def extract_milestone_data_from_file(file, ms_data, main, comp,
         comp (str): id of the compared book (derived from the srt file name).
         main_col (str): is the main book bk1 or bk2 in the srt file? "1" or "2".
         comp_col (str): is the compared book bk1 or bk2 in the srt file? "1" or "2". 
+
+    Returns:
+        dict (information about the srt file for the pair file manifest:
+            {"comp": comp, "n_rows": number of alignments,
+             "max_len": length of the longest alignment in the main text,
+             "main_ms": sorted list of reused milestones of the main text})
     """
+    n_rows = 0
+    max_len = 0
+    main_mss = set()
     for row in csv.DictReader(file, delimiter="\t"):
         main_ms = int(re.findall(r"\d+$", row["id"+main_col])[0])
         main_bw = int(row["bw"+main_col])
@@ -481,49 +3945,1132 @@ def extract_milestone_data_from_file(file, ms_data, main, comp,
         ms_data[main_ms][comp][comp_ms][comp_bw]["main_ew"] = main_ew
         #ms_data[main_ms][comp][comp_ms][comp_bw]["main_id"] = main
         ms_data[main_ms][comp][comp_ms][comp_bw]["main_s"] = main_s    
+        n_rows += 1
+        max_len = max(max_len, main_ew - main_bw)
+        main_mss.add(main_ms)
+    return {"comp": comp, "n_rows": n_rows, "max_len": max_len,
+            "main_ms": sorted(main_mss)}
 
-def extract_milestone_data_from_folder(folder):
-    """Extract for every milestone in the mail text all corresponding
-    milestones from all csv files in `folder` and save them as json files
-    (one json file per milestone)
+def is_pair_file(fn):
+    """Check whether `fn` is the name of a passim srt file
+    (bk1_bk2.csv, optionally gzipped; other csv files in the folder,
+    like the milestone summaries, have more than one underscore)"""
+    return re.match(r"[^_]+_[^_]+(?:\.csv|\.txt)?(?:\.gz)?$", fn) is not None \
+        and re.search(r"(?:\.csv|\.txt|\.gz)$", fn) is not None
+
+def split_pair_file_name(fn):
+    """Get the ids of the two books aligned in a passim srt file
+    from its file name (bk1_bk2.csv / bk1_bk2.csv.gz)
+
+    Returns:
+        tuple (bk1 (str), bk2 (str))
     """
+    bk1, bk2 = re.sub(r"(?:\.csv|\.txt|\.gz)*$", "", fn).split("_")
+    return bk1, bk2
+
+def find_main_text(folder):
+    """Find the id of the main text in a folder of srt files:
+    the book that figures in most of the srt files."""
     count = defaultdict(int)
     for fn in os.listdir(folder):
-        if not fn.endswith("json"):
-            bk1, bk2 = ".".join(fn.split(".")[:-1]).split("_")
+        if is_pair_file(fn):
+            bk1, bk2 = split_pair_file_name(fn)
             count[bk1] += 1
             count[bk2] += 1
-    main = sorted(count.items(), key=lambda item: item[1], reverse=True)[0][0]
+    return sorted(count.items(), key=lambda item: item[1], reverse=True)[0][0]
+
+def get_pair_file_roles(fn, main):
+    """Find out which of the two books in an srt file is the main text.
+
+    Returns:
+        tuple (comp (str), main_col (str), comp_col (str))
+    """
+    bk1, bk2 = split_pair_file_name(fn)
+    if bk1 == main:
+        return bk2, "1", "2"
+    return bk1, "2", "1"
+
+def get_srt_cache_fp(fp):
+    """Get the path to the recompressed copy of a gzipped srt file."""
+    folder, fn = os.path.split(fp)
+    return os.path.join(folder, SRT_CACHE_FOLDER, re.sub(r"\.gz$", ".zst", fn))
 
-    ms_data = defaultdict(dict)
+def load_srt_cache_index(fp, cache_fp):
+    """Load the block index of the recompressed copy of an srt file.
+
+    Returns:
+        dict (None if there is no recompressed copy,
+            or if the srt file has changed since it was made)
+    """
+    index_fp = cache_fp + ".json"
+    if not (os.path.exists(index_fp) and os.path.exists(cache_fp)):
+        return None
+    with open(index_fp, mode="r", encoding="utf-8") as file:
+        index = json.load(file)
+    stat = os.stat(fp)
+    if index["src_size"] != stat.st_size or index["src_mtime"] != stat.st_mtime:
+        return None
+    return index
+
+def transcode_srt_file(fp, cache_fp=None, block_lines=20000, level=3):
+    """Recompress a gzipped srt file into a series of independent
+    zstandard frames (of `block_lines` lines each),
+    which can be decompressed much faster and in parallel
+    (see read_transcoded_srt_file()).
+
+    The offset, size and number of lines of each frame are saved
+    in a block index (<cache_fp>.json), together with the header line
+    of the srt file and the size and modification time of the gz file.
+
+    Args:
+        fp (str): path to the gzipped srt file
+        cache_fp (str): path to the recompressed file.
+            Default: None (a .zst file in the srt cache folder
+            next to the srt file)
+        block_lines (int): number of lines in each zstandard frame
+        level (int): zstandard compression level
+
+    Returns:
+        dict (the block index)
+    """
+    if zstandard is None:
+        raise ImportError("zstandard is required for the srt cache")
+    if not cache_fp:
+        cache_fp = get_srt_cache_fp(fp)
+    os.makedirs(os.path.dirname(cache_fp), exist_ok=True)
+    with file_lock(cache_fp) as waited:
+        # another process may just have recompressed the file:
+        index = load_srt_cache_index(fp, cache_fp) if waited else None
+        if index is not None:
+            return index
+        cctx = zstandard.ZstdCompressor(level=level)
+        blocks = []
+        offset = 0
+        with gzip.open(fp, mode="rt", encoding="utf-8") as file:
+            header = file.readline()
+            with atomic_write(cache_fp, mode="wb") as out:
+                while True:
+                    lines = list(itertools.islice(file, block_lines))
+                    if not lines:
+                        break
+                    frame = cctx.compress("".join(lines).encode("utf-8"))
+                    out.write(frame)
+                    blocks.append([offset, len(frame), len(lines)])
+                    offset += len(frame)
+        stat = os.stat(fp)
+        index = {"src_size": stat.st_size, "src_mtime": stat.st_mtime,
+                 "header": header, "blocks": blocks}
+        with atomic_write(cache_fp+".json") as file:
+            json.dump(index, file, ensure_ascii=False)
+    return index
+
+def read_transcoded_srt_file(cache_fp, index, workers=4):
+    """Read the lines of a recompressed srt file,
+    decompressing `workers` blocks at a time in parallel threads
+    (zstandard releases the GIL while decompressing).
+
+    Yields:
+        str (one line of the srt file, starting with the header line)
+    """
+    def decompress(frame):
+        return zstandard.ZstdDecompressor().decompress(frame).decode("utf-8")
+
+    yield index["header"]
+    blocks = index["blocks"]
+    with open(cache_fp, mode="rb") as file, ThreadPoolExecutor(workers) as pool:
+        for i in range(0, len(blocks), workers):
+            frames = []
+            for offset, size, n_lines in blocks[i:i+workers]:
+                file.seek(offset)
+                frames.append(file.read(size))
+            for text in pool.map(decompress, frames):
+                yield from text.splitlines(keepends=True)
+
+@instrumented()
+def build_srt_cache(folder, workers=4, block_lines=20000, level=3):
+    """Recompress all gzipped srt files in `folder` that do not have
+    an up-to-date recompressed copy in the srt cache folder yet
+    (see transcode_srt_file()).
+
+    After this, open_pair_file() transparently reads the recompressed copies.
+    """
+    fps = []
     for fn in os.listdir(folder):
-        if not fn.endswith("json"):
+        fp = os.path.join(folder, fn)
+        if is_pair_file(fn) and fn.endswith("gz"):
+            if load_srt_cache_index(fp, get_srt_cache_fp(fp)) is None:
+                fps.append(fp)
+    print("Recompressing", len(fps), "gzipped srt files in", folder)
+    with ThreadPoolExecutor(workers) as pool:
+        list(pool.map(lambda fp: transcode_srt_file(fp, block_lines=block_lines,
+                                                    level=level), fps))
+
+@contextmanager
+def open_pair_file(fp, srt_cache=False, workers=4):
+    """Open a (gzipped or plain) srt file as an iterable of text lines.
+
+    For a gzipped srt file, the recompressed copy in the srt cache
+    folder (see transcode_srt_file()) is read instead,
+    if it exists and is up to date.
+
+    Args:
+        fp (str): path to the srt file
+        srt_cache (bool): if True, create a recompressed copy
+            of gzipped srt files that do not have one yet
+            (requires zstandard)
+        workers (int): number of threads used for decompressing
+            the recompressed copy
+    """
+    if fp.endswith("gz") and zstandard is not None:
+        cache_fp = get_srt_cache_fp(fp)
+        index = load_srt_cache_index(fp, cache_fp)
+        if index is None and srt_cache:
+            index = transcode_srt_file(fp, cache_fp)
+        if index is not None:
+            yield read_transcoded_srt_file(cache_fp, index, workers)
+            return
+    if fp.endswith("gz"):
+        with gzip.open(fp, mode="rt", encoding="utf-8") as file:
+            yield file
+    else:
+        with open(fp, mode="r", encoding="utf-8") as file:
+            yield file
+
+def load_pair_file_manifest(folder):
+    """Load the pair file manifest of a text folder
+    (see extract_milestone_data_from_folder()).
+
+    Returns:
+        dict ({"main": main text id, "files": {fn: file info}};
+            None if the folder does not contain a manifest)
+    """
+    fp = os.path.join(folder, MANIFEST_FN)
+    if not os.path.exists(fp):
+        return None
+    with open(fp, mode="r", encoding="utf-8") as file:
+        return json.load(file)
+
+def save_pair_file_manifest(folder, main, file_info):
+    """Add information about srt files to the pair file manifest of a folder.
+
+    Args:
+        folder (str): path to the text folder
+        main (str): id of the main text
+        file_info (dict): {fn: dictionary returned by
+            extract_milestone_data_from_file()}
+    """
+    manifest_fp = os.path.join(folder, MANIFEST_FN)
+    with file_lock(manifest_fp):
+        manifest = load_pair_file_manifest(folder) or {"main": main, "files": {}}
+        manifest["files"].update(file_info)
+        with atomic_write(manifest_fp) as file:
+            json.dump(manifest, file, ensure_ascii=False)
+
+def select_comp_dates(status=None):
+    """Get the death date of the author of every text
+    with the required status in the metadata.
+
+    The result can be passed to worker processes, which do not have
+    the metadata if they are not forked from the main process
+    (e.g., on Windows and macOS).
+
+    Args:
+        status (str or list): required status(es) of the text
+            in the metadata. Default: None (any status)
+
+    Returns:
+        dict ({text_id: date})
+    """
+    if isinstance(status, str):
+        status = [status]
+    return {text_id: int(d["date"]) for text_id, d in meta.items()
+            if not status or d["status"] in status}
+
+def comp_is_relevant(comp, date_ranges=None, status=None, comp_dates=None):
+    """Check, based on the metadata only, whether reuse by text `comp`
+    can contribute to any of the date ranges and has the required status
+    (texts that are not in the metadata never can).
+
+    Args:
+        comp (str): id of the compared text (e.g., "Shamela0009788-ara1")
+        date_ranges (list): list of tuples (start_date, end_date).
+            Default: None (all dates)
+        status (str or list): required status(es) of the text
+            in the metadata. Default: None (any status)
+        comp_dates (dict): death date of each text with the required
+            status (see select_comp_dates()), to be used instead
+            of the metadata. Default: None
+    """
+    comp_id = comp.split("-")[0]
+    if comp_dates is not None:
+        if comp_id not in comp_dates:
+            return False
+        date = comp_dates[comp_id]
+        return not date_ranges or any(r[0] <= date < r[1] for r in date_ranges)
+    if comp_id not in meta:
+        return False
+    if isinstance(status, str):
+        status = [status]
+    if status and meta[comp_id]["status"] not in status:
+        return False
+    if date_ranges:
+        date = int(meta[comp_id]["date"])
+        if not any(r[0] <= date < r[1] for r in date_ranges):
+            return False
+    return True
+
+def plan_pair_files(folder, date_ranges=None, status=None,
+                    min_alignment_length=0, comp_dates=None):
+    """Select the srt files in `folder` that can contribute to the
+    requested date ranges, status and minimum alignment length,
+    without opening any of the srt files.
+
+    The selection is made on the basis of the file names (bk1_bk2),
+    the metadata and, for the minimum alignment length,
+    the pair file manifest (if the folder has one).
+    srt files of texts that are not in the metadata are skipped
+    (and reported).
+    Files that have already been removed from the folder after
+    the extraction of the milestone json files are taken from the manifest.
+    If `comp_dates` is given, it is used instead of the metadata
+    (see comp_is_relevant()).
+
+    Returns:
+        list (file names of the relevant srt files)
+    """
+    manifest = load_pair_file_manifest(folder) or {"files": {}}
+    fns = set(fn for fn in os.listdir(folder) if is_pair_file(fn))
+    fns.update(manifest["files"].keys())
+    if not fns:
+        return []
+    main = manifest.get("main") or find_main_text(folder)
+    selected = []
+    unknown = []
+    for fn in sorted(fns):
+        comp = get_pair_file_roles(fn, main)[0]
+        if comp_dates is None and comp.split("-")[0] not in meta:
+            unknown.append(fn)
+            continue
+        if not comp_is_relevant(comp, date_ranges, status, comp_dates):
+            continue
+        info = manifest["files"].get(fn)
+        if info and info["max_len"] < min_alignment_length:
+            continue
+        selected.append(fn)
+    if unknown:
+        print("Skipped", len(unknown), "srt files of texts that are not in the metadata:",
+              ", ".join(unknown))
+    return selected
+
+def select_milestone_files(folder, date_ranges=None, status=None,
+                           min_alignment_length=0, milestone_range=None):
+    """Select the milestone json files in `folder` that can contain
+    alignments relevant to the date ranges, status and minimum
+    alignment length.
+
+    Without a pair file manifest, all milestone json files are selected.
+    If a milestone range is given, only the files of the milestones
+    in that range are selected (their file names are derived from
+    the milestone numbers, without listing the folder).
+
+    Returns:
+        list (file names of the milestone json files, in milestone order)
+    """
+    if milestone_range:
+        ms_fns = ["{}.json".format(ms) for ms in range(*milestone_range)
+                  if os.path.exists(os.path.join(folder, "{}.json".format(ms)))]
+    else:
+        ms_fns = sorted([fn for fn in os.listdir(folder) if re.match(r"\d+\.json$", fn)],
+                        key=lambda fn: int(fn.split(".")[0]))
+    manifest = load_pair_file_manifest(folder)
+    if not manifest:
+        return ms_fns
+    relevant_ms = set()
+    for fn in plan_pair_files(folder, date_ranges, status, min_alignment_length):
+        if fn in manifest["files"]:
+            relevant_ms.update(manifest["files"][fn]["main_ms"])
+    print("Selected", len(relevant_ms), "of", len(ms_fns), "milestone files")
+    return [fn for fn in ms_fns if int(fn.split(".")[0]) in relevant_ms]
+
+@instrumented()
+def extract_milestone_data_from_folder(folder, date_ranges=None, status=None,
+                                       min_alignment_length=0, srt_cache=False):
+    """Extract for every milestone in the mail text all corresponding
+    milestones from all csv files in `folder` and save them as json files
+    (one json file per milestone)
+
+    If date ranges, status or minimum alignment length are provided,
+    only the srt files that can contribute to them are read
+    (see plan_pair_files()).
+    Information about each srt file that was read
+    (comp text, number of alignments, longest alignment, reused milestones)
+    is saved in the pair file manifest of the folder.
+    srt files that are already in the manifest are not read again;
+    the data of the new srt files is added to the existing milestone
+    json files, so that the json files always contain the data
+    of all srt files in the manifest.
+
+    If `srt_cache` is True, gzipped srt files are recompressed
+    into the srt cache folder the first time they are read,
+    so that subsequent runs can read them much faster
+    (see open_pair_file()).
+
+    Only one process at a time extracts the data of a folder;
+    a process that has to wait for another one only extracts
+    the srt files that the other process did not extract.
+    """
+    main = find_main_text(folder)
+    with file_lock(os.path.join(folder, "_extract")):
+        manifest = load_pair_file_manifest(folder) or {"files": {}}
+        fns = [fn for fn in plan_pair_files(folder, date_ranges, status, min_alignment_length)
+               if os.path.exists(os.path.join(folder, fn))
+               and fn not in manifest["files"]]
+        if not fns:
+            print("Milestone data already extracted")
+            return
+
+        ms_data = defaultdict(dict)
+        file_info = dict()
+        for fn in fns:
             print(fn)
             fp = os.path.join(folder, fn)
-            bk1, bk2 = ".".join(fn.split(".")[:-1]).split("_")
-            if bk1 == main:
-                comp = bk2
-                main_col = "1"
-                comp_col = "2"
-            else:
-                comp = bk1
-                main_col = "2"
-                comp_col = "1"
-                
-            if not fp.endswith("gz"):
-                with open(fp, mode="r", encoding="utf-8") as file:
-                    extract_milestone_data_from_file(file, ms_data, main, comp,
-                                                     main_col, comp_col)
-            else:
-                with gzip.open(fp, mode="rt", encoding="utf-8") as file:
-                    extract_milestone_data_from_file(file, ms_data, main, comp,
-                                                     main_col, comp_col)
-                
+            comp, main_col, comp_col = get_pair_file_roles(fn, main)
+            with open_pair_file(fp, srt_cache=srt_cache) as file:
+                file_info[fn] = extract_milestone_data_from_file(file, ms_data, main, comp,
+                                                                 main_col, comp_col)
+            count_items(files=1, rows=file_info[fn]["n_rows"])
+
             #print(json.dumps(ms_data, ensure_ascii=False, indent=2, sort_keys=True))
-    for ms in ms_data:
-        outfp = os.path.join(folder, "{}.json".format(ms))
-        with open(outfp, mode="w", encoding="utf-8") as file:
-            json.dump(ms_data[ms], file, ensure_ascii=False, sort_keys=True, indent=2)
+        for ms in ms_data:
+            outfp = os.path.join(folder, "{}.json".format(ms))
+            # add the data of the new srt files to the data
+            # of the srt files extracted earlier:
+            if manifest["files"] and os.path.exists(outfp):
+                data = load_ms_json(outfp)
+                data.update(ms_data[ms])
+            else:
+                data = ms_data[ms]
+            with atomic_write(outfp) as file:
+                json.dump(data, file, ensure_ascii=False, sort_keys=True, indent=2)
+        save_pair_file_manifest(folder, main, file_info)
+
+@instrumented()
+def convert_srt_folder_to_store(folder, store_fp=None, bucket_size=100,
+                                include_strings=True, row_group_size=50000,
+                                srt_cache=False, update_manifest=True):
+    """Convert all srt files in `folder` into a columnar alignment store:
+    a parquet dataset partitioned by the death date of the author
+    of the compared text (`date_bucket=<start of bucket>/part-0.parquet`).
+
+    Each row in the store is one alignment; within each partition,
+    rows are sorted by main milestone. Like in the milestone json files,
+    only the last alignment with the same main milestone, comp milestone
+    and comp_bw is kept.
+
+    Date range queries (see read_store()) then only read the relevant
+    partitions and columns instead of parsing all srt files.
+    Only one process at a time converts a folder; a process that has to
+    wait for another one reuses the store created by that process.
+    Information about each srt file is added to the pair file manifest
+    of the folder (see plan_pair_files()), unless `update_manifest`
+    is False (then nothing is written into `folder`).
+
+    Args:
+        folder (str): path to the folder containing the srt files
+        store_fp (str): path to the folder in which the store will be saved.
+            Default: None (`alignment_store` folder inside `folder`)
+        bucket_size (int): number of years covered by each partition
+        include_strings (bool): if False, the aligned strings
+            (main_s, comp_s) will not be stored
+        row_group_size (int): maximum number of rows per parquet row group
+        srt_cache (bool): if True, recompress gzipped srt files
+            into the srt cache folder (see open_pair_file())
+        update_manifest (bool): if False, the pair file manifest
+            of the folder is not updated
+
+    Returns:
+        str (path to the store)
+    """
+    if pa is None:
+        raise ImportError("pyarrow is required for the alignment store")
+    if not store_fp:
+        store_fp = os.path.join(folder, STORE_FOLDER)
+    os.makedirs(os.path.dirname(os.path.abspath(store_fp)), exist_ok=True)
+    with file_lock(store_fp) as waited:
+        if waited and os.path.exists(os.path.join(store_fp, "_store_info.json")):
+            print("Alignment store already created by another process")
+            return store_fp
+        print("Converting srt files in", folder, "to alignment store", store_fp)
+        main = find_main_text(folder)
+        int_cols = ["comp_date", "main_ms", "main_bw", "main_ew",
+                    "comp_ms", "comp_bw", "comp_ew"]
+        str_cols = ["main_s", "comp_s"] if include_strings else []
+        cols = {col: [] for col in ["comp"] + int_cols + str_cols}
+        n_files = 0
+        file_info = dict()
+        for fn in os.listdir(folder):
+            if not is_pair_file(fn):
+                continue
+            comp, main_col, comp_col = get_pair_file_roles(fn, main)
+            if comp.split("-")[0] not in meta:
+                print(fn, "skipped:", comp, "not in metadata")
+                continue
+            n_files += 1
+            n_rows = 0
+            comp_date = int(meta[comp.split("-")[0]]["date"])
+            # keep only the last alignment with the same key
+            # (as in extract_milestone_data_from_file):
+            rows = dict()
+            with open_pair_file(os.path.join(folder, fn), srt_cache=srt_cache) as file:
+                for row in csv.DictReader(file, delimiter="\t"):
+                    main_ms = int(re.findall(r"\d+$", row["id"+main_col])[0])
+                    comp_ms = int(re.findall(r"\d+$", row["id"+comp_col])[0])
+                    comp_bw = int(row["bw"+comp_col])
+                    n_rows += 1
+                    rows[(main_ms, comp_ms, comp_bw)] = (
+                        main_ms, int(row["bw"+main_col]), int(row["ew"+main_col]),
+                        comp_ms, comp_bw, int(row["ew"+comp_col]),
+                        row["s"+main_col], row["s"+comp_col])
+            file_info[fn] = {"comp": comp, "n_rows": n_rows,
+                             "max_len": max([r[2]-r[1] for r in rows.values()], default=0),
+                             "main_ms": sorted(set(k[0] for k in rows))}
+            for r in rows.values():
+                cols["comp"].append(comp)
+                cols["comp_date"].append(comp_date)
+                for i, col in enumerate(int_cols[1:]):
+                    cols[col].append(r[i])
+                if include_strings:
+                    cols["main_s"].append(r[6])
+                    cols["comp_s"].append(r[7])
+
+        # build the table and write one file per date bucket:
+        arrays = {"comp": pa.array(cols["comp"], pa.string()).dictionary_encode()}
+        for col in int_cols:
+            arrays[col] = pa.array(cols[col], pa.int32())
+        for col in str_cols:
+            arrays[col] = pa.array(cols[col], pa.string())
+        table = pa.table(arrays)
+        buckets = (np.asarray(cols["comp_date"], dtype=np.int32) // bucket_size) * bucket_size
+        for bucket in np.unique(buckets):
+            part = table.filter(pa.array(buckets == bucket))
+            part = part.sort_by([("main_ms", "ascending"), ("main_bw", "ascending")])
+            part_folder = os.path.join(store_fp, "date_bucket={}".format(bucket))
+            os.makedirs(part_folder, exist_ok=True)
+            with atomic_write(os.path.join(part_folder, "part-0.parquet"), mode="wb") as file:
+                pq.write_table(part, file, row_group_size=row_group_size,
+                               compression="zstd")
+
+        # save information about the store:
+        info = {"main": main, "bucket_size": bucket_size, "n_files": n_files,
+                "n_rows": table.num_rows, "columns": ["comp"] + int_cols + str_cols,
+                "comps": sorted(set(d["comp"] for d in file_info.values()))}
+        with atomic_write(os.path.join(store_fp, "_store_info.json")) as file:
+            json.dump(info, file, ensure_ascii=False, indent=2)
+        if update_manifest:
+            save_pair_file_manifest(folder, main, file_info)
+        count_items(files=n_files, rows=table.num_rows)
+        print("Saved", table.num_rows, "alignments from", n_files, "srt files")
+    return store_fp
+
+def load_store_info(store_fp):
+    """Load the information file of an alignment store."""
+    with open(os.path.join(store_fp, "_store_info.json"), mode="r", encoding="utf-8") as file:
+        return json.load(file)
+
+def read_store(store_fp, columns, date_ranges=None, comps=None,
+               min_alignment_length=0, milestone_range=None):
+    """Read selected columns from an alignment store.
+
+    Only the partitions that overlap with the date ranges are read,
+    and rows outside of the date ranges (or by other texts than `comps`,
+    or shorter than the minimum alignment length) are filtered out
+    while the parquet files are read (predicate pushdown).
+
+    Args:
+        store_fp (str): path to the alignment store
+        columns (list): names of the columns to be read
+        date_ranges (list): list of tuples (start_date, end_date);
+            start date is inclusive, end date exclusive.
+            Default: None (read all rows)
+        comps (list): ids of the compared texts to be read.
+            Default: None (all texts)
+        min_alignment_length (int): minimum number of tokens
+            an alignment should cover in the main text. Default: 0
+        milestone_range (tuple): (first milestone, last milestone (exclusive))
+            of the main text to be read. Default: None (all milestones)
+
+    Returns:
+        pyarrow Table
+    """
+    if pa is None:
+        raise ImportError("pyarrow is required for the alignment store")
+    bucket_size = load_store_info(store_fp)["bucket_size"]
+    dataset = ds.dataset(store_fp, format="parquet", partitioning="hive")
+    flt = None
+    for start, end in (date_ranges or []):
+        # the date_bucket condition prunes partitions before reading:
+        bucket_start = (start // bucket_size) * bucket_size
+        f = ((ds.field("date_bucket") >= bucket_start)
+             & (ds.field("date_bucket") < end)
+             & (ds.field("comp_date") >= start)
+             & (ds.field("comp_date") < end))
+        flt = f if flt is None else flt | f
+    if comps is not None:
+        f = ds.field("comp").isin(comps)
+        flt = f if flt is None else flt & f
+    if min_alignment_length:
+        f = pc.subtract(ds.field("main_ew"), ds.field("main_bw")) >= min_alignment_length
+        flt = f if flt is None else flt & f
+    if milestone_range:
+        # the store is sorted by main_ms, so that the row group statistics
+        # allow skipping most row groups:
+        f = ((ds.field("main_ms") >= milestone_range[0])
+             & (ds.field("main_ms") < milestone_range[1]))
+        flt = f if flt is None else flt & f
+    return dataset.to_table(columns=columns, filter=flt)
+
+def load_alignments_from_store(store_fp, date_ranges, status=None,
+                               min_alignment_length=0, columns=[],
+                               milestone_range=None):
+    """Load the main milestone, start and end token and text of all
+    alignments in the date ranges from an alignment store.
+
+    Args:
+        store_fp (str): path to the alignment store
+        date_ranges (list): list of tuples (start_date, end_date);
+            each alignment is assigned to the first range in which it fits
+        status (str or list): only include reuse by texts with this status
+            in the metadata (e.g., "pri"). Default: None (all texts)
+        min_alignment_length (int): only include alignments that cover
+            at least this number of tokens in the main text. Default: 0
+        columns (list): names of additional store columns to be loaded
+        milestone_range (tuple): (first milestone, last milestone (exclusive))
+            of the main text to be included. Default: None (all milestones)
+
+    Returns:
+        tuple (list of dictionaries of numpy arrays (one for each date range):
+                   {"ms": ..., "bw": ..., "ew": ..., "text": ..., <column>: ...},
+               list of text ids (the "text" arrays contain indexes in this list))
+    """
+    # select the compared texts that can contribute before reading:
+    comps = None
+    if status:
+        comps = [c for c in load_store_info(store_fp)["comps"]
+                 if comp_is_relevant(c, date_ranges, status)]
+    cols = ["comp", "comp_date", "main_ms", "main_bw", "main_ew"]
+    cols += [col for col in columns if col not in cols]
+    table = read_store(store_fp, cols, date_ranges, comps=comps,
+                       min_alignment_length=min_alignment_length,
+                       milestone_range=milestone_range)
+    dates = table["comp_date"].to_numpy()
+
+    # give each text (not each version of a text) an integer id:
+    encoded = pc.dictionary_encode(table["comp"]).combine_chunks()
+    text_ids = dict()
+    codes = [text_ids.setdefault(comp.split("-")[0], len(text_ids))
+             for comp in encoded.dictionary.to_pylist()]
+    texts = np.asarray(codes, dtype=np.int64)[encoded.indices.to_numpy()]
+
+    data = {"ms": table["main_ms"].to_numpy(), "bw": table["main_bw"].to_numpy(),
+            "ew": table["main_ew"].to_numpy(), "text": texts}
+    for col in columns:
+        data[col] = table[col].to_numpy()
+
+    # assign each alignment to the first date range in which it fits:
+    range_idx = np.full(len(dates), -1)
+    for x, r in enumerate(date_ranges):
+        range_idx[(range_idx == -1) & (r[0] <= dates) & (dates < r[1])] = x
+    alignments = []
+    for x in range(len(date_ranges)):
+        sel = range_idx == x
+        alignments.append({key: arr[sel] for key, arr in data.items()})
+    count_items(alignments=int((range_idx != -1).sum()))
+    return alignments, list(text_ids)
+
+@instrumented()
+def load_alignments(folder, date_ranges, status=None, min_alignment_length=0,
+                    columns=[], milestone_range=None):
+    """Load the main milestone, start and end token and text of all
+    alignments in the date ranges, from the alignment store of the folder
+    if it has one, and from the milestone json files otherwise.
+
+    See load_alignments_from_store() for the arguments and return value.
+    """
+    store_fp = os.path.join(folder, STORE_FOLDER)
+    if os.path.exists(store_fp):
+        return load_alignments_from_store(store_fp, date_ranges, status=status,
+                                          min_alignment_length=min_alignment_length,
+                                          columns=columns,
+                                          milestone_range=milestone_range)
+    if isinstance(status, str):
+        status = [status]
+    comp_dates = select_comp_dates(status)
+    fns = select_milestone_files(folder, date_ranges, status,
+                                 min_alignment_length, milestone_range)
+    alignments, text_ids = collect_alignments_from_ms_files(folder, fns, date_ranges,
+                                                            comp_dates,
+                                                            min_alignment_length,
+                                                            columns)
+    for a in alignments:
+        for key in a:
+            a[key] = np.asarray(a[key])
+    count_items(files=len(fns), alignments=sum(len(a["ms"]) for a in alignments))
+    return alignments, text_ids
+
+def milestone_alignments(folder, ms, date_ranges=None, status=None,
+                         min_alignment_length=0):
+    """List the alignments of a single milestone of the main text,
+    from the alignment store of the folder if it has one,
+    and from the milestone json file otherwise.
+
+    Args:
+        folder (str): path to the folder containing the milestone files
+        ms (int): milestone number in the main text
+        date_ranges (list): only include reuse by texts in these date ranges.
+            Default: None (all dates)
+        status (str or list): only include reuse by texts with this status
+            in the metadata (e.g., "pri"). Default: None (all texts)
+        min_alignment_length (int): only include alignments that cover
+            at least this number of tokens in the main text. Default: 0
+
+    Returns:
+        list (of dictionaries with keys "comp", "comp_date", "comp_ms",
+            "main_bw", "main_ew", "comp_bw", "comp_ew", "main_s", "comp_s",
+            sorted by main_bw; the strings are None if they were not stored)
+    """
+    rows = []
+    store_fp = os.path.join(folder, STORE_FOLDER)
+    if os.path.exists(store_fp):
+        info = load_store_info(store_fp)
+        comps = None
+        if status:
+            comps = [c for c in info["comps"] if comp_is_relevant(c, date_ranges, status)]
+        cols = ["comp", "comp_date", "comp_ms", "main_bw", "main_ew", "comp_bw", "comp_ew"]
+        cols += [col for col in ["main_s", "comp_s"] if col in info["columns"]]
+        table = read_store(store_fp, cols, date_ranges, comps=comps,
+                           min_alignment_length=min_alignment_length,
+                           milestone_range=(ms, ms+1))
+        for row in table.to_pylist():
+            row.setdefault("main_s", None)
+            row.setdefault("comp_s", None)
+            rows.append(row)
+    else:
+        fp = os.path.join(folder, "{}.json".format(ms))
+        data = load_ms_json(fp) if os.path.exists(fp) else dict()
+        for comp in data:
+            if not comp_is_relevant(comp, date_ranges, status):
+                continue
+            for comp_ms in data[comp]:
+                for d in data[comp][comp_ms].values():
+                    if d["main_ew"] - d["main_bw"] < min_alignment_length:
+                        continue
+                    row = {"comp": comp,
+                           "comp_date": int(meta[comp.split("-")[0]]["date"]),
+                           "comp_ms": int(comp_ms)}
+                    for key in ["main_bw", "main_ew", "comp_bw", "comp_ew"]:
+                        row[key] = d[key]
+                    row["main_s"] = d.get("main_s")
+                    row["comp_s"] = d.get("comp_s")
+                    rows.append(row)
+    return sorted(rows, key=lambda row: (row["main_bw"], row["comp"]))
+
+@instrumented()
+def calculate_token_reuse_freq_from_store(store_fp, date_ranges, status=None,
+                                          min_alignment_length=0,
+                                          metric="alignments", with_summary=False,
+                                          milestone_range=None):
+    """Calculate how often each token is reused in specific date ranges,
+    using the alignment store instead of the milestone json files.
+
+    Returns the same data structure as calculate_token_reuse_freq()
+    """
+    print("Calculating reuse frequency of each reused token from store...")
+    alignments, text_ids = load_alignments_from_store(store_fp, date_ranges,
+                                                      status=status,
+                                                      min_alignment_length=min_alignment_length,
+                                                      milestone_range=milestone_range)
+    ms_count_dicts = []
+    summaries = []
+    for a in alignments:
+        ms, bw, ew = a["ms"], a["bw"], a["ew"]
+        if metric == "texts":
+            ms, bw, ew = union_intervals_per_text(ms, bw, ew, a["text"])
+        ms_count_dicts.append(coverage_runs(ms, bw, ew))
+        if with_summary:
+            summaries.append(summarize_milestones(a["ms"], a["text"], ms_count_dicts[-1]))
+    if with_summary:
+        return ms_count_dicts, summaries
+    return ms_count_dicts
+
+def shard_of_text(text_id, n_shards):
+    """Assign a text to one of `n_shards` shards, with a hash of its id
+    that is the same in every process and on every machine
+    (unlike Python's hash())."""
+    return zlib.crc32(text_id.encode("utf-8")) % n_shards
+
+def shard_params(date_ranges, status=None, min_alignment_length=0,
+                 metric="alignments", milestone_range=None):
+    """Describe the selection of alignments of a sharded run
+    (saved in every shard, and checked before the shards are merged)."""
+    if isinstance(status, str):
+        status = [status]
+    return {"date_ranges": [list(dr) for dr in date_ranges],
+            "status": sorted(status) if status else None,
+            "min_alignment_length": min_alignment_length,
+            "metric": metric,
+            "milestone_range": list(milestone_range) if milestone_range else None}
+
+def shard_fp(folder, shard, n_shards, params):
+    """Get the path to the file of a shard of a text folder.
+    The file name contains a hash of the parameters of the run
+    (see shard_params()), so that the shards of different runs
+    do not get mixed up."""
+    key = hashlib.sha1(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()[:12]
+    return os.path.join(folder, SHARD_FOLDER,
+                        "shard_{}_{:04d}-of-{:04d}.npz".format(key, shard, n_shards))
+
+@instrumented()
+def compute_shard(folder, shard, n_shards, date_ranges, status=None,
+                  min_alignment_length=0, metric="alignments",
+                  milestone_range=None, srt_cache=False, comp_dates=None):
+    """Calculate the partial result of one shard of a text folder
+    and save it in the shard folder (see shard_worker()).
+
+    The srt files of the folder are divided into shards by a hash
+    of the id of the compared text (see shard_of_text()), so that
+    all versions of a text end up in the same shard; the counts
+    of the shards can therefore simply be added up, also with the
+    "texts" metric. The srt files are read directly
+    (no milestone json files are created).
+
+    A shard file (npz) is self-describing: its "info" array contains
+    a json string with the main text, the shard number, the parameters
+    of the run (see shard_params()), the srt files and texts included,
+    and the machine and process that created it; for each date range x,
+    "runs_x" contains the runs [ms, start, end, count]
+    (see coverage_runs()) and "summary_x" the milestone summary
+    (see summarize_milestones()) of the texts of the shard.
+
+    Args:
+        comp_dates (dict): death date of each text with the required
+            status (see select_comp_dates()). Default: None
+            (taken from the metadata, which is only available
+            in the main process and in forked processes)
+
+    See ms_data_heatmap() for the other arguments.
+
+    Returns:
+        str (path to the shard file)
+    """
+    params = shard_params(date_ranges, status, min_alignment_length, metric,
+                          milestone_range)
+    if comp_dates is None:
+        comp_dates = select_comp_dates(status)
+    main = find_main_text(folder)
+    fns = [fn for fn in plan_pair_files(folder, date_ranges, status, min_alignment_length,
+                                        comp_dates)
+           if os.path.exists(os.path.join(folder, fn))]
+    text_ids = dict()
+    files = []
+    alignments = [{"ms": [], "bw": [], "ew": [], "text": []} for dr in date_ranges]
+    for fn in fns:
+        comp, main_col, comp_col = get_pair_file_roles(fn, main)
+        comp_id = comp.split("-")[0]
+        if shard_of_text(comp_id, n_shards) != shard:
+            continue
+        x = [r[0] <= comp_dates[comp_id] < r[1] for r in date_ranges].index(True)
+        ms, bw, ew = read_pair_file_alignments(os.path.join(folder, fn),
+                                               main_col, comp_col, srt_cache=srt_cache)
+        keep = ew - bw >= min_alignment_length
+        if milestone_range:
+            keep &= (milestone_range[0] <= ms) & (ms < milestone_range[1])
+        ms, bw, ew = ms[keep], bw[keep], ew[keep]
+        text = np.full(len(ms), text_ids.setdefault(comp_id, len(text_ids)), dtype=np.int64)
+        for key, arr in zip(["ms", "bw", "ew", "text"], [ms, bw, ew, text]):
+            alignments[x][key].append(arr)
+        files.append(fn)
+        count_items(files=1, alignments=len(ms))
+
+    arrays = dict()
+    for x, a in enumerate(alignments):
+        ms, bw, ew, text = [np.concatenate(a[key]) if a[key] else np.zeros(0, dtype=np.int64)
+                            for key in ["ms", "bw", "ew", "text"]]
+        summary_ms = ms
+        if metric == "texts":
+            ms, bw, ew = union_intervals_per_text(ms, bw, ew, text)
+        ms_runs = coverage_runs(ms, bw, ew)
+        summary = summarize_milestones(summary_ms, text, ms_runs)
+        arrays["runs_{}".format(x)] = np.array(
+            [[m, start, end, count] for m in sorted(ms_runs)
+             for start, end, count in ms_runs[m]], dtype=np.int64).reshape(-1, 4)
+        arrays["summary_{}".format(x)] = np.stack(
+            [np.asarray(summary[col], dtype=np.int64) for col in SUMMARY_COLUMNS], axis=1)
+
+    info = {"main": main, "folder": os.path.basename(os.path.normpath(folder)),
+            "shard": shard, "n_shards": n_shards, "params": params,
+            "files": files, "texts": list(text_ids),
+            "host": socket.gethostname(), "pid": os.getpid(),
+            "created": time.strftime("%Y-%m-%d %H:%M:%S")}
+    fp = shard_fp(folder, shard, n_shards, params)
+    os.makedirs(os.path.dirname(fp), exist_ok=True)
+    with atomic_write(fp, mode="wb") as file:
+        np.savez_compressed(file, info=np.array(json.dumps(info, ensure_ascii=False)),
+                            **arrays)
+    return fp
+
+def load_shard(fp):
+    """Load a shard file (see compute_shard()).
+
+    Returns:
+        tuple (info dictionary,
+               list of runs arrays (n x 4) for each date range,
+               list of milestone summaries for each date range)
+    """
+    with np.load(fp) as data:
+        info = json.loads(str(data["info"]))
+        n_dr = len(info["params"]["date_ranges"])
+        runs = [data["runs_{}".format(x)] for x in range(n_dr)]
+        summaries = [{col: data["summary_{}".format(x)][:, i]
+                      for i, col in enumerate(SUMMARY_COLUMNS)}
+                     for x in range(n_dr)]
+    return info, runs, summaries
+
+def merge_shard_summaries(summaries, ms_runs):
+    """Merge the milestone summaries of the shards of a text folder.
+
+    The numbers of alignments and texts of the shards are added up
+    (every text is in only one shard); the number of reused tokens
+    and the highest count are taken from the merged runs.
+
+    Args:
+        summaries (list): milestone summaries of the shards
+            (see summarize_milestones())
+        ms_runs (dict): merged runs of each milestone (see coverage_runs())
+
+    Returns:
+        dict (of numpy arrays, see SUMMARY_COLUMNS)
+    """
+    merged = merge_summaries(summaries)
+    ms, inverse = np.unique(merged["ms"], return_inverse=True)
+    summary = {"ms": ms}
+    for col in ["alignments", "texts"]:
+        summary[col] = np.bincount(inverse, weights=merged[col],
+                                   minlength=len(ms)).astype(np.int64)
+    summary["reused_tokens"] = np.array([sum(end - start for start, end, count
+                                             in ms_runs.get(m, []))
+                                         for m in ms.tolist()], dtype=np.int64)
+    summary["max_value"] = np.array([max([0] + [count for start, end, count
+                                                in ms_runs.get(m, [])])
+                                     for m in ms.tolist()], dtype=np.int64)
+    return summary
+
+@instrumented()
+def merge_shards(folder, n_shards, date_ranges, status=None, min_alignment_length=0,
+                 metric="alignments", milestone_range=None):
+    """Merge the shards of a text folder (see compute_shard()) into
+    the lines and milestone summary of each date range, and save them
+    in the same files in which load_heatmap_lines() caches them,
+    so that ms_data_heatmap() (and the other heatmap functions)
+    use them without calculating anything.
+
+    The runs of the shards are added up with the same sweep line
+    that calculates the runs of the alignments (see coverage_runs()),
+    with the count of each run as its weight.
+
+    See ms_data_heatmap() for the other arguments.
+
+    Returns:
+        tuple (list of lists of lines for each date range
+               (see create_plot_lines()),
+               list of milestone summaries for each date range)
+    """
+    params = shard_params(date_ranges, status, min_alignment_length, metric,
+                          milestone_range)
+    fps = [shard_fp(folder, shard, n_shards, params) for shard in range(n_shards)]
+    missing = [shard for shard, fp in enumerate(fps) if not os.path.exists(fp)]
+    if missing:
+        raise FileNotFoundError("shards {} of {} missing in {}".format(
+            missing, n_shards, folder))
+    print("Merging", n_shards, "shards of", folder)
+    main = None
+    runs = [[] for dr in date_ranges]
+    summaries = [[] for dr in date_ranges]
+    for fp in fps:
+        info, shard_runs, shard_summaries = load_shard(fp)
+        if info["params"] != params or info["n_shards"] != n_shards:
+            raise ValueError("shard {} was created with other parameters".format(fp))
+        if main and info["main"] != main:
+            raise ValueError("the shards in {} are not of the same main text: {} and {}".format(
+                folder, main, info["main"]))
+        main = info["main"]
+        for x in range(len(date_ranges)):
+            runs[x].append(shard_runs[x])
+            summaries[x].append(shard_summaries[x])
+        count_items(shards=1, files=len(info["files"]))
+
+    ms_count_dicts = []
+    merged_summaries = []
+    for x in range(len(date_ranges)):
+        r = np.concatenate(runs[x])
+        ms_runs = coverage_runs(r[:, 0], r[:, 1], r[:, 2], weights=r[:, 3])
+        ms_count_dicts.append(ms_runs)
+        merged_summaries.append(merge_shard_summaries(summaries[x], ms_runs))
+    suffix = cache_file_suffix(status, min_alignment_length, metric, milestone_range)
+    split_fps, summary_fps = heatmap_cache_fps(folder, date_ranges, suffix)
+    # hold the same locks as load_heatmap_lines() while writing the files:
+    with ExitStack() as stack:
+        for fp in sorted(split_fps):
+            stack.enter_context(file_lock(fp))
+        for summary, fp in zip(merged_summaries, summary_fps):
+            save_summary_csv(summary, fp)
+        return create_plot_lines(ms_count_dicts, split_fps), merged_summaries
+
+@instrumented()
+def shard_worker(folders, n_shards, date_ranges, status=None, min_alignment_length=0,
+                 metric="alignments", milestone_range=None, srt_cache=False,
+                 merge=True, comp_dates=None):
+    """Calculate the unclaimed shards of one or more text folders
+    (a worker of the sharded mode, for processing the whole corpus
+    on several machines).
+
+    Any number of workers (processes on one or more machines that share
+    the text folders) can run at the same time, without a queue
+    or cluster manager: each worker claims a shard by locking its file
+    (see file_lock()); shards that are locked by another worker
+    or that have already been saved are skipped, so that workers
+    that crashed can simply be started again (without fcntl, e.g. on
+    Windows, the lock files of workers that crashed on another machine,
+    `<folder>/_shards/*.lock`, must be removed first; see file_lock()).
+    Work is divided by main text (with n_shards=1, every folder
+    is one shard) and within each folder by compared text
+    (see compute_shard()).
+
+    Args:
+        folders (str or list): path(s) to the text folder(s)
+        n_shards (int): number of shards of each folder
+        merge (bool): if True, the shards of each folder are merged
+            (see merge_shards()) by the worker that finds all of them saved,
+            unless the lines and summaries have already been saved
+        comp_dates (dict): see compute_shard()
+
+    See ms_data_heatmap() for the other arguments.
+
+    Returns:
+        list (paths to the shard files saved by this worker)
+    """
+    if isinstance(folders, str):
+        folders = [folders]
+    params = shard_params(date_ranges, status, min_alignment_length, metric,
+                          milestone_range)
+    if comp_dates is None:
+        comp_dates = select_comp_dates(status)
+    kwargs = dict(status=status, min_alignment_length=min_alignment_length,
+                  metric=metric, milestone_range=milestone_range)
+    saved = []
+    for folder in folders:
+        fps = [shard_fp(folder, shard, n_shards, params) for shard in range(n_shards)]
+        os.makedirs(os.path.join(folder, SHARD_FOLDER), exist_ok=True)
+        for shard, fp in enumerate(fps):
+            if os.path.exists(fp):
+                continue
+            with ExitStack() as stack:
+                try:
+                    stack.enter_context(file_lock(fp, timeout=0))
+                except TimeoutError:
+                    continue  # claimed by another worker
+                if not os.path.exists(fp):
+                    print("Calculating shard {} of {} of {}".format(shard, n_shards, folder))
+                    saved.append(compute_shard(folder, shard, n_shards, date_ranges,
+                                               srt_cache=srt_cache, comp_dates=comp_dates,
+                                               **kwargs))
+        if not merge or not all(os.path.exists(fp) for fp in fps):
+            continue
+        merge_fp = re.sub(r"_\d+-of-\d+\.npz$", "_merge", fps[0])
+        with ExitStack() as stack:
+            try:
+                stack.enter_context(file_lock(merge_fp, timeout=0))
+            except TimeoutError:
+                continue  # being merged by another worker
+            suffix = cache_file_suffix(status, min_alignment_length, metric, milestone_range)
+            split_fps, summary_fps = heatmap_cache_fps(folder, date_ranges, suffix)
+            if not all(os.path.exists(fp) for fp in split_fps + summary_fps):
+                merge_shards(folder, n_shards, date_ranges, **kwargs)
+    return saved
+
+@instrumented()
+def sharded_heatmap_data(folders, date_ranges, n_shards=8, workers=None, status=None,
+                         min_alignment_length=0, metric="alignments",
+                         milestone_range=None, srt_cache=False):
+    """Calculate the heatmap data of one or more text folders
+    in the sharded mode on this machine: start a number of worker
+    processes (see shard_worker()) that share the shards of all folders,
+    and merge the shards of each folder.
+    To use more machines, start shard_worker() (or
+    `python milestone_text_reuse_heatmap.py shard-worker ...`)
+    on each of them with the same arguments.
+
+    Args:
+        folders (str or list): path(s) to the text folder(s)
+        n_shards (int): number of shards of each folder
+        workers (int): number of worker processes. Default: None
+            (number of CPUs)
+
+    See ms_data_heatmap() for the other arguments.
+
+    Returns:
+        list (paths to the shard files saved by the workers)
+    """
+    workers = workers or os.cpu_count() or 1
+    # the worker processes get the dates of the texts as an argument,
+    # since they may not have the metadata:
+    comp_dates = select_comp_dates(status)
+    with ProcessPoolExecutor(workers) as pool:
+        futures = [pool.submit(shard_worker, folders, n_shards, date_ranges,
+                               status=status, min_alignment_length=min_alignment_length,
+                               metric=metric, milestone_range=milestone_range,
+                               srt_cache=srt_cache, comp_dates=comp_dates)
+                   for i in range(workers)]
+        return [fp for future in as_completed(futures) for fp in future.result()]
+
+def sharded_cli(command, argv=None):
+    """Command line interface for the sharded mode:
+
+        python milestone_text_reuse_heatmap.py shard-worker folder [folder ...] --shards 8 ...
+        python milestone_text_reuse_heatmap.py merge-shards folder [folder ...] --shards 8 ...
+
+    (see shard_worker() and merge_shards())
+    """
+    parser = argparse.ArgumentParser(prog="milestone_text_reuse_heatmap.py " + command,
+                                     description="Calculate (shard-worker) or merge "
+                                                 "(merge-shards) the shards of text folders.")
+    parser.add_argument("folders", nargs="+", help="text folders with srt files")
+    parser.add_argument("--shards", type=int, default=8, help="number of shards per folder")
+    parser.add_argument("--split-dates", type=int, nargs="*", default=None,
+                        help="dates that divide the date ranges "
+                             "(see split_dates_to_date_ranges()); default: one date range")
+    parser.add_argument("--status", nargs="*", help="e.g., pri")
+    parser.add_argument("--min-alignment-length", type=int, default=0)
+    parser.add_argument("--metric", choices=["alignments", "texts"], default="alignments")
+    parser.add_argument("--milestone-range", type=int, nargs=2, default=None,
+                        metavar=("FIRST", "END"))
+    parser.add_argument("--srt-cache", action="store_true")
+    parser.add_argument("--no-merge", action="store_true",
+                        help="shard-worker: do not merge the completed folders")
+    parser.add_argument("--meta", help="path to the metadata file")
+    args = parser.parse_args(argv)
+
+    meta.update(load_metadata(args.meta) if args.meta else load_metadata())
+    date_ranges = split_dates_to_date_ranges(args.split_dates) if args.split_dates \
+                  else [(0, 1501)]
+    kwargs = dict(status=args.status, min_alignment_length=args.min_alignment_length,
+                  metric=args.metric, milestone_range=args.milestone_range)
+    if command == "shard-worker":
+        saved = shard_worker(args.folders, args.shards, date_ranges,
+                             srt_cache=args.srt_cache, merge=not args.no_merge, **kwargs)
+        print("Saved", len(saved), "shards")
+    else:
+        for folder in args.folders:
+            merge_shards(folder, args.shards, date_ranges, **kwargs)
 
 def download_file(url, filepath):
     """
@@ -572,57 +5119,71 @@ def download_srt_files(base_url, main_text_id, outfolder, incl_sec=False):
         else:
             print("    already in folder")
 
-meta = load_metadata()
-
-##folder = r"D:\London\publications\co-authored vol\geographers_srts_2019\0367IbnHawqal.SuratArd"
-##for fn in os.listdir(folder):
-##    if fn.endswith(".csv"):
-##        id2 = re.sub("-.+", "", fn.split("_")[1])
-##        if meta[id2]["date"] < 400:
-##            print(id2, meta[id2])
-##input("continue?")        
-##        
-
-
-base_url = "http://dev.kitab-project.org/passim01022021/"
-text_id = "Shamela0009788-ara1.mARkdown"
-folder = r"D:\London\publications\co-authored vol\geographers_srts_2019\0310Tabari.Tarikh"
-#download_srt_files(base_url, text_id, folder)
-folder = r"C:\Users\peter\Downloads\Dharica"
-#extract_milestone_data_from_folder(folder)
-split_dates = [1389]
-folder = r"D:\London\publications\co-authored vol\geographers_srts_2019\0367IbnHawqal.SuratArd"
-split_dates = [367, 500, 700, 900, 1100, 1300]
-split_dates = [0]
-
-folder = r"D:\London\publications\co-authored vol\geographers_srts_2019\0310Tabari.Tarikh"
-split_dates = [310, 500, 700, 900, 1100, 1300]
-#split_dates = [0]
-
-
-date_ranges = split_dates_to_date_ranges(split_dates)
-folder_name = os.path.split(folder)[-1]
-ms_data_heatmap(folder, date_ranges=date_ranges, cmap=inferno,
-#                outfp="output_images/{}_{}_filtered.html".format(folder_name, split_dates[0]),
-#                filter_date_ranges=[0],
-                outfp="output_images/{}_{}.html".format(folder_name, split_dates[0]),
-                filter_date_ranges=[],
-                plot_func=plot_with_bokeh)
-
-input("continue?")
-split_dates = [300, 500, 700, 900, 1100]
-date_ranges = split_dates_to_date_ranges(split_dates)
-ms_data_heatmap(os.path.join(parent, folder),
-                date_ranges=date_ranges, cmap=plt.cm.inferno_r,
-                #filter_date_ranges=[0],
-                outfp="output_images/{}_{}.png".format(folder, split_dates[0]))
-
-parent = r"D:\London\publications\co-authored vol\geographers_srts_2019"
-##for folder in os.listdir(parent):
-##    if os.path.isdir(os.path.join(parent, folder)):
-##        
-##        split_dates = [int(folder[:4]),]
-##        date_ranges = split_dates_to_date_ranges(split_dates)
-##        ms_data_heatmap(os.path.join(parent, folder),
-##                        date_ranges=date_ranges, cmap=plt.cm.inferno_r,
-##                        outfp="output_images/{}_{}.png".format(folder, split_dates[0]))
+# metadata of all texts (loaded when the script is run, see below):
+meta = dict()
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["top-passages"]:
+        top_reused_passages_cli(sys.argv[2:])
+        sys.exit()
+    if sys.argv[1:2] in (["shard-worker"], ["merge-shards"]):
+        sharded_cli(sys.argv[1], sys.argv[2:])
+        sys.exit()
+
+    meta = load_metadata()
+
+    ##folder = r"D:\London\publications\co-authored vol\geographers_srts_2019\0367IbnHawqal.SuratArd"
+    ##for fn in os.listdir(folder):
+    ##    if fn.endswith(".csv"):
+    ##        id2 = re.sub("-.+", "", fn.split("_")[1])
+    ##        if meta[id2]["date"] < 400:
+    ##            print(id2, meta[id2])
+    ##input("continue?")        
+    ##        
+
+
+    base_url = "http://dev.kitab-project.org/passim01022021/"
+    text_id = "Shamela0009788-ara1.mARkdown"
+    folder = r"D:\London\publications\co-authored vol\geographers_srts_2019\0310Tabari.Tarikh"
+    #download_srt_files(base_url, text_id, folder)
+    folder = r"C:\Users\peter\Downloads\Dharica"
+    #extract_milestone_data_from_folder(folder)
+    #convert_srt_folder_to_store(folder)
+    #build_srt_cache(folder)
+    split_dates = [1389]
+    folder = r"D:\London\publications\co-authored vol\geographers_srts_2019\0367IbnHawqal.SuratArd"
+    split_dates = [367, 500, 700, 900, 1100, 1300]
+    split_dates = [0]
+
+    folder = r"D:\London\publications\co-authored vol\geographers_srts_2019\0310Tabari.Tarikh"
+    split_dates = [310, 500, 700, 900, 1100, 1300]
+    #split_dates = [0]
+
+
+    date_ranges = split_dates_to_date_ranges(split_dates)
+    folder_name = os.path.split(folder)[-1]
+    ms_data_heatmap(folder, date_ranges=date_ranges, cmap=inferno,
+    #                outfp="output_images/{}_{}_filtered.html".format(folder_name, split_dates[0]),
+    #                filter_date_ranges=[0],
+                    outfp="output_images/{}_{}.html".format(folder_name, split_dates[0]),
+                    filter_date_ranges=[],
+                    plot_func=plot_with_bokeh)
+    #serve_heatmap(folder, date_ranges=date_ranges, cmap=inferno)
+
+    input("continue?")
+    split_dates = [300, 500, 700, 900, 1100]
+    date_ranges = split_dates_to_date_ranges(split_dates)
+    ms_data_heatmap(os.path.join(parent, folder),
+                    date_ranges=date_ranges, cmap=plt.cm.inferno_r,
+                    #filter_date_ranges=[0],
+                    outfp="output_images/{}_{}.png".format(folder, split_dates[0]))
+
+    parent = r"D:\London\publications\co-authored vol\geographers_srts_2019"
+    ##for folder in os.listdir(parent):
+    ##    if os.path.isdir(os.path.join(parent, folder)):
+    ##        
+    ##        split_dates = [int(folder[:4]),]
+    ##        date_ranges = split_dates_to_date_ranges(split_dates)
+    ##        ms_data_heatmap(os.path.join(parent, folder),
+    ##                        date_ranges=date_ranges, cmap=plt.cm.inferno_r,
+    ##                        outfp="output_images/{}_{}.png".format(folder, split_dates[0]))
@@ -0,0 +1,39 @@
+import os
+import sys
+import shutil
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import matplotlib
+matplotlib.use("Agg")
+
+import milestone_text_reuse_heatmap as heatmap
+import benchmark_heatmap
+
+
+@pytest.fixture(scope="session")
+def synthetic_source(tmp_path_factory):
+    """A small folder of synthetic srt files (see
+    benchmark_heatmap.generate_synthetic_folder()) and its metadata file;
+    tests must not write into it (use the `text_folder` fixture)."""
+    folder = str(tmp_path_factory.mktemp("synthetic") / "Synth0000001")
+    meta_fp = benchmark_heatmap.generate_synthetic_folder(
+        folder, n_pairs=12, n_rows=150, n_ms=30, ms_tokens=120, comp_ms=50,
+        mean_length=25, seed=1)
+    return folder, meta_fp
+
+
+@pytest.fixture
+def text_folder(synthetic_source, tmp_path):
+    """A fresh copy of the synthetic folder, with its metadata loaded."""
+    source, meta_fp = synthetic_source
+    folder = str(tmp_path / "Synth0000001")
+    shutil.copytree(source, folder)
+    saved_meta = dict(heatmap.meta)
+    heatmap.meta.clear()
+    heatmap.meta.update(heatmap.load_metadata(meta_fp))
+    yield folder
+    heatmap.meta.clear()
+    heatmap.meta.update(saved_meta)
@@ -0,0 +1,666 @@
+import os
+import re
+import csv
+import gzip
+import json
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+
+import numpy as np
+import pytest
+
+import milestone_text_reuse_heatmap as heatmap
+
+
+DATE_RANGES = [(0, 700), (700, 1501)]
+
+
+def srt_alignments(folder):
+    """Read the alignments of every compared text in the srt files
+    of `folder` ({text id: list of (ms, bw, ew)}), keeping only the last
+    alignment with the same main milestone, comp milestone and comp_bw
+    (like the milestone json files)."""
+    main = heatmap.find_main_text(folder)
+    alignments = dict()
+    for fn in sorted(os.listdir(folder)):
+        if not heatmap.is_pair_file(fn):
+            continue
+        comp, main_col, comp_col = heatmap.get_pair_file_roles(fn, main)
+        fp = os.path.join(folder, fn)
+        opener = gzip.open if fn.endswith(".gz") else open
+        rows = dict()
+        with opener(fp, mode="rt", encoding="utf-8", newline="") as file:
+            for row in csv.DictReader(file, delimiter="\t"):
+                main_ms = int(re.findall(r"\d+$", row["id"+main_col])[0])
+                comp_ms = int(re.findall(r"\d+$", row["id"+comp_col])[0])
+                rows[(main_ms, comp_ms, int(row["bw"+comp_col]))] = (
+                    main_ms, int(row["bw"+main_col]), int(row["ew"+main_col]))
+        alignments.setdefault(comp.split("-")[0], []).extend(rows.values())
+    return alignments
+
+
+def brute_force_counts(folder, date_range, metric="alignments", status=None,
+                       min_alignment_length=0, milestone_range=None):
+    """Count every reused token one by one ({(ms, token): count})."""
+    counts = Counter()
+    for text, rows in srt_alignments(folder).items():
+        d = heatmap.meta[text]
+        if not date_range[0] <= d["date"] < date_range[1]:
+            continue
+        if status and d["status"] != status:
+            continue
+        tokens = [(ms, token) for ms, bw, ew in rows
+                  if ew - bw >= min_alignment_length
+                  and (not milestone_range or milestone_range[0] <= ms < milestone_range[1])
+                  for token in range(bw, ew)]
+        counts.update(set(tokens) if metric == "texts" else tokens)
+    return dict(counts)
+
+
+def runs_to_counts(ms_runs):
+    return {(ms, token): count for ms, runs in ms_runs.items()
+            for start, end, count in runs for token in range(start, end)}
+
+
+def lines_to_counts(lines):
+    return {(x[0], token): v for x, y, v in lines for token in range(y[0], y[1])}
+
+
+def serial_lines(folder, **kwargs):
+    heatmap.extract_milestone_data_from_folder(folder)
+    return heatmap.load_heatmap_lines(folder, DATE_RANGES, with_summary=True, **kwargs)
+
+
+def test_coverage_runs_match_per_token_count():
+    rnd = np.random.default_rng(0)
+    n = 500
+    ms = rnd.integers(0, 20, n)
+    bw = rnd.integers(0, 200, n)
+    ew = bw + rnd.integers(0, 60, n)
+    texts = rnd.integers(0, 15, n)
+    expected = Counter((m, t) for m, b, e in zip(ms, bw, ew) for t in range(b, e))
+    assert runs_to_counts(heatmap.coverage_runs(ms, bw, ew)) == dict(expected)
+
+    expected = Counter(set((m, x, t) for m, b, e, x in zip(ms, bw, ew, texts)
+                           for t in range(b, e)))
+    expected = Counter((m, t) for m, x, t in expected)
+    u_ms, u_bw, u_ew = heatmap.union_intervals_per_text(ms, bw, ew, texts)
+    assert runs_to_counts(heatmap.coverage_runs(u_ms, u_bw, u_ew)) == dict(expected)
+
+
+@pytest.mark.parametrize("metric", ["alignments", "texts"])
+def test_token_reuse_freq_matches_brute_force(text_folder, metric):
+    heatmap.extract_milestone_data_from_folder(text_folder)
+    ms_count_dicts = heatmap.calculate_token_reuse_freq(text_folder, DATE_RANGES,
+                                                        workers=1, metric=metric)
+    for dr, ms_runs in zip(DATE_RANGES, ms_count_dicts):
+        assert runs_to_counts(ms_runs) == brute_force_counts(text_folder, dr, metric)
+
+
+def test_filters_match_brute_force(text_folder):
+    heatmap.extract_milestone_data_from_folder(text_folder)
+    ms_count_dicts = heatmap.calculate_token_reuse_freq(text_folder, DATE_RANGES,
+                                                        status="pri",
+                                                        min_alignment_length=30,
+                                                        workers=1)
+    for dr, ms_runs in zip(DATE_RANGES, ms_count_dicts):
+        assert runs_to_counts(ms_runs) == brute_force_counts(
+            text_folder, dr, status="pri", min_alignment_length=30)
+
+
+@pytest.mark.parametrize("metric", ["alignments", "texts"])
+def test_store_equals_milestone_files(text_folder, tmp_path, metric):
+    pytest.importorskip("pyarrow")
+    heatmap.extract_milestone_data_from_folder(text_folder)
+    from_json = heatmap.calculate_token_reuse_freq(text_folder, DATE_RANGES,
+                                                   workers=1, metric=metric,
+                                                   with_summary=True)
+    store_fp = heatmap.convert_srt_folder_to_store(text_folder,
+                                                   store_fp=str(tmp_path / "store"))
+    from_store = heatmap.calculate_token_reuse_freq_from_store(store_fp, DATE_RANGES,
+                                                               metric=metric,
+                                                               with_summary=True)
+    for x in range(len(DATE_RANGES)):
+        assert runs_to_counts(from_store[0][x]) == runs_to_counts(from_json[0][x])
+        for col in heatmap.SUMMARY_COLUMNS:
+            assert np.array_equal(from_store[1][x][col], from_json[1][x][col])
+
+
+def test_milestone_range_equals_restricted_full_result(text_folder):
+    heatmap.extract_milestone_data_from_folder(text_folder)
+    full = heatmap.calculate_token_reuse_freq(text_folder, DATE_RANGES, workers=1)
+    window = heatmap.calculate_token_reuse_freq(text_folder, DATE_RANGES, workers=1,
+                                                milestone_range=(10, 20))
+    for full_runs, window_runs in zip(full, window):
+        assert window_runs == {ms: runs for ms, runs in full_runs.items() if 10 <= ms < 20}
+
+
+@pytest.mark.parametrize("metric", ["alignments", "texts"])
+def test_merged_shards_equal_serial_result(text_folder, metric):
+    lines, max_val, last_ms, summaries = serial_lines(text_folder, metric=metric)
+    # the second worker finds all shards saved:
+    for worker in range(2):
+        heatmap.shard_worker(text_folder, 3, DATE_RANGES, metric=metric, merge=False)
+    merged_lines, merged_summaries = heatmap.merge_shards(text_folder, 3, DATE_RANGES,
+                                                          metric=metric)
+    for x in range(len(DATE_RANGES)):
+        assert lines_to_counts(merged_lines[x]) == lines_to_counts(lines[x])
+        for col in heatmap.SUMMARY_COLUMNS:
+            assert np.array_equal(merged_summaries[x][col], summaries[x][col])
+
+
+def test_sharded_workers_write_the_heatmap_cache(text_folder):
+    heatmap.sharded_heatmap_data(text_folder, DATE_RANGES, n_shards=4, workers=2)
+    lines = heatmap.load_heatmap_lines(text_folder, DATE_RANGES)[0]
+    for dr, dr_lines in zip(DATE_RANGES, lines):
+        assert lines_to_counts(dr_lines) == brute_force_counts(text_folder, dr)
+
+
+def test_merge_shards_requires_all_shards(text_folder):
+    heatmap.compute_shard(text_folder, 0, 2, DATE_RANGES)
+    with pytest.raises(FileNotFoundError):
+        heatmap.merge_shards(text_folder, 2, DATE_RANGES)
+
+
+def test_filtered_extractions_keep_earlier_data(text_folder):
+    heatmap.extract_milestone_data_from_folder(text_folder, date_ranges=[DATE_RANGES[0]])
+    heatmap.extract_milestone_data_from_folder(text_folder, date_ranges=[DATE_RANGES[1]])
+    ms_count_dicts = heatmap.calculate_token_reuse_freq(text_folder, DATE_RANGES, workers=1)
+    for dr, ms_runs in zip(DATE_RANGES, ms_count_dicts):
+        assert runs_to_counts(ms_runs) == brute_force_counts(text_folder, dr)
+
+
+def test_texts_missing_from_metadata_are_skipped(text_folder):
+    fn = sorted(fn for fn in os.listdir(text_folder) if fn.endswith(".csv"))[0]
+    with open(os.path.join(text_folder, fn), mode="r", encoding="utf-8") as file:
+        data = file.read()
+    stray = "Stray0000001-ara1_Synth0000001-ara1.csv"
+    with open(os.path.join(text_folder, stray), mode="w", encoding="utf-8") as file:
+        file.write(data)
+    assert stray not in heatmap.plan_pair_files(text_folder)
+    heatmap.extract_milestone_data_from_folder(text_folder)
+
+
+def test_atomic_write_keeps_old_file_on_error(tmp_path):
+    fp = str(tmp_path / "data.json")
+    with heatmap.atomic_write(fp) as file:
+        json.dump([1], file)
+    with pytest.raises(RuntimeError):
+        with heatmap.atomic_write(fp) as file:
+            file.write("[2")
+            raise RuntimeError("interrupted")
+    with open(fp, mode="r", encoding="utf-8") as file:
+        assert json.load(file) == [1]
+    assert os.listdir(str(tmp_path)) == ["data.json"]
+
+
+def test_stale_lock_file_is_removed(tmp_path, monkeypatch):
+    monkeypatch.setattr(heatmap, "fcntl", None)
+    fp = str(tmp_path / "shard.npz")
+    dead = subprocess.Popen([sys.executable, "-c", "pass"])
+    dead.wait()
+    with open(fp + ".lock", mode="w", encoding="utf-8") as file:
+        file.write("{} {} 2020-01-01 00:00:00".format(dead.pid, socket.gethostname()))
+    with heatmap.file_lock(fp, timeout=0) as waited:
+        assert not waited
+    assert not os.path.exists(fp + ".lock")
+
+    # the lock of a running process is respected:
+    with open(fp + ".lock", mode="w", encoding="utf-8") as file:
+        file.write("{} {} 2020-01-01 00:00:00".format(os.getppid(), socket.gethostname()))
+    with pytest.raises(TimeoutError):
+        with heatmap.file_lock(fp, timeout=0):
+            pass
+
+
+def test_max_grid_end_token_is_exclusive():
+    lines = heatmap.lines_to_arrays([[[0, 0], [0, 5], 3], [[0, 0], [5, 8], 7],
+                                     [[1, 0], [2, 4], 5]])
+    grid = heatmap.max_grid(lines, 0, 1, 2)
+    assert grid.tolist() == [[3, 3, 3, 3, 3, 7, 7, 7], [0, 0, 5, 5, 0, 0, 0, 0]]
+    grid = heatmap.max_grid(lines, 0, 2, 1, token_bin=4)
+    assert grid.tolist() == [[5, 7]]
+
+
+def test_srt_cache_round_trip(text_folder):
+    pytest.importorskip("zstandard")
+    fps = [os.path.join(text_folder, fn) for fn in sorted(os.listdir(text_folder))
+           if heatmap.is_pair_file(fn) and fn.endswith(".gz")]
+    assert fps
+    for fp in fps:
+        with gzip.open(fp, mode="rt", encoding="utf-8") as file:
+            expected = file.readlines()
+        cache_fp = heatmap.get_srt_cache_fp(fp)
+        index = heatmap.transcode_srt_file(fp, cache_fp, block_lines=7)
+        assert len(index["blocks"]) == -(-(len(expected) - 1) // 7)
+        assert sum(n_lines for offset, size, n_lines in index["blocks"]) == len(expected) - 1
+        assert heatmap.load_srt_cache_index(fp, cache_fp) == index
+        assert list(heatmap.read_transcoded_srt_file(cache_fp, index, workers=3)) == expected
+        with heatmap.open_pair_file(fp) as file:
+            assert list(file) == expected
+
+    # a changed srt file invalidates its recompressed copy:
+    os.utime(fps[0], (0, 0))
+    assert heatmap.load_srt_cache_index(fps[0], heatmap.get_srt_cache_fp(fps[0])) is None
+
+
+def test_srt_cache_gives_the_same_milestone_data(text_folder):
+    pytest.importorskip("zstandard")
+    heatmap.build_srt_cache(text_folder, block_lines=11)
+    heatmap.extract_milestone_data_from_folder(text_folder)
+    ms_count_dicts = heatmap.calculate_token_reuse_freq(text_folder, DATE_RANGES, workers=1)
+    for dr, ms_runs in zip(DATE_RANGES, ms_count_dicts):
+        assert runs_to_counts(ms_runs) == brute_force_counts(text_folder, dr)
+
+
+@pytest.mark.parametrize("executor", ["thread", "process"])
+def test_worker_pool_gives_the_serial_result(text_folder, executor):
+    heatmap.extract_milestone_data_from_folder(text_folder)
+    serial = heatmap.calculate_token_reuse_freq(text_folder, DATE_RANGES, workers=1,
+                                                with_summary=True)
+    pool = heatmap.calculate_token_reuse_freq(text_folder, DATE_RANGES, workers=3,
+                                              executor=executor, with_summary=True,
+                                              min_pool_files=0)
+    assert json.dumps(pool[0]) == json.dumps(serial[0])
+    for x in range(len(DATE_RANGES)):
+        for col in heatmap.SUMMARY_COLUMNS:
+            assert np.array_equal(pool[1][x][col], serial[1][x][col])
+
+
+def brute_force_contributors(folder, date_range):
+    """Count the alignments of each text that cover each reused token
+    ({(ms, token): {text id: count}})."""
+    contributors = dict()
+    for text, rows in srt_alignments(folder).items():
+        if not date_range[0] <= heatmap.meta[text]["date"] < date_range[1]:
+            continue
+        for ms, bw, ew in rows:
+            for token in range(bw, ew):
+                counts = contributors.setdefault((ms, token), Counter())
+                counts[text] += 1
+    return contributors
+
+
+def test_contributor_index_matches_brute_force(text_folder, tmp_path):
+    heatmap.extract_milestone_data_from_folder(text_folder)
+    indexes = heatmap.build_contributor_indexes(text_folder, DATE_RANGES)
+    for dr, index in zip(DATE_RANGES, indexes):
+        expected = brute_force_contributors(text_folder, dr)
+        contributors = dict()
+        for i in range(len(index["ms"])):
+            a, b = index["indptr"][i], index["indptr"][i+1]
+            counts = Counter({index["text_ids"][t]: c for t, c in
+                              zip(index["texts"][a:b], index["counts"][a:b])})
+            for token in range(index["start"][i], index["end"][i]):
+                contributors[(index["ms"][i], token)] = counts
+        assert contributors == expected
+
+        # tokens of each text in the passage ms 3 token 40 - ms 5 token 60:
+        tokens = Counter()
+        for (ms, token), counts in expected.items():
+            if (3, 40) <= (ms, token) < (5, 60):
+                tokens.update(counts)
+        assert tokens
+        top = heatmap.top_contributors(index, 3, 5, 40, 60, n=len(tokens))
+        assert {d["text"]: d["tokens"] for d in top} == dict(tokens)
+        assert [d["tokens"] for d in top] == sorted(tokens.values(), reverse=True)
+
+        fp = str(tmp_path / "index.npz")
+        heatmap.save_contributor_index(index, fp)
+        loaded = heatmap.load_contributor_index(fp)
+        assert loaded["text_ids"] == index["text_ids"]
+        for key in ["ms", "start", "end", "indptr", "texts", "counts"]:
+            assert np.array_equal(loaded[key], index[key])
+
+
+def test_sidecar_data_round_trip(text_folder, tmp_path):
+    split_data_lines = serial_lines(text_folder)[0]
+    outfp = str(tmp_path / "heatmap.html")
+    heatmap.ms_data_heatmap(text_folder, DATE_RANGES, cmap=heatmap.inferno,
+                            plot_func=heatmap.plot_with_bokeh,
+                            outfp=outfp, mode="sidecar", show_plot=False)
+    with open(outfp, mode="r", encoding="utf-8") as file:
+        manifest = json.loads(re.findall(r"const manifest = (.+);", file.read())[0])
+    assert sorted(os.listdir(str(tmp_path / "heatmap_data"))) == ["lines_0.bin", "lines_1.bin"]
+    for i, lines in enumerate(split_data_lines):
+        m = manifest["lines_{}".format(i)]
+        # x0 and x1 are identical and stored only once:
+        assert m["aliases"] == {"x1": "x0"}
+        arr = np.fromfile(str(tmp_path / m["url"]), dtype="<i4").reshape(len(m["columns"]), -1)
+        data = dict(zip(m["columns"], arr.tolist()))
+        assert list(zip(data["x0"], data["y0"], data["y1"], data["val"])) == \
+            [(x[0], y[0], y[1], v) for x, y, v in lines]
+
+    with pytest.raises(ValueError):
+        heatmap.ms_data_heatmap(text_folder, DATE_RANGES, cmap=heatmap.inferno,
+                            plot_func=heatmap.plot_with_bokeh,
+                                outfp=outfp, mode="sidecar", contributors=3,
+                                show_plot=False)
+
+
+def test_heatmap_server_reports_errors(text_folder, monkeypatch):
+    def fail(*args, **kwargs):
+        raise KeyError("Synth9999999")
+
+    monkeypatch.setattr(heatmap, "milestone_alignments", fail)
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    heatmap.extract_milestone_data_from_folder(text_folder)
+    server = threading.Thread(target=heatmap.serve_heatmap, args=(text_folder, DATE_RANGES),
+                              kwargs=dict(port=port, open_browser=False), daemon=True)
+    server.start()
+    url = "http://127.0.0.1:{}/".format(port)
+    for i in range(50):
+        try:
+            urllib.request.urlopen(url + "tiles/0/0/0")
+            break
+        except urllib.error.URLError:
+            time.sleep(0.1)
+    for path, code in [("milestone/0/5", 500), ("tiles/x", 404), ("tiles/5/0/0", 404)]:
+        with pytest.raises(urllib.error.HTTPError) as e:
+            urllib.request.urlopen(url + path)
+        assert e.value.code == code
+
+
+def test_overview_shows_the_whole_text_with_a_window(text_folder):
+    summaries = serial_lines(text_folder)[3]
+    layout = heatmap.ms_data_heatmap(text_folder, DATE_RANGES, cmap=heatmap.inferno,
+                                     plot_func=heatmap.plot_with_bokeh, overview=True,
+                                     milestone_range=(10, 20), show_plot=False)
+    range_tool = layout.select_one({"type": heatmap.RangeTool})
+    assert (range_tool.x_range.start, range_tool.x_range.end) == (10, 20)
+    overview = [p for p in layout.select({"type": heatmap.figure().__class__})
+                if range_tool in p.tools][0]
+    assert overview.x_range.start == 0
+    assert overview.x_range.end > max(int(s["ms"].max()) for s in summaries)
+    sources = [r.data_source for r in overview.renderers]
+    for summary, source in zip(summaries, sources):
+        ms = np.asarray(source.data["ms"])
+        tokens = np.asarray(source.data["reused_tokens"])
+        assert np.array_equal(tokens[summary["ms"]], summary["reused_tokens"])
+        assert ms[0] == 0 and tokens.sum() == summary["reused_tokens"].sum()
+
+
+def brute_force_totals(folder, date_range):
+    """Count the alignments and reused tokens (summed over all alignments)."""
+    rows = [(ms, bw, ew) for text, text_rows in srt_alignments(folder).items()
+            if date_range[0] <= heatmap.meta[text]["date"] < date_range[1]
+            for ms, bw, ew in text_rows]
+    return len(rows), sum(ew - bw for ms, bw, ew in rows)
+
+
+def test_full_preview_equals_brute_force(text_folder):
+    lines, max_val, last_ms, estimates = heatmap.preview_heatmap_lines(
+        text_folder, DATE_RANGES, fraction=1.0, stratum_size=300)
+    for dr, dr_lines, e in zip(DATE_RANGES, lines, estimates):
+        assert lines_to_counts(dr_lines) == brute_force_counts(text_folder, dr)
+        assert (e["alignments"], e["reused_tokens"]) == brute_force_totals(text_folder, dr)
+        assert e["alignments_se"] == e["reused_tokens_se"] == 0
+    # nothing is saved in the folder:
+    assert not [fn for fn in os.listdir(text_folder) if fn.endswith(".json")]
+
+
+def test_file_sample_preview_is_scaled_up(text_folder):
+    # a single stratum of 12 files, of which 3 are sampled:
+    lines, max_val, last_ms, estimates = heatmap.preview_heatmap_lines(
+        text_folder, [(0, 1501)], fraction=0.25, stratum_size=2000)
+    e = estimates[0]
+    assert (e["sampled"], e["total"]) == (3, 12)
+    assert all(v % 4 == 0 for x, y, v in lines[0])
+    assert sum((y[1] - y[0]) * v for x, y, v in lines[0]) == e["reused_tokens"]
+    assert e["reused_tokens_se"] > 0
+
+    estimates = []
+    for seed in range(40):
+        estimates.append(heatmap.preview_heatmap_lines(
+            text_folder, DATE_RANGES, fraction=0.5, stratum_size=300, seed=seed)[3])
+    # the estimates are unbiased:
+    for x, dr in enumerate(DATE_RANGES):
+        n_alignments, n_tokens = brute_force_totals(text_folder, dr)
+        mean = np.mean([e[x]["reused_tokens"] for e in estimates])
+        se = np.mean([e[x]["reused_tokens_se"] for e in estimates])
+        assert abs(mean - n_tokens) < 3 * se / np.sqrt(len(estimates)) + 0.02 * n_tokens
+
+
+def test_row_sample_preview(text_folder):
+    fraction = 0.25
+    n_rows = sum(len(rows) for rows in srt_alignments(text_folder).values())
+    sampled = []
+    for seed in range(20):
+        lines, max_val, last_ms, estimates = heatmap.preview_heatmap_lines(
+            text_folder, DATE_RANGES, fraction=fraction, sample="rows", seed=seed)
+        for e in estimates:
+            assert e["alignments"] == pytest.approx(e["sampled"] / fraction)
+        sampled.append(sum(e["sampled"] for e in estimates))
+    assert np.mean(sampled) == pytest.approx(fraction * n_rows, rel=0.1)
+
+
+def test_sample_lines_is_a_bernoulli_sample():
+    rnd = np.random.default_rng(0)
+    lines = [str(i) for i in range(20000)]
+    sample = list(heatmap.sample_lines(iter(lines), 0.1, rnd))
+    assert sample == sorted(set(sample), key=int)
+    assert abs(len(sample) - 2000) < 3 * np.sqrt(20000 * 0.1 * 0.9)
+    assert list(heatmap.sample_lines(iter(lines), 1.0, rnd)) == lines
+
+
+def test_reuse_network_matches_srt_files(text_folder, tmp_path):
+    expected = dict()
+    for fn in os.listdir(text_folder):
+        if not heatmap.is_pair_file(fn):
+            continue
+        ids = [bk.split("-")[0] for bk in heatmap.split_pair_file_name(fn)]
+        opener = gzip.open if fn.endswith(".gz") else open
+        with opener(os.path.join(text_folder, fn), mode="rt", encoding="utf-8") as file:
+            rows = [row for row in csv.DictReader(file, delimiter="\t")
+                    if int(row["ew1"]) - int(row["bw1"]) >= 20
+                    and int(row["ew2"]) - int(row["bw2"]) >= 20]
+        tokens = {ids[i]: sum(int(row["ew"+n]) - int(row["bw"+n]) for row in rows)
+                  for i, n in enumerate("12")}
+        expected[frozenset(ids)] = (len(rows), tokens)
+    expected = {pair: totals for pair, totals in expected.items() if totals[0]}
+
+    network = heatmap.build_reuse_network(text_folder, min_alignment_length=20, workers=1)
+    texts = network["texts"]
+    assert network["dates"] == sorted(network["dates"])
+    edges = dict()
+    for i, j, n, tokens_i, tokens_j in zip(network["row"], network["col"],
+                                           network["alignments"],
+                                           network["row_tokens"], network["col_tokens"]):
+        assert i < j
+        edges[frozenset([texts[i], texts[j]])] = (n, {texts[i]: tokens_i, texts[j]: tokens_j})
+    assert edges == expected
+
+    fp = str(tmp_path / "network.tsv")
+    heatmap.save_reuse_network_csv(network, fp)
+    with open(fp, mode="r", encoding="utf-8") as file:
+        rows = list(csv.DictReader(file, delimiter="\t"))
+    assert {frozenset([r["text1"], r["text2"]]): int(r["alignments"]) for r in rows} == \
+        {pair: n for pair, (n, tokens) in expected.items()}
+
+    layout = heatmap.plot_reuse_network(network, show_plot=False)
+    # both cells of each pair in the matrix:
+    sources = layout.select({"type": heatmap.ColumnDataSource})
+    sizes = [len(source.data["tokens"]) for source in sources if "y" in source.data
+             and "tokens" in source.data]
+    assert sizes == [2*len(expected)]
+
+
+@pytest.mark.parametrize("metric", ["alignments", "tokens", "texts"])
+def test_ms_date_matrix_matches_brute_force(text_folder, metric):
+    heatmap.extract_milestone_data_from_folder(text_folder)
+    ms_range, ms_bin, date_range, year_bin = (5, 27), 4, (100, 1400), 50
+    alignments, text_ids = heatmap.load_alignments(text_folder, [(0, 1501)],
+                                                   columns=["comp_date"])
+    a = alignments[0]
+    matrix, ms_totals, year_totals = heatmap.ms_date_matrix(
+        a["ms"], a["bw"], a["ew"], a["comp_date"], a["text"], ms_range, ms_bin,
+        date_range, year_bin, metric)
+    assert matrix.shape == (26, 6)
+
+    cells, ms_cells, year_cells = Counter(), Counter(), Counter()
+    cell_texts, ms_texts, year_texts = set(), set(), set()
+    for text, rows in srt_alignments(text_folder).items():
+        date = heatmap.meta[text]["date"]
+        if not date_range[0] <= date < date_range[1]:
+            continue
+        y = (date - date_range[0]) // year_bin
+        for ms, bw, ew in rows:
+            if not ms_range[0] <= ms < ms_range[1]:
+                continue
+            x = (ms - ms_range[0]) // ms_bin
+            if metric == "texts":
+                cell_texts.add((y, x, text))
+                ms_texts.add((x, text))
+                year_texts.add((y, text))
+            else:
+                value = ew - bw if metric == "tokens" else 1
+                cells[(y, x)] += value
+                ms_cells[x] += value
+                year_cells[y] += value
+    if metric == "texts":
+        cells = Counter((y, x) for y, x, text in cell_texts)
+        ms_cells = Counter(x for x, text in ms_texts)
+        year_cells = Counter(y for y, text in year_texts)
+    assert {(y, x): v for (y, x), v in np.ndenumerate(matrix) if v} == dict(cells)
+    assert {x: v for x, v in enumerate(ms_totals) if v} == dict(ms_cells)
+    assert {y: v for y, v in enumerate(year_totals) if v} == dict(year_cells)
+
+    layout = heatmap.ms_date_heatmap(text_folder, date_range, year_bin, ms_bin, metric,
+                                     milestone_range=ms_range, show_plot=False)
+    sources = layout.select({"type": heatmap.ColumnDataSource})
+    image = [source.data["image"][0] for source in sources if "image" in source.data][0]
+    assert np.array_equal(np.nan_to_num(image), matrix)
+
+
+def test_diff_heatmap_matches_brute_force(text_folder, tmp_path, monkeypatch):
+    new = str(tmp_path / "new" / "Synth0000001")
+    shutil.copytree(text_folder, new)
+    pair_fns = sorted(fn for fn in os.listdir(new) if heatmap.is_pair_file(fn))
+    # the texts of the first files lose reuse, those of the next ones gain reuse:
+    for fn in pair_fns[:3]:
+        os.remove(os.path.join(new, fn))
+    for fn in pair_fns[3:6]:
+        os.remove(os.path.join(text_folder, fn))
+    for folder in [text_folder, new]:
+        heatmap.extract_milestone_data_from_folder(folder)
+
+    shapes = []
+    dense_coverage = heatmap.dense_coverage
+    def recorded_dense_coverage(*args):
+        matrix = dense_coverage(*args)
+        shapes.append(matrix.shape)
+        return matrix
+    monkeypatch.setattr(heatmap, "dense_coverage", recorded_dense_coverage)
+
+    for milestone_range in [None, (10, 20)]:
+        shapes.clear()
+        diff_lines, totals = heatmap.diff_heatmap(text_folder, new, DATE_RANGES,
+                                                  milestone_range=milestone_range,
+                                                  show_plot=False)
+        if milestone_range:
+            assert all(shape[0] <= 10 for shape in shapes)
+        for dr, lines, t in zip(DATE_RANGES, diff_lines, totals):
+            old_counts = brute_force_counts(text_folder, dr, milestone_range=milestone_range)
+            new_counts = brute_force_counts(new, dr, milestone_range=milestone_range)
+            diff = {key: new_counts.get(key, 0) - old_counts.get(key, 0)
+                    for key in set(old_counts) | set(new_counts)}
+            diff = {key: v for key, v in diff.items() if v}
+            assert lines_to_counts(lines) == diff
+            assert t["gained"] == sum(v for v in diff.values() if v > 0)
+            assert t["lost"] == -sum(v for v in diff.values() if v < 0)
+            assert t["net"] == sum(diff.values())
+        assert sum(t["gained"] for t in totals) and sum(t["lost"] for t in totals)
+
+
+def brute_force_passages(counts, min_count, rank_by):
+    """Find the passages in per-token counts ({(ms, token): count})
+    and sort them by score, milestone and start token."""
+    passages = []
+    for (ms, token), count in sorted(counts.items()):
+        if count < min_count:
+            continue
+        p = passages[-1] if passages else None
+        if p and p["ms"] == ms and p["end"] == token:
+            p["end"] += 1
+            p["peak"] = max(p["peak"], count)
+            p["total"] += count
+        else:
+            passages.append({"ms": ms, "start": token, "end": token + 1,
+                             "peak": count, "total": count})
+    max_mean = max(p["total"] / (p["end"] - p["start"]) for p in passages)
+    for p in passages:
+        mean = p["total"] / (p["end"] - p["start"])
+        p["score"] = {"peak": p["peak"] + mean / (max_mean + 1), "mean": mean,
+                      "total": p["total"]}[rank_by]
+    return sorted(passages, key=lambda p: (-p["score"], p["ms"], p["start"]))
+
+
+@pytest.mark.parametrize("rank_by", ["peak", "mean", "total"])
+def test_top_reused_passages_match_brute_force(text_folder, rank_by):
+    heatmap.extract_milestone_data_from_folder(text_folder)
+    counts = brute_force_counts(text_folder, (0, 1501))
+    for min_count in [1, 3]:
+        expected = brute_force_passages(counts, min_count, rank_by)
+        for k in [1, 7, 20, len(expected) + 5]:
+            top = heatmap.top_reused_passages(text_folder, k=k, min_count=min_count,
+                                              rank_by=rank_by)
+            assert [(p["ms"], p["start"], p["end"], p["peak"], p["total"]) for p in top] == \
+                [(p["ms"], p["start"], p["end"], p["peak"], p["total"])
+                 for p in expected[:k]]
+            assert [p["rank"] for p in top] == list(range(1, len(top) + 1))
+
+
+def test_top_k_breaks_ties_like_a_full_sort():
+    rnd = np.random.default_rng(0)
+    for i in range(100):
+        n = int(rnd.integers(1, 300))
+        score = rnd.integers(0, 5, n).astype(np.float64)
+        ms = rnd.integers(0, 10, n)
+        start = rnd.permutation(n)
+        k = int(rnd.integers(0, n + 3))
+        expected = np.lexsort((start, ms, -score))[:k]
+        assert np.array_equal(heatmap.top_k(score, k, ms, start), expected)
+
+
+def test_stale_lock_removal_keeps_a_new_lock(tmp_path, monkeypatch):
+    lock_fp = str(tmp_path / "shard.npz.lock")
+    dead = subprocess.Popen([sys.executable, "-c", "pass"])
+    dead.wait()
+    stale = "{} {} 2020-01-01 00:00:00".format(dead.pid, socket.gethostname())
+    live = "{} {} 2020-01-01 00:00:01".format(os.getppid(), socket.gethostname())
+    with open(lock_fp, mode="w", encoding="utf-8") as file:
+        file.write(stale)
+
+    # while this process checks the owner, another process removes
+    # the stale lock and a third one locks the file:
+    def replace_lock(pid):
+        os.remove(lock_fp)
+        with open(lock_fp, mode="w", encoding="utf-8") as file:
+            file.write(live)
+        return False
+    monkeypatch.setattr(heatmap, "process_is_running", replace_lock)
+    assert not heatmap.remove_stale_lock(lock_fp)
+    with open(lock_fp, mode="r", encoding="utf-8") as file:
+        assert file.read() == live
+    monkeypatch.undo()
+
+    # another process is removing the stale lock:
+    with open(lock_fp, mode="w", encoding="utf-8") as file:
+        file.write(stale)
+    open(lock_fp + ".break", mode="w").close()
+    assert not heatmap.remove_stale_lock(lock_fp)
+    assert os.path.exists(lock_fp)
+    # ... or it died while doing so:
+    os.utime(lock_fp + ".break", (0, 0))
+    assert not heatmap.remove_stale_lock(lock_fp)
+    assert heatmap.remove_stale_lock(lock_fp)
+    assert os.listdir(str(tmp_path)) == []